@@ -0,0 +1,330 @@
+"""
+Benchmark offline do pipeline fila → player_loop → áudio (sem Discord nem YouTube).
+
+- Extractor stub: extract_info devolve info "enlatada" e o download copia um WAV local
+  (latências configuráveis, para simular o YouTube).
+- VoiceClient falso: consome AudioSource.read() em tempo real (20 ms por frame) ou mais depressa.
+- N servidores simulados em paralelo; mede time-to-first-frame, intervalo entre faixas,
+  CPU por stream e lag do event loop (p50/p99).
+
+Uso:
+    python bench.py --guilds 20 --tracks 3 --track-seconds 3
+    python bench.py --no-ffmpeg          # sem FFmpeg instalado: lê o WAV em Python
+    python bench.py --output bench_output.txt
+    python bench.py --timeout 60         # tempo máximo por servidor (0 = calculado a partir das latências)
+"""
+import os
+import sys
+import time
+import wave
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import uuid
+from array import array
+from typing import Optional
+
+os.environ.setdefault("DISCORD_BOT_TOKEN", "bench")  # main.py não liga ao Discord ao importar
+os.environ.setdefault("METADATA_CACHE_FILE", "")  # não persistir a cache de metadados do bench
+os.environ.setdefault("QUEUE_JOURNAL_FILE", "")  # nem as filas
+os.environ.setdefault("AUDIO_CACHE_DIR", os.path.join(tempfile.gettempdir(), "bench_audio_cache"))
+
+import discord
+
+import main
+
+FRAME_BYTES = discord.opus.Encoder.FRAME_SIZE  # 20 ms de PCM 48 kHz estéreo 16-bit
+FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+
+def make_wav(path: str, seconds: float) -> None:
+    """Gera um WAV 48 kHz estéreo (onda quadrada baixa) para usar como faixa."""
+    frames = int(48000 * seconds)
+    samples = array("h", [0]) * (frames * 2)
+    for i in range(0, len(samples), 2):
+        value = 2000 if (i // 2 // 109) % 2 else -2000  # ~220 Hz
+        samples[i] = samples[i + 1] = value
+    with wave.open(path, "wb") as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(48000)
+        w.writeframes(samples.tobytes())
+
+
+class StubExtractor:
+    """Substitui extract_info / download_audio_to_file do main por versões locais."""
+
+    def __init__(self, wav_path: str, track_seconds: float, resolve_latency: float, download_latency: float):
+        self.wav_path = wav_path
+        self.track_seconds = track_seconds
+        self.resolve_latency = resolve_latency
+        self.download_latency = download_latency
+
+    def extract_info(self, query: str) -> dict:
+        time.sleep(self.resolve_latency)
+        video_id = uuid.uuid5(uuid.NAMESPACE_URL, query).hex[:11]
+        return {
+            "title": f"Bench {query}",
+            "webpage_url": f"https://bench.invalid/watch?v={video_id}",
+            "url": None,
+            "duration": self.track_seconds,
+            "cache_key": f"Bench-{video_id}",
+        }
+
+    def download_audio_to_file(
+        self, url: str, resolved: Optional[dict] = None, cancel_event: Optional[threading.Event] = None
+    ) -> Optional[str]:
+        deadline = time.monotonic() + self.download_latency
+        while time.monotonic() < deadline:
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            time.sleep(0.01)
+        path = main.temp_janitor.new_base() + ".wav"
+        shutil.copyfile(self.wav_path, path)
+        return path
+
+    def install(self) -> None:
+        main.extract_info = self.extract_info
+        main.download_audio_to_file = self.download_audio_to_file
+
+
+class WavPCMAudio(discord.AudioSource):
+    """
+    Substituto do FFmpegPCMAudio para máquinas sem FFmpeg (lê PCM do WAV diretamente).
+    open_latency simula o arranque do FFmpeg (spawn + probe + primeira descodificação) no primeiro read().
+    """
+
+    open_latency = 0.0
+
+    def __init__(self, source, **_kwargs):
+        self._wav = wave.open(source, "rb")
+        self._opened = False
+
+    def read(self) -> bytes:
+        if not self._opened:
+            self._opened = True
+            time.sleep(self.open_latency)
+        data = self._wav.readframes(FRAME_BYTES // 4)
+        return data if len(data) == FRAME_BYTES else b""
+
+    def cleanup(self) -> None:
+        self._wav.close()
+
+
+class TrackTimes:
+    def __init__(self):
+        self.first_frame: list[float] = []
+        self.end: list[float] = []
+        self.enqueued_at: list[float] = []
+
+
+class FakeVoiceClient:
+    """VoiceClient falso: uma thread por faixa a consumir frames como o AudioPlayer do discord.py."""
+
+    def __init__(self, times: TrackTimes, speed: float):
+        self.times = times
+        self.speed = speed
+        self._playing = False
+        self._stop = threading.Event()
+
+    def is_connected(self) -> bool:
+        return True
+
+    def is_playing(self) -> bool:
+        return self._playing
+
+    def is_paused(self) -> bool:
+        return False
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def play(self, source: discord.AudioSource, *, after=None) -> None:
+        self._stop.clear()
+        self._playing = True
+        enqueued_at = getattr(source, "item", {}).get("enqueued_at")
+        threading.Thread(target=self._run, args=(source, after, enqueued_at), daemon=True).start()
+
+    def _run(self, source: discord.AudioSource, after, enqueued_at: Optional[float]) -> None:
+        interval = FRAME_SECONDS / self.speed
+        next_at = time.perf_counter()
+        first = True
+        error = None
+        try:
+            while not self._stop.is_set():
+                data = source.read()
+                if not data:
+                    break
+                if first:
+                    first = False
+                    self.times.first_frame.append(time.monotonic())
+                    self.times.enqueued_at.append(enqueued_at or time.monotonic())
+                next_at += interval
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+        finally:
+            self.times.end.append(time.monotonic())
+            self._playing = False
+            source.cleanup()
+            if after is not None:
+                after(error)
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, voice_client: FakeVoiceClient):
+        self.id = guild_id
+        self.name = f"bench-{guild_id}"
+        self.voice_client = voice_client
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def loop_lag_sampler(samples: list[float], stop: asyncio.Event, interval: float = 0.05) -> None:
+    while not stop.is_set():
+        before = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - before - interval))
+
+
+def guild_timeout(args) -> float:
+    """Tempo máximo para um servidor tocar todas as faixas (--timeout ou folga generosa sobre o esperado)."""
+    if args.timeout > 0:
+        return args.timeout
+    per_track = args.track_seconds / args.speed + args.resolve_latency + args.download_latency + args.open_latency
+    return 30 + 3 * per_track * args.tracks
+
+
+async def run_guild(guild_id: int, args, times: TrackTimes, failures: list[str]) -> None:
+    guild = FakeGuild(guild_id, FakeVoiceClient(times, args.speed))
+    state = main.get_state(guild_id)
+    task = asyncio.ensure_future(main.player_loop(guild))
+    deadline = time.monotonic() + guild_timeout(args)
+    try:
+        for i in range(args.tracks):
+            # Igual ao !play: resolver (cache de metadados / pool) e pôr na fila
+            info = await main.resolve_query(guild_id, f"g{guild_id} t{i}" if not args.repeat else f"t{i}")
+            state.queue.put(info)
+            main.schedule_prefetch(state)
+        while len(times.end) < args.tracks:
+            if time.monotonic() > deadline:
+                # Faixa que nunca tocou (erro na source, FFmpeg a falhar, ...): não ficar à espera para sempre
+                failures.append(f"servidor {guild_id}: {len(times.end)}/{args.tracks} faixas em {guild_timeout(args):.0f}s")
+                return
+            if task.done():
+                error = task.exception() if not task.cancelled() else None
+                failures.append(f"servidor {guild_id}: player_loop terminou ({error!r})")
+                return
+            await asyncio.sleep(0.05)
+    finally:
+        task.cancel()
+        main.cancel_downloads(state)
+
+
+async def run(args) -> tuple[str, list[str]]:
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    wav_path = os.path.join(workdir, "track.wav")
+    make_wav(wav_path, args.track_seconds)
+    StubExtractor(wav_path, args.track_seconds, args.resolve_latency, args.download_latency).install()
+    if args.no_ffmpeg:
+        discord.FFmpegPCMAudio = discord.FFmpegOpusAudio = WavPCMAudio
+        main.loudness.workers = 0  # a análise de loudness também precisa do FFmpeg
+        WavPCMAudio.open_latency = args.open_latency
+    if not args.cache:
+        main.audio_cache.max_bytes = 0
+    main.load_persistent_state()
+
+    lag: list[float] = []
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(loop_lag_sampler(lag, stop))
+    times = {gid: TrackTimes() for gid in range(1, args.guilds + 1)}
+    failures: list[str] = []
+
+    cpu_before = os.times()
+    wall_before = time.monotonic()
+    await asyncio.gather(*(run_guild(gid, args, t, failures) for gid, t in times.items()))
+    wall = time.monotonic() - wall_before
+    cpu_after = os.times()
+    stop.set()
+    await sampler
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    # Primeira faixa de cada servidor (fila vazia → áudio) e todas as faixas (inclui esperar pelas anteriores)
+    ttff = [t.first_frame[0] - t.enqueued_at[0] for t in times.values() if t.first_frame]
+    enqueue_to_audio = [f - e for t in times.values() for f, e in zip(t.first_frame, t.enqueued_at)]
+    gaps = [t.first_frame[i + 1] - t.end[i] for t in times.values() for i in range(len(t.first_frame) - 1)]
+    cpu = sum(
+        getattr(cpu_after, f) - getattr(cpu_before, f)
+        for f in ("user", "system", "children_user", "children_system")
+    )
+    audio_seconds = args.guilds * args.tracks * args.track_seconds
+
+    def row(name: str, values: list[float], unit: str = "ms", scale: float = 1000) -> str:
+        return (
+            f"{name:<24} n={len(values):<5} p50={percentile(values, 50) * scale:9.1f}{unit} "
+            f"p99={percentile(values, 99) * scale:9.1f}{unit} max={max(values, default=float('nan')) * scale:9.1f}{unit}"
+        )
+
+    lines = [
+        f"guilds={args.guilds} tracks={args.tracks} track_seconds={args.track_seconds} speed={args.speed} "
+        f"resolve={args.resolve_latency}s download={args.download_latency}s prefetch={main.PREFETCH_COUNT} "
+        f"workers={main.EXTRACT_WORKERS} ffmpeg={'no' if args.no_ffmpeg else main.FFMPEG_EXECUTABLE} "
+        f"cache={'on' if args.cache else 'off'} encode={main.AUDIO_ENCODE_MODE} gapless={'on' if main.GAPLESS else 'off'}",
+        row("time-to-first-frame", ttff),
+        row("enqueue-to-audio", enqueue_to_audio),
+        row("inter-track gap", gaps),
+        row("event-loop lag", lag),
+        f"{'cpu per stream':<24} {cpu / max(audio_seconds / args.speed, 1e-9) * 100:.2f}% de um core "
+        f"({cpu:.2f}s CPU em {wall:.1f}s)",
+    ]
+    if failures:
+        lines.append(f"FALHAS ({len(failures)} servidores):")
+        lines.extend(f"  {failure}" for failure in failures)
+    return "\n".join(lines), failures
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark offline do player do bot de música.")
+    parser.add_argument("--guilds", type=int, default=10, help="Servidores simulados em paralelo")
+    parser.add_argument("--tracks", type=int, default=3, help="Faixas por servidor")
+    parser.add_argument("--track-seconds", type=float, default=3.0, help="Duração de cada faixa")
+    parser.add_argument("--speed", type=float, default=1.0, help="Velocidade de consumo (1 = tempo real)")
+    parser.add_argument("--resolve-latency", type=float, default=0.5, help="Latência simulada do extract_info (s)")
+    parser.add_argument("--download-latency", type=float, default=1.0, help="Latência simulada do download (s)")
+    parser.add_argument("--repeat", action="store_true", help="Todos os servidores pedem as mesmas faixas")
+    parser.add_argument("--cache", action="store_true", help="Ativar a cache de áudio (AUDIO_CACHE_DIR)")
+    parser.add_argument("--no-ffmpeg", action="store_true", help="Ler o WAV em Python em vez de usar FFmpeg")
+    parser.add_argument(
+        "--open-latency", type=float, default=0.15, help="Com --no-ffmpeg: arranque simulado do FFmpeg por faixa (s)"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=0, help="Tempo máximo por servidor em s (0 = calculado a partir das latências)"
+    )
+    parser.add_argument("--output", help="Também gravar o relatório neste ficheiro")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.no_ffmpeg and not main._is_ffmpeg_available():
+        print(
+            f"FFmpeg não encontrado ({main.FFMPEG_EXECUTABLE}). Instala-o, define FFMPEG_PATH "
+            "ou corre com --no-ffmpeg (lê o WAV em Python).",
+            file=sys.stderr,
+        )
+        sys.exit(2)
+    report, failures = asyncio.run(run(args))
+    print(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    sys.exit(1 if failures else 0)
@@ -1,26 +1,175 @@
 import os
+import re
 import sys
+import copy
+import json
+import glob
 import asyncio
 import subprocess
 import tempfile
 import time
 import uuid
+import heapq
+import random
+import inspect
+import traceback
+import itertools
 import platform
+import warnings
+import shutil
+import sqlite3
+import threading
+import functools
+import concurrent.futures
+import multiprocessing
+import hashlib
+import signal
+import stat
+import unicodedata
+import urllib.request
+from collections import OrderedDict, deque
 from typing import Optional
+from urllib.parse import parse_qs, urlparse
 
+import aiohttp
 from dotenv import load_dotenv
 
 load_dotenv()
 
 import discord
+from discord import app_commands
 from discord.ext import commands
 
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", DeprecationWarning)
+    try:
+        import audioop  # Só para o crossfade (o discord.py já o usa no PCMVolumeTransformer)
+    except ImportError:
+        audioop = None
+
 import yt_dlp
 
 # ====== CONFIG ======
 TOKEN = os.getenv("DISCORD_BOT_TOKEN")  # ou mete o token diretamente (não recomendado)
 COMMAND_PREFIX = "!"  # Ex: !play
 INACTIVITY_LEAVE_SECONDS = 10 * 60  # Auto !leave after 10 minutes of inactivity
+INACTIVITY_BUSY_RETRY_SECONDS = 60  # A tocar/com fila quando o timer expira: volta a verificar daqui a isto
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", "2"))  # Próximas músicas a descarregar em background (0 = desliga)
+# Cache de áudio em disco partilhado por todos os servidores (chave = extractor + ID do vídeo)
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "cache", "audio"
+)
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_MB", "2048")) * 1024 * 1024  # 0 = desliga a cache
+AUDIO_CACHE_POLICY = os.getenv("AUDIO_CACHE_POLICY", "lru").strip().lower()  # "lru" ou "lfu"
+# Playlists: entradas leves (extração "flat") resolvidas só quando se aproximam do início da fila
+PLAYLIST_MAX_ENTRIES = int(os.getenv("PLAYLIST_MAX_ENTRIES", "200"))  # Máximo de faixas por pedido
+PLAYLIST_RESOLVE_AHEAD = int(os.getenv("PLAYLIST_RESOLVE_AHEAD", "5"))  # Resolve as N primeiras da fila
+PLAYLIST_PAGE_SIZE = int(os.getenv("PLAYLIST_PAGE_SIZE", "50"))  # Entradas extraídas (e adicionadas) de cada vez
+# !playmany: várias pesquisas/links numa mensagem (uma por linha), resolvidas em paralelo
+PLAYMANY_MAX_LINES = int(os.getenv("PLAYMANY_MAX_LINES", "50"))
+PLAYMANY_CONCURRENCY = int(os.getenv("PLAYMANY_CONCURRENCY", "4"))  # Limitado também por EXTRACT_MAX_PENDING_PER_GUILD
+# Info resolvida no !play é reutilizada no download enquanto o URL direto for válido
+DIRECT_URL_DEFAULT_TTL_SECONDS = 10 * 60  # Quando o site não indica quando o URL expira
+DIRECT_URL_EXPIRY_MARGIN_SECONDS = 2 * 60  # Margem para o download começar antes de expirar
+# Anexos do !play: downloads em paralelo, limites de tamanho e deduplicação por hash do conteúdo
+ATTACHMENT_CONCURRENCY = int(os.getenv("ATTACHMENT_CONCURRENCY", "4"))
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_MB", "100")) * 1024 * 1024  # Por ficheiro
+ATTACHMENT_GUILD_MAX_BYTES = int(os.getenv("ATTACHMENT_GUILD_MAX_MB", "500")) * 1024 * 1024  # Por servidor
+# Sharding: "off" (um Bot normal), "auto" (AutoShardedBot num só processo) ou "process"
+# (supervisor que lança SHARD_PROCESSES processos, cada um com um intervalo de shards, e os reinicia se falharem)
+SHARD_MODE = os.getenv("SHARD_MODE", "off").strip().lower()
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))  # 0 = o número recomendado pelo Discord
+SHARD_PROCESSES = int(os.getenv("SHARD_PROCESSES", str(os.cpu_count() or 1)))
+# Definidos pelo supervisor em cada processo filho (não configurar à mão)
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "-1"))  # Índice do processo; -1 = processo único
+SHARD_IDS = [int(x) for x in os.getenv("SHARD_IDS", "").split(",") if x.strip()]
+SHARD_PROCESS_COUNT = int(os.getenv("SHARD_PROCESS_COUNT", "1"))  # Nº de processos lançados pelo supervisor
+# A cache de áudio não é partilhada entre processos de shards: leitores (pins) e orçamento são por processo,
+# por isso uma pasta comum deixava um processo apagar o ficheiro que outro está a tocar e ocupar N× o orçamento.
+# Cada processo usa AUDIO_CACHE_DIR/shard<N> com AUDIO_CACHE_MAX_MB / nº de processos (o total fica igual;
+# a mesma faixa pedida em servidores de processos diferentes é descarregada uma vez por processo).
+if SHARD_INDEX >= 0:
+    AUDIO_CACHE_PROCESS_DIR = os.path.join(AUDIO_CACHE_DIR, f"shard{SHARD_INDEX}")
+    AUDIO_CACHE_PROCESS_MAX_BYTES = AUDIO_CACHE_MAX_BYTES // max(SHARD_PROCESS_COUNT, 1)
+else:
+    AUDIO_CACHE_PROCESS_DIR = AUDIO_CACHE_DIR
+    AUDIO_CACHE_PROCESS_MAX_BYTES = AUDIO_CACHE_MAX_BYTES
+# Métricas em formato Prometheus num endpoint HTTP local (0 = desligado)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1").strip()
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+if METRICS_PORT > 0 and SHARD_INDEX > 0:
+    METRICS_PORT += SHARD_INDEX  # Uma porta por processo de shards (METRICS_PORT, +1, +2, …)
+# Pool dedicado para extrações/downloads do yt-dlp (partilhado por todos os servidores, com fairness)
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))
+EXTRACT_POOL_MODE = os.getenv("EXTRACT_POOL_MODE", "thread").strip().lower()  # "thread" ou "process"
+EXTRACT_MAX_PENDING_PER_GUILD = int(os.getenv("EXTRACT_MAX_PENDING_PER_GUILD", "10"))  # Pesquisas em espera por servidor
+EXTRACT_TIMEOUT_SECONDS = float(os.getenv("EXTRACT_TIMEOUT_SECONDS", "60"))
+DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("DOWNLOAD_TIMEOUT_SECONDS", "900"))
+# Streaming progressivo (opcional): começa a tocar enquanto o yt-dlp ainda descarrega
+STREAM_MODE = os.getenv("STREAM_MODE", "0").strip() == "1"
+STREAM_BUFFER_BYTES = int(os.getenv("STREAM_BUFFER_KB", "512")) * 1024  # Buffer mínimo antes de tocar
+STREAM_START_TIMEOUT_SECONDS = float(os.getenv("STREAM_START_TIMEOUT_SECONDS", "20"))
+# Cache de metadados (resultado de pesquisas/links) para responder ao !play sem ir ao YouTube
+METADATA_CACHE_TTL_SECONDS = int(os.getenv("METADATA_CACHE_TTL_SECONDS", str(6 * 3600)))
+METADATA_CACHE_MAX_ENTRIES = int(os.getenv("METADATA_CACHE_MAX_ENTRIES", "5000"))
+# Ficheiro para persistir a cache entre reinícios (vazio = só em memória)
+METADATA_CACHE_FILE = os.getenv(
+    "METADATA_CACHE_FILE", os.path.join(os.path.dirname(AUDIO_CACHE_DIR), "metadata.json")
+).strip()
+# Biblioteca local: pastas com música (separadas por os.pathsep, ex: /musica:/mnt/nas) indexadas em SQLite
+LIBRARY_DIRS = [d for d in os.getenv("LIBRARY_DIRS", "").split(os.pathsep) if d.strip()]
+LIBRARY_DB_FILE = os.getenv("LIBRARY_DB_FILE", os.path.join(os.path.dirname(AUDIO_CACHE_DIR), "library.sqlite3")).strip()
+LIBRARY_SCAN_WORKERS = int(os.getenv("LIBRARY_SCAN_WORKERS", "4"))  # Processos ffprobe em paralelo
+LIBRARY_RESCAN_MINUTES = float(os.getenv("LIBRARY_RESCAN_MINUTES", "0"))  # 0 = só no arranque e com !library rescan
+# Volume: ganho fixo por faixa a partir de uma análise EBU R128 feita uma vez em background (0 = desligado)
+DEFAULT_VOLUME = float(os.getenv("DEFAULT_VOLUME", "0.7"))  # Faixas ainda sem análise
+LOUDNESS_TARGET_LUFS = float(os.getenv("LOUDNESS_TARGET_LUFS", "-18"))
+LOUDNESS_MAX_GAIN_DB = float(os.getenv("LOUDNESS_MAX_GAIN_DB", "9"))  # Não amplificar faixas muito baixas além disto (>= 0)
+LOUDNESS_WORKERS = int(os.getenv("LOUDNESS_WORKERS", "1"))
+LOUDNESS_CACHE_FILE = os.getenv(
+    "LOUDNESS_CACHE_FILE", os.path.join(os.path.dirname(AUDIO_CACHE_DIR), "loudness.json")
+).strip()
+# Codificação de áudio: "opus" = o FFmpeg aplica o volume (-af volume) e codifica Opus no seu processo,
+# o Python só envia pacotes; "pcm" = FFmpegPCMAudio + PCMVolumeTransformer + encoder Opus no processo do bot
+AUDIO_ENCODE_MODE = os.getenv("AUDIO_ENCODE_MODE", "opus").strip().lower()
+OPUS_BITRATE_KBPS = int(os.getenv("OPUS_BITRATE_KBPS", "128"))
+# stderr do FFmpeg: últimas linhas por stream (juntas aos erros) e limite de linhas/s enviadas para o terminal
+FFMPEG_STDERR_TAIL_LINES = int(os.getenv("FFMPEG_STDERR_TAIL_LINES", "20"))
+FFMPEG_STDERR_LINES_PER_SECOND = float(os.getenv("FFMPEG_STDERR_LINES_PER_SECOND", "5"))
+FFMPEG_STDERR_QUEUE_LINES = 1000  # Linhas à espera de ir para o terminal (as mais antigas caem)
+# Monitor do event loop: amostra o atraso (lag) e, se o loop ficar bloqueado mais do que o limite,
+# uma thread captura a stack do que o está a bloquear (ver !perf)
+LOOP_LAG_SAMPLE_SECONDS = float(os.getenv("LOOP_LAG_SAMPLE_SECONDS", "0.25"))
+SLOW_CALLBACK_SECONDS = float(os.getenv("SLOW_CALLBACK_SECONDS", "0.1"))
+# Transições sem pausa: o FFmpeg da próxima faixa arranca (e lê os primeiros frames) enquanto a atual toca
+GAPLESS = os.getenv("GAPLESS", "1").strip() == "1"
+GAPLESS_PRIME_FRAMES = int(os.getenv("GAPLESS_PRIME_FRAMES", "25"))  # 25 frames = 0,5 s em memória
+CROSSFADE_SECONDS = float(os.getenv("CROSSFADE_SECONDS", "0"))  # Só com AUDIO_ENCODE_MODE=pcm e duração conhecida
+# Journal das filas (sobrevive a crash/redeploy: no arranque volta aos canais de voz e continua). Vazio = desligado
+QUEUE_JOURNAL_FILE = os.getenv(
+    "QUEUE_JOURNAL_FILE", os.path.join(os.path.dirname(AUDIO_CACHE_DIR), "queue.journal")
+).strip()
+QUEUE_JOURNAL_FLUSH_SECONDS = float(os.getenv("QUEUE_JOURNAL_FLUSH_SECONDS", "1"))
+QUEUE_RESTORE_CONCURRENCY = int(os.getenv("QUEUE_RESTORE_CONCURRENCY", "5"))  # Ligações de voz em paralelo no restauro
+# Ficheiros temporários (downloads, streams, anexos): uma pasta por processo, limpa no arranque e com
+# orçamento de disco (acima dele: apaga órfãos, recusa anexos e não faz prefetch além da próxima faixa)
+TEMP_DIR = os.getenv(
+    "TEMP_DIR",
+    os.path.join(tempfile.gettempdir(), "discord_bot" + (f"_s{SHARD_INDEX}" if SHARD_INDEX >= 0 else "")),
+).strip()
+TEMP_MAX_BYTES = int(os.getenv("TEMP_MAX_MB", "4096")) * 1024 * 1024  # 0 = sem limite
+TEMP_JANITOR_INTERVAL_SECONDS = float(os.getenv("TEMP_JANITOR_INTERVAL_SECONDS", "300"))
+TEMP_STALE_SECONDS = float(os.getenv("TEMP_STALE_SECONDS", "3600"))  # Ficheiros de outros processos/versões
+# Mensagem de estado por servidor (a tocar / fila), editada no lugar em vez de uma resposta por comando.
+# Pedidos seguidos juntam-se numa só edição: espera STATUS_DEBOUNCE_SECONDS sem pedidos novos, no máximo STATUS_MAX_DELAY_SECONDS
+STATUS_DEBOUNCE_SECONDS = float(os.getenv("STATUS_DEBOUNCE_SECONDS", "1.5"))
+STATUS_MAX_DELAY_SECONDS = float(os.getenv("STATUS_MAX_DELAY_SECONDS", "5"))
+STATUS_REPOST_SECONDS = float(os.getenv("STATUS_REPOST_SECONDS", "600"))  # Mensagem mais antiga: nova no fundo do canal
+STATUS_NOTES = 5  # Últimos eventos (adicionado, skip, ...) mostrados por cima da fila
+# Slash commands (/play com autocomplete): registados no Discord no arranque só quando mudam
+SLASH_SYNC = os.getenv("SLASH_SYNC", "1").strip() == "1"
+APP_COMMANDS_HASH_FILE = os.path.join(os.path.dirname(AUDIO_CACHE_DIR), "app_commands.sha256")
+TITLE_INDEX_MAX_ENTRIES = int(os.getenv("TITLE_INDEX_MAX_ENTRIES", "100000"))  # Títulos para o autocomplete
 # Caminho para o FFmpeg (obrigatório para voz). Se não estiver no PATH, define em .env:
 # FFMPEG_PATH=C:\caminho\para\ffmpeg.exe
 def _resolve_ffmpeg() -> str:
@@ -47,6 +196,22 @@ def _resolve_ffmpeg() -> str:
 
 FFMPEG_EXECUTABLE = _resolve_ffmpeg()
 
+
+def _resolve_ffprobe() -> str:
+    """FFPROBE_PATH, ou o ffprobe ao lado do FFmpeg (vêm sempre juntos), ou o do PATH."""
+    path = os.getenv("FFPROBE_PATH", "").strip()
+    if path:
+        return path
+    folder, name = os.path.split(FFMPEG_EXECUTABLE)
+    if folder:
+        candidate = os.path.join(folder, name.replace("ffmpeg", "ffprobe"))
+        if os.path.isfile(candidate):
+            return candidate
+    return "ffprobe"
+
+
+FFPROBE_EXECUTABLE = _resolve_ffprobe()
+
 # Opções do yt-dlp: pega o melhor áudio
 YTDL_OPTS = {
     "format": "bestaudio/best",
@@ -61,27 +226,766 @@ FFMPEG_BEFORE_OPTS_FILE = "-nostdin"
 FFMPEG_OPTS = "-vn"
 
 
+class _StderrLog:
+    """
+    Escrita do stderr do FFmpeg para o terminal fora das threads de leitura: as linhas vão para uma
+    fila limitada (as mais antigas caem se o terminal não acompanhar) e uma thread grava-as em lotes,
+    com um só flush por lote.
+    """
+
+    FLUSH_INTERVAL_SECONDS = 0.2
+
+    def __init__(self, max_lines: int):
+        self._lines: deque[str] = deque(maxlen=max_lines)
+        self._dropped = 0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def put(self, line: str) -> None:
+        with self._cond:
+            if len(self._lines) == self._lines.maxlen:
+                self._dropped += 1
+            self._lines.append(line)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ffmpeg-stderr", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._lines:
+                    self._cond.wait()
+                lines, dropped = list(self._lines), self._dropped
+                self._lines.clear()
+                self._dropped = 0
+            if dropped:
+                lines.append(f"[FFMPEG] … {dropped} linhas descartadas (terminal lento)")
+            try:
+                sys.stderr.write("\n".join(lines) + "\n")
+                sys.stderr.flush()
+            except (OSError, ValueError):
+                pass
+            time.sleep(self.FLUSH_INTERVAL_SECONDS)
+
+
+ffmpeg_stderr_log = _StderrLog(FFMPEG_STDERR_QUEUE_LINES)
+
+
 class _FFmpegStderrSink:
-    """Encaminha stderr do FFmpeg para o terminal (para ver erros)."""
+    """
+    stderr de um processo FFmpeg (o discord.py chama write() a partir da thread que o lê).
+    - Guarda as últimas FFMPEG_STDERR_TAIL_LINES linhas (para juntar ao erro quando a faixa falha).
+    - Encaminha para o terminal com etiqueta (servidor/faixa) e rate limit por stream
+      (FFMPEG_STDERR_LINES_PER_SECOND): um FFmpeg muito verboso não custa mais I/O.
+    """
+
+    MAX_PARTIAL_BYTES = 4096
+    BURST_LINES = 20
+
+    def __init__(self, tag: str = ""):
+        self.tag = tag
+        self.tail: deque[str] = deque(maxlen=FFMPEG_STDERR_TAIL_LINES)
+        self._partial = b""
+        self._tokens = float(self.BURST_LINES)
+        self._last_refill = time.monotonic()
+        self._suppressed = 0
+
     def write(self, data: bytes) -> None:
-        if data:
-            sys.stderr.buffer.write(data)
-            sys.stderr.buffer.flush()
+        if not data:
+            return
+        *lines, self._partial = (self._partial + data).split(b"\n")
+        self._partial = self._partial[-self.MAX_PARTIAL_BYTES:]
+        for raw in lines:
+            line = raw.decode("utf-8", "replace").strip()
+            if line:
+                self._emit(line)
+
+    def _emit(self, line: str) -> None:
+        self.tail.append(line)
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._last_refill) * FFMPEG_STDERR_LINES_PER_SECOND, self.BURST_LINES)
+        self._last_refill = now
+        if self._tokens < 1:
+            self._suppressed += 1
+            return
+        self._tokens -= 1
+        prefix = f"[FFMPEG {self.tag}]" if self.tag else "[FFMPEG]"
+        if self._suppressed:
+            ffmpeg_stderr_log.put(f"{prefix} … {self._suppressed} linhas suprimidas")
+            self._suppressed = 0
+        ffmpeg_stderr_log.put(f"{prefix} {line}")
+
     def flush(self) -> None:
-        sys.stderr.buffer.flush()
+        pass
+
+    def tail_text(self) -> str:
+        """Últimas linhas do stderr (para mensagens de erro)."""
+        lines = list(self.tail)
+        if self._partial.strip():
+            lines.append(self._partial.decode("utf-8", "replace").strip())
+        return "\n".join(lines)
+
+
+def stream_tag(guild_id: int, item: dict) -> str:
+    title = item.get("title") or "?"
+    return f"guild={guild_id} track={title[:40]!r}"
+
+# Uma instância de YoutubeDL por worker (thread ou processo) do pool de extração
+_worker_local = threading.local()
+
+
+def _worker_ytdl() -> yt_dlp.YoutubeDL:
+    ydl = getattr(_worker_local, "ytdl", None)
+    if ydl is None:
+        ydl = _worker_local.ytdl = yt_dlp.YoutubeDL(YTDL_OPTS)
+    return ydl
 
-ytdl = yt_dlp.YoutubeDL(YTDL_OPTS)
 
 intents = discord.Intents.default()
 intents.message_content = True  # necessário para comandos por mensagem
 
-bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents)
+if SHARD_MODE in ("auto", "process"):
+    # Em modo "process" cada filho recebe SHARD_IDS/SHARD_COUNT do supervisor
+    bot = commands.AutoShardedBot(
+        command_prefix=COMMAND_PREFIX,
+        intents=intents,
+        shard_count=SHARD_COUNT or None,
+        shard_ids=SHARD_IDS or None,
+    )
+else:
+    bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents)
+
+# ====== Métricas ======
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _labels_text(key: tuple, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    """Histograma com buckets cumulativos (Prometheus) e amostras recentes para p50/p99. Thread-safe."""
+
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+    def __init__(self, name: str, doc: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series: dict[tuple, list] = {}  # labels -> [contagens por bucket, soma, total, recentes]
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0, deque(maxlen=500)]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+            series[3].append(value)
+
+    def summaries(self) -> list[tuple[tuple, int, float, float, float]]:
+        """[(labels, total, média, p50, p99)] com base nas amostras recentes."""
+        with self._lock:
+            items = [(key, series[2], series[1], sorted(series[3])) for key, series in self._series.items()]
+        result = []
+        for key, count, total, recent in items:
+            if not recent:
+                continue
+            p50 = recent[len(recent) // 2]
+            p99 = recent[min(len(recent) - 1, int(len(recent) * 0.99))]
+            result.append((key, count, total / count, p50, p99))
+        return result
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count, _recent) in self._series.items():
+                for bound, c in zip(self.buckets, counts):
+                    le = 'le="%s"' % bound
+                    lines.append(f"{self.name}_bucket{_labels_text(key, le)} {c}")
+                inf = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_labels_text(key, inf)} {count}")
+                lines.append(f"{self.name}_sum{_labels_text(key)} {total:.6f}")
+                lines.append(f"{self.name}_count{_labels_text(key)} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, doc: str):
+        self.name = name
+        self.doc = doc
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> dict[tuple, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_labels_text(key)} {value:g}" for key, value in self.values().items())
+        return lines
+
+
+class Gauge:
+    """Valor lido na altura da recolha (função sem argumentos)."""
+
+    def __init__(self, name: str, doc: str, fn):
+        self.name = name
+        self.doc = doc
+        self.fn = fn
+
+    def value(self) -> float:
+        try:
+            return float(self.fn())
+        except Exception:
+            return float("nan")
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge", f"{self.name} {self.value():g}"]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.histograms: dict[str, Histogram] = {}
+        self.counters: dict[str, Counter] = {}
+        self.gauges: dict[str, Gauge] = {}
+
+    def histogram(self, name: str, doc: str, buckets: tuple = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self.histograms.setdefault(name, Histogram(name, doc, buckets))
+
+    def counter(self, name: str, doc: str) -> Counter:
+        return self.counters.setdefault(name, Counter(name, doc))
+
+    def gauge(self, name: str, doc: str, fn) -> Gauge:
+        return self.gauges.setdefault(name, Gauge(name, doc, fn))
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in (*self.histograms.values(), *self.counters.values(), *self.gauges.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+RESOLVE_SECONDS = metrics.histogram("musicbot_resolve_seconds", "Tempo a resolver pesquisas/links (!play)")
+DOWNLOAD_SECONDS = metrics.histogram("musicbot_download_seconds", "Tempo a obter o ficheiro de áudio (cache ou download)")
+FFMPEG_FIRST_FRAME_SECONDS = metrics.histogram(
+    "musicbot_ffmpeg_first_frame_seconds", "Tempo desde a criação do FFmpeg até ao primeiro frame de áudio"
+)
+ENQUEUE_TO_AUDIO_SECONDS = metrics.histogram(
+    "musicbot_enqueue_to_audio_seconds", "Tempo desde entrar na fila até ao primeiro frame de áudio",
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0),
+)
+STARTUP_SECONDS = metrics.histogram("musicbot_startup_seconds", "Tempo desde sair da fila até voice.play (por modo)")
+STREAM_CPU_RATIO = metrics.histogram(
+    "musicbot_stream_cpu_ratio", "CPU por stream em fração de um core (part=ffmpeg|python, mode=opus|pcm)",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+STREAM_CPU_SECONDS = metrics.counter("musicbot_stream_cpu_seconds_total", "CPU gasto a tocar (part=ffmpeg|python)")
+VOICE_CONNECT_SECONDS = metrics.histogram("musicbot_voice_connect_seconds", "Duração de cada tentativa de ligação de voz")
+VOICE_CONNECT_ATTEMPTS = metrics.counter("musicbot_voice_connect_attempts_total", "Tentativas de ligação de voz")
+VOICE_CONNECT_RETRIES = metrics.counter("musicbot_voice_connect_retries_total", "Tentativas de ligação de voz repetidas")
+LOOP_LAG_SECONDS = metrics.histogram(
+    "musicbot_event_loop_lag_seconds", "Atraso do event loop em cada amostra",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+SLOW_CALLBACKS = metrics.counter("musicbot_slow_callbacks_total", "Bloqueios do event loop acima de SLOW_CALLBACK_SECONDS")
+LOUDNESS_ANALYSIS_SECONDS = metrics.histogram(
+    "musicbot_loudness_analysis_seconds", "Duração da análise EBU R128 de uma faixa (em background)"
+)
+AUTOCOMPLETE_SECONDS = metrics.histogram(
+    "musicbot_autocomplete_seconds", "Pesquisa no índice de títulos para o autocomplete do /play",
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5),
+)
+REST_REQUESTS = metrics.counter("musicbot_rest_requests_total", "Pedidos à API REST do Discord (route=método e caminho)")
+STATUS_UPDATES = metrics.counter(
+    "musicbot_status_updates_total", "Mensagem de estado: pedidos de atualização e chamadas feitas (kind=requested|edit|send)"
+)
+
+
+def _count_rest_requests(http) -> None:
+    """Conta cada pedido REST do bot (inclui as respostas a comandos) envolvendo HTTPClient.request."""
+    original = http.request
+
+    async def request(route, **kwargs):
+        REST_REQUESTS.inc(route=f"{route.method} {route.path}")
+        return await original(route, **kwargs)
+
+    http.request = request
+
+
+_count_rest_requests(bot.http)
+_downloads_in_flight = 0  # Alterado só no event loop (fetch_audio)
+
 
 # ====== Estado por servidor (guild) ======
+class TrackQueue:
+    """
+    Fila de músicas de um servidor. Cada item recebe um ID estável (item["qid"]).
+    Lista duplamente ligada por qid (mapas prev/next): pop do início, put, remoção por ID e
+    mover para antes/depois de outro item (move_before/move_after) são O(1), sem cópias.
+    move(qid, index) e at(index) (posições do !queue) andam até à posição a partir da ponta
+    mais próxima, O(min(i, n - i)) sem alocar. get() espera por itens.
+    version muda a cada alteração (para caches de apresentação).
+    """
+
+    def __init__(self, journal=None):
+        self._items: dict[int, dict] = {}  # qid -> item
+        self._prev: dict[int, Optional[int]] = {}
+        self._next: dict[int, Optional[int]] = {}
+        self._head: Optional[int] = None
+        self._tail: Optional[int] = None
+        self._ids = itertools.count(1)
+        self._journal = journal  # journal(op, **dados) a cada alteração (ver QueueJournal)
+        self._not_empty = asyncio.Event()
+        self.version = 0
+        # Totais mantidos incrementalmente (sem percorrer a fila)
+        self.total_duration = 0  # segundos, só dos itens com duração conhecida
+        self.unknown_durations = 0
+        self._snapshot: list[dict] = []
+        self._snapshot_version = -1
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self):
+        qid = self._head
+        while qid is not None:
+            yield self._items[qid]
+            qid = self._next[qid]
+
+    def _link_after(self, qid: int, prev: Optional[int]) -> None:
+        """Liga qid a seguir a prev (None = no início). O(1)."""
+        nxt = self._head if prev is None else self._next[prev]
+        self._prev[qid] = prev
+        self._next[qid] = nxt
+        if prev is None:
+            self._head = qid
+        else:
+            self._next[prev] = qid
+        if nxt is None:
+            self._tail = qid
+        else:
+            self._prev[nxt] = qid
+
+    def _unlink(self, qid: int) -> None:
+        prev = self._prev.pop(qid)
+        nxt = self._next.pop(qid)
+        if prev is None:
+            self._head = nxt
+        else:
+            self._next[prev] = nxt
+        if nxt is None:
+            self._tail = prev
+        else:
+            self._prev[nxt] = prev
+
+    def _qid_at(self, index: int) -> Optional[int]:
+        """qid na posição index, a andar a partir da ponta mais próxima."""
+        if index < 0 or index >= len(self._items):
+            return None
+        if index < len(self._items) // 2:
+            qid = self._head
+            for _ in range(index):
+                qid = self._next[qid]
+        else:
+            qid = self._tail
+            for _ in range(len(self._items) - 1 - index):
+                qid = self._prev[qid]
+        return qid
+
+    def _changed(self) -> None:
+        self.version += 1
+        if self._items:
+            self._not_empty.set()
+        else:
+            self._not_empty.clear()
+
+    def _log(self, op: str, **data) -> None:
+        if self._journal is not None:
+            self._journal(op, **data)
+
+    def _account(self, item: dict, sign: int) -> None:
+        duration = item.get("duration")
+        if duration:
+            self.total_duration += sign * int(duration)
+        else:
+            self.unknown_durations += sign
+
+    def put(self, item: dict) -> int:
+        qid = next(self._ids)
+        item["qid"] = qid
+        item.setdefault("enqueued_at", time.monotonic())
+        self._items[qid] = item
+        self._link_after(qid, self._tail)
+        self._account(item, 1)
+        self._changed()
+        self._log("put", item=QueueJournal.slim(item))
+        return qid
+
+    def restore(self, items: list[dict]) -> None:
+        """Repõe itens de um journal no fim da fila, mantendo os qid (o journal refere-se a eles)."""
+        for item in items:
+            item.setdefault("enqueued_at", time.monotonic())
+            qid = item["qid"]
+            if qid in self._items:
+                continue
+            self._items[qid] = item
+            self._link_after(qid, self._tail)
+            self._account(item, 1)
+        if self._items:
+            self._ids = itertools.count(max(self._items) + 1)
+        self._changed()
+
+    async def get(self) -> dict:
+        """Espera até haver um item e retira o primeiro."""
+        while not self._items:
+            await self._not_empty.wait()
+        qid = self._head
+        self._unlink(qid)
+        item = self._items.pop(qid)
+        self._account(item, -1)
+        self._changed()
+        self._log("pop", qid=qid)
+        return item
+
+    def update(self, item: dict, changes: dict) -> None:
+        """Atualiza os dados de um item (ex: playlist resolvida) mantendo os totais certos."""
+        queued = item.get("qid") in self._items
+        if queued:
+            self._account(item, -1)
+        item.update(changes)
+        if queued:
+            self._account(item, 1)
+            self._changed()
+            self._log("update", qid=item["qid"], changes=QueueJournal.slim(changes))
+
+    def snapshot(self) -> list[dict]:
+        """Lista dos itens, reconstruída só quando a fila mudou (para páginas do !queue)."""
+        if self._snapshot_version != self.version:
+            self._snapshot = list(self)
+            self._snapshot_version = self.version
+        return self._snapshot
+
+    def peek(self, count: int) -> list[dict]:
+        """Primeiros count itens (sem retirar)."""
+        return list(itertools.islice(self, max(count, 0)))
+
+    def at(self, index: int) -> Optional[dict]:
+        """Item na posição index (0 = próximo a tocar) ou None."""
+        qid = self._qid_at(index)
+        return None if qid is None else self._items[qid]
+
+    def remove(self, qid: int) -> Optional[dict]:
+        item = self._items.pop(qid, None)
+        if item is not None:
+            self._unlink(qid)
+            self._account(item, -1)
+            self._changed()
+            self._log("remove", qid=qid)
+        return item
+
+    def move_after(self, qid: int, anchor: Optional[int]) -> bool:
+        """Move o item para logo a seguir a anchor (None = para o início). O(1)."""
+        if qid not in self._items or qid == anchor or (anchor is not None and anchor not in self._items):
+            return False
+        self._unlink(qid)
+        self._link_after(qid, anchor)
+        self._changed()
+        self._log("move", qid=qid, after=anchor)
+        return True
+
+    def move_before(self, qid: int, anchor: int) -> bool:
+        """Move o item para logo antes de anchor. O(1)."""
+        if anchor not in self._items or qid == anchor:
+            return False
+        prev = self._prev[anchor]
+        return True if prev == qid else self.move_after(qid, prev)
+
+    def move(self, qid: int, index: int) -> bool:
+        """Move o item para a posição index: anda até ao vizinho (ponta mais próxima) e liga em O(1)."""
+        if qid not in self._items:
+            return False
+        index = min(max(index, 0), len(self._items) - 1)
+        item = self._items.pop(qid)  # Fora da lista enquanto se procura o vizinho (_qid_at usa o tamanho)
+        self._unlink(qid)
+        prev = None if index == 0 else self._qid_at(index - 1)
+        self._link_after(qid, prev)
+        self._items[qid] = item
+        self._changed()
+        self._log("move", qid=qid, index=index)
+        return True
+
+    def shuffle(self) -> None:
+        order = list(self._items)
+        random.shuffle(order)
+        self._head = self._tail = None
+        self._prev.clear()
+        self._next.clear()
+        for qid in order:
+            self._link_after(qid, self._tail)
+        self._changed()
+        self._log("shuffle", order=order)
+
+    def clear(self) -> list[dict]:
+        """Esvazia a fila e devolve os itens removidos."""
+        items = list(self)
+        self._items.clear()
+        self._prev.clear()
+        self._next.clear()
+        self._head = self._tail = None
+        self.total_duration = 0
+        self.unknown_durations = 0
+        self._changed()
+        self._log("clear")
+        return items
+
+
+class QueueJournal:
+    """
+    Journal append-only das alterações às filas (put/pop/remove/move/shuffle/clear/update, canal de voz),
+    para retomar tudo depois de um crash ou redeploy.
+    - record() só acrescenta a uma lista em memória; uma tarefa grava os lotes numa thread
+      a cada QUEUE_JOURNAL_FLUSH_SECONDS (um write + fsync por lote), sem bloquear o event loop.
+    - A cada COMPACT_RECORDS registos grava um snapshot do estado de todas as filas e trunca o journal;
+      o restauro lê o snapshot e só repete os registos posteriores (número de sequência "s").
+    - Um lote que falhe a gravar volta para a frente dos pendentes e é repetido no flush seguinte
+      (o restauro ignora registos repetidos); close() grava o que falta ao desligar.
+    """
+
+    COMPACT_RECORDS = 5000
+    ITEM_KEYS = ("qid", "title", "webpage_url", "duration", "cache_key", "file_path", "lazy")
+
+    def __init__(self, path: str, flush_interval: float, base_path: str = ""):
+        self.path = path
+        self.base_path = base_path or path  # Journals dos outros processos: base_path e base_path.shardN
+        self.snapshot_path = path + ".snapshot" if path else ""
+        self.flush_interval = flush_interval
+        self._pending: list[dict] = []
+        self._seq = 0
+        self._since_snapshot = 0
+        self._voice: dict[int, int] = {}  # guild_id -> canal de voz onde o bot está
+        self._task: Optional[asyncio.Task] = None
+        self._writing: Optional[asyncio.Task] = None  # Escrita em curso (numa thread)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    @classmethod
+    def slim(cls, item: dict) -> dict:
+        """Só o que é preciso para voltar a pôr o item na fila (sem info do yt-dlp nem URLs diretos que expiram)."""
+        return {k: item[k] for k in cls.ITEM_KEYS if item.get(k) is not None}
+
+    def record(self, guild_id: int, op: str, **data) -> None:
+        if not self.enabled:
+            return
+        if op == "voice":
+            self._voice[guild_id] = data["channel"]
+        elif op == "leave":
+            self._voice.pop(guild_id, None)
+        self._seq += 1
+        self._since_snapshot += 1
+        self._pending.append({"s": self._seq, "g": guild_id, "op": op, **data})
+
+    def compact_soon(self) -> None:
+        """Próximo flush grava um snapshot completo (ex: depois de restaurar)."""
+        self._since_snapshot = self.COMPACT_RECORDS
+
+    def start(self) -> None:
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[JOURNAL] Erro ao gravar: {e}")
+
+    async def flush(self) -> None:
+        if self._writing is not None:
+            await asyncio.wait({self._writing})  # Uma escrita de cada vez (esperar não a cancela)
+        batch, self._pending = self._pending, []
+        compact = self._since_snapshot >= self.COMPACT_RECORDS
+        if compact:
+            snapshot = self._build_snapshot()  # no event loop: o estado não muda a meio
+            self._since_snapshot = 0
+            write = asyncio.ensure_future(asyncio.to_thread(self._write_snapshot, snapshot))
+        elif batch:
+            write = asyncio.ensure_future(asyncio.to_thread(self._append, batch))
+        else:
+            return
+        self._writing = write
+        write.add_done_callback(functools.partial(self._written, batch, compact))
+        await asyncio.wait({write})
+        if not write.cancelled() and write.exception() is not None:
+            raise write.exception()
+
+    def _written(self, batch: list[dict], compact: bool, write: asyncio.Task) -> None:
+        if self._writing is write:
+            self._writing = None
+        if write.cancelled() or write.exception() is not None:
+            self._pending[:0] = batch  # Repetir no próximo flush
+            if compact:
+                self._since_snapshot = max(self._since_snapshot, self.COMPACT_RECORDS)
+
+    async def close(self) -> None:
+        """Pára a gravação periódica e grava o que estiver pendente (ao desligar)."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.enabled:
+            await self.flush()
+
+    def _build_snapshot(self) -> dict:
+        guilds = {}
+        for guild_id, state in guild_states.items():
+            items = [self.slim(item) for item in state.queue]
+            playing = self.slim(state.currently_playing) if state.currently_playing else None
+            voice = self._voice.get(guild_id)
+            if voice is None and not items and playing is None:
+                continue
+            guilds[str(guild_id)] = {"voice": voice, "text": state.last_channel_id, "playing": playing, "items": items}
+        return {"s": self._seq, "guilds": guilds}
+
+    def _append(self, batch: list[dict]) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n" for record in batch))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_snapshot(self, snapshot: dict) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.snapshot_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError:
+            _remove_file(tmp_path)
+            raise
+        # Se falhar aqui o journal antigo fica, mas os registos com s <= snapshot são ignorados no restauro
+        open(self.path, "w").close()
+
+    def load(self) -> dict[int, dict]:
+        """
+        Estado das filas à data do último registo gravado: {guild_id: {voice, text, playing, items}}. Bloqueante.
+        Lê também os journals dos outros processos de shards: um servidor que mudou de processo
+        (SHARD_PROCESSES alterado) é retomado por quem agora o tem; o journal próprio tem prioridade.
+        """
+        guilds, self._seq = self._read(self.path)
+        others = [self.base_path] + glob.glob(glob.escape(self.base_path) + ".shard*")
+        for path in others:
+            if path == self.path or path.endswith((".snapshot", ".tmp")):
+                continue
+            for guild_id, g in self._read(path)[0].items():
+                guilds.setdefault(guild_id, g)
+        for guild_id, g in guilds.items():
+            if g.get("voice"):
+                self._voice[guild_id] = g["voice"]
+        return guilds
+
+    def _read(self, path: str) -> tuple[dict[int, dict], int]:
+        """Snapshot + registos posteriores de um journal. Devolve (servidores, último nº de sequência)."""
+        guilds: dict[int, dict] = {}
+        seq = 0
+        try:
+            with open(path + ".snapshot", "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            seq = snapshot.get("s", 0)
+            for key, g in snapshot.get("guilds", {}).items():
+                g["items"] = OrderedDict((item["qid"], item) for item in g.get("items") or [])
+                guilds[int(key)] = g
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[JOURNAL] Snapshot ilegível ({e}); a usar só o journal")
+        last = seq
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # linha cortada por um crash a meio da escrita
+                    if record.get("s", 0) <= last:
+                        continue  # Já no snapshot, ou repetido (lote regravado depois de uma falha)
+                    last = max(last, record["s"])
+                    g = guilds.setdefault(record["g"], {"voice": None, "text": None, "playing": None, "items": OrderedDict()})
+                    self._apply(g, record)
+        except FileNotFoundError:
+            pass
+        return guilds, last
+
+    @staticmethod
+    def _apply(g: dict, record: dict) -> None:
+        items: OrderedDict = g["items"]
+        op = record["op"]
+        if op == "put":
+            items[record["item"]["qid"]] = record["item"]
+        elif op == "pop":
+            g["playing"] = items.pop(record["qid"], None)
+        elif op == "done":
+            g["playing"] = None
+        elif op == "remove":
+            items.pop(record["qid"], None)
+        elif op == "update" and record["qid"] in items:
+            items[record["qid"]].update(record["changes"])
+        elif op == "move" and record["qid"] in items:
+            item = items.pop(record["qid"])
+            entries = list(items.items())
+            if "after" in record:  # move_after: logo a seguir a outro item (None = início)
+                anchor = record["after"]
+                position = next((i + 1 for i, (qid, _it) in enumerate(entries) if qid == anchor), 0)
+            else:
+                position = max(record["index"], 0)
+            entries.insert(position, (record["qid"], item))
+            g["items"] = OrderedDict(entries)
+        elif op == "shuffle":
+            g["items"] = OrderedDict((qid, items[qid]) for qid in record["order"] if qid in items)
+        elif op == "clear":
+            items.clear()
+            g["playing"] = None
+        elif op == "voice":
+            g["voice"] = record["channel"]
+            g["text"] = record.get("text") or g.get("text")
+        elif op == "leave":
+            g["voice"] = None
+
+
+queue_journal = QueueJournal(
+    # Um ficheiro por processo de shards; o restauro lê todos (os servidores podem ter mudado de processo)
+    f"{QUEUE_JOURNAL_FILE}.shard{SHARD_INDEX}" if QUEUE_JOURNAL_FILE and SHARD_INDEX >= 0 else QUEUE_JOURNAL_FILE,
+    QUEUE_JOURNAL_FLUSH_SECONDS,
+    QUEUE_JOURNAL_FILE,
+)
+
+
 class GuildMusicState:
-    def __init__(self):
-        self.queue: asyncio.Queue[dict] = asyncio.Queue()
-        self.queue_list: list[dict] = []  # Lista para exibir a fila
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.queue = TrackQueue(functools.partial(queue_journal.record, guild_id))
         self.currently_playing: Optional[dict] = None  # Item atualmente a tocar
         self.play_next = asyncio.Event()
         self.audio_task: Optional[asyncio.Task] = None
@@ -89,77 +993,242 @@ class GuildMusicState:
         self.last_activity_at: float = 0.0  # For inactivity auto-leave
         self.last_channel_id: Optional[int] = None  # To send auto-leave message
         self.voice_connect_lock = asyncio.Lock()  # Avoid concurrent connect/move races
-    
-    def get_queue_display(self) -> list[dict]:
-        """Retorna a lista completa da fila (incluindo o que está a tocar)."""
-        queue = []
-        if self.currently_playing:
-            queue.append(self.currently_playing)
-        queue.extend(self.queue_list)
-        return queue
+        self.prefetches: dict[int, "_Prefetch"] = {}  # qid -> download em background
+        self.current_download: Optional["_Prefetch"] = None  # Download do item que vai tocar a seguir
+        self.resolving: dict[int, asyncio.Task] = {}  # qid -> resolução de uma entrada de playlist
+        self.primed: Optional["_PrimedSource"] = None  # Source da próxima faixa já aberta (gapless)
+        self.preopen_task: Optional[asyncio.Task] = None
+        self.preopen_qid: Optional[int] = None
+        self.status_message: Optional[discord.Message] = None  # Mensagem "a tocar / fila" editada no lugar
+        self.status_posted_at = 0.0
+        self.status_notes: deque[str] = deque(maxlen=STATUS_NOTES)
+        self.status_pending_since: Optional[float] = None  # Primeiro pedido ainda não publicado
+        self.status_lock = asyncio.Lock()
 
 guild_states: dict[int, GuildMusicState] = {}
 
+# Referências a tarefas "fire-and-forget" (o asyncio só guarda referências fracas)
+_background_tasks: set[asyncio.Task] = set()
+
+
+def spawn_background(coro) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 
 def get_state(guild_id: int) -> GuildMusicState:
     if guild_id not in guild_states:
-        st = GuildMusicState()
+        st = GuildMusicState(guild_id)
         st.last_activity_at = time.monotonic()
         guild_states[guild_id] = st
     return guild_states[guild_id]
 
 
+class DeadlineScheduler:
+    """
+    Timers por chave (ex: ("inactivity", guild_id)) guardados num heap de deadlines.
+    Uma única tarefa dorme até ao próximo deadline; reagendar é O(log n) e as entradas
+    antigas do heap são ignoradas quando saem. Só as chaves expiradas são processadas.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, int, object]] = []
+        self._timers: dict[object, tuple[float, int, object]] = {}  # chave -> (deadline, seq, callback)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def schedule(self, key, delay: float, callback) -> None:
+        """(Re)agenda callback() para daqui a delay segundos; substitui o timer anterior da chave."""
+        deadline = time.monotonic() + delay
+        seq = next(self._seq)
+        self._timers[key] = (deadline, seq, callback)
+        heapq.heappush(self._heap, (deadline, seq, key))
+        if len(self._heap) > 2 * len(self._timers) + 64:
+            # Muitas entradas obsoletas (reagendamentos): reconstruir
+            self._heap = [(d, sq, k) for k, (d, sq, _cb) in self._timers.items()]
+            heapq.heapify(self._heap)
+        if self._heap[0][1] == seq:
+            self._wakeup.set()  # passou a ser o próximo a expirar
+
+    def cancel(self, key) -> None:
+        self._timers.pop(key, None)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                _deadline, seq, key = heapq.heappop(self._heap)
+                timer = self._timers.get(key)
+                if timer is None or timer[1] != seq:
+                    continue  # cancelado ou reagendado
+                del self._timers[key]
+                try:
+                    result = timer[2]()
+                    if inspect.isawaitable(result):
+                        spawn_background(result)
+                except Exception as e:
+                    print(f"[TIMERS] Erro no timer {key}: {e}")
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+timers = DeadlineScheduler()
+
+
+class _SlowCallback:
+    __slots__ = ("at", "duration", "stack")
+
+    def __init__(self, at: float, duration: float, stack: list[str]):
+        self.at = at  # time.time() em que foi detetado
+        self.duration = duration  # Atualizado quando o loop volta a responder
+        self.stack = stack
+
+
+class LoopMonitor:
+    """
+    Lag do event loop e deteção de callbacks lentos, para apanhar código que bloqueia o loop
+    (e faz engasgar o áudio de todos os servidores).
+    - Uma tarefa dorme LOOP_LAG_SAMPLE_SECONDS e mede quanto acordou atrasada (histograma + janela recente).
+    - Uma thread vigia o "batimento" dessa tarefa; se o loop não responde há mais de SLOW_CALLBACK_SECONDS,
+      captura a stack da thread do loop (sys._current_frames) enquanto ainda está bloqueado.
+    """
+
+    RECENT_SAMPLES = 2400  # ~10 min com amostras de 0,25 s
+    MAX_EVENTS = 20
+
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.recent: deque[float] = deque(maxlen=self.RECENT_SAMPLES)
+        self.events: deque[_SlowCallback] = deque(maxlen=self.MAX_EVENTS)
+        self._beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._current: Optional[_SlowCallback] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        if self.interval <= 0:
+            return
+        if self._task is None or self._task.done():
+            self._loop_thread_id = threading.get_ident()
+            self._beat = time.monotonic()
+            self._task = asyncio.ensure_future(self._sample())
+        if self.threshold > 0 and self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def _sample(self) -> None:
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - before - self.interval, 0.0)
+            with self._lock:
+                self._beat = now
+                current, self._current = self._current, None
+            if current is not None:
+                current.duration = lag
+            self.recent.append(lag)
+            LOOP_LAG_SECONDS.observe(lag)
+
+    def _watch(self) -> None:
+        while True:
+            time.sleep(max(self.threshold / 2, 0.01))
+            with self._lock:
+                stalled = time.monotonic() - self._beat - self.interval
+                if stalled < self.threshold or self._current is not None:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread_id)
+                event = self._current = _SlowCallback(time.time(), stalled, [])
+                self.events.append(event)
+            # Formatar a stack fora do lock: o sampler (no event loop) usa o mesmo lock
+            stack = traceback.format_stack(frame) if frame is not None else []
+            del frame
+            event.stack = stack
+            SLOW_CALLBACKS.inc()
+            where = stack[-1].strip().splitlines()[0] if stack else "?"
+            print(f"[PERF] Event loop bloqueado há {stalled * 1000:.0f} ms em {where}")
+
+    def summary(self) -> Optional[tuple[float, float, float]]:
+        """(p50, p99, máximo) do lag nas amostras recentes, ou None sem amostras."""
+        samples = sorted(self.recent)
+        if not samples:
+            return None
+        p50 = samples[min(int(len(samples) * 0.5), len(samples) - 1)]
+        p99 = samples[min(int(len(samples) * 0.99), len(samples) - 1)]
+        return p50, p99, samples[-1]
+
+
+loop_monitor = LoopMonitor(LOOP_LAG_SAMPLE_SECONDS, SLOW_CALLBACK_SECONDS)
+
+
 def touch_activity(guild_id: int, channel_id: Optional[int] = None) -> None:
     """Update last activity time (and optionally last channel) for inactivity auto-leave."""
     state = get_state(guild_id)
     state.last_activity_at = time.monotonic()
     if channel_id is not None:
         state.last_channel_id = channel_id
+    timers.schedule(("inactivity", guild_id), INACTIVITY_LEAVE_SECONDS, functools.partial(inactivity_expired, guild_id))
 
 
-async def inactivity_check_loop() -> None:
-    """Background task: if in voice and inactive for INACTIVITY_LEAVE_SECONDS, run !leave."""
-    await bot.wait_until_ready()
-    while not bot.is_closed():
-        try:
-            await asyncio.sleep(60)  # Check every minute
-            now = time.monotonic()
-            for guild in bot.guilds:
-                voice = guild.voice_client
-                if not voice or not voice.is_connected():
-                    continue
-                state = get_state(guild.id)
-                if voice.is_playing() or voice.is_paused():
-                    continue
-                if state.queue_list or not state.queue.empty():
-                    continue
-                if (now - state.last_activity_at) < INACTIVITY_LEAVE_SECONDS:
-                    continue
-                # Auto leave (same as !leave)
-                try:
-                    await voice.disconnect()
-                    if state.last_channel_id:
-                        ch = guild.get_channel(state.last_channel_id)
-                        if ch and isinstance(ch, discord.TextChannel):
-                            await ch.send("Saí do canal de voz por inatividade (10 min). 👋")
-                except Exception as e:
-                    print(f"[INACTIVITY] Erro ao sair em {guild.name}: {e}")
-        except asyncio.CancelledError:
-            break
-        except Exception as e:
-            print(f"[INACTIVITY] {e}")
+async def inactivity_expired(guild_id: int) -> None:
+    """Timer de inatividade expirou: se estiver em voz parado e sem fila, faz !leave."""
+    guild = bot.get_guild(guild_id)
+    state = guild_states.get(guild_id)
+    if guild is None or state is None:
+        return
+    voice = guild.voice_client
+    if not voice or not voice.is_connected():
+        return  # o próximo comando volta a agendar
+    remaining = INACTIVITY_LEAVE_SECONDS - (time.monotonic() - state.last_activity_at)
+    if voice.is_playing() or voice.is_paused() or state.queue:
+        # Ocupado: o player_loop marca atividade quando a fila acaba, e a contagem começa aí
+        remaining = max(remaining, INACTIVITY_BUSY_RETRY_SECONDS)
+    if remaining > 0:
+        timers.schedule(("inactivity", guild_id), remaining, functools.partial(inactivity_expired, guild_id))
+        return
+    # Auto leave (same as !leave)
+    try:
+        queue_journal.record(guild_id, "leave")
+        clear_queue(state)
+        await voice.disconnect()
+        if state.last_channel_id:
+            ch = guild.get_channel(state.last_channel_id)
+            if ch and isinstance(ch, discord.TextChannel):
+                await ch.send("Saí do canal de voz por inatividade (10 min). 👋")
+    except Exception as e:
+        print(f"[INACTIVITY] Erro ao sair em {guild.name}: {e}")
 
 
 async def ensure_voice(ctx: commands.Context) -> discord.VoiceClient:
     """Garante que o bot está no canal de voz do utilizador."""
     if not ctx.author.voice or not ctx.author.voice.channel:
         raise commands.CommandError("Tens de estar num canal de voz para eu entrar.")
+    return await connect_voice(ctx.guild, ctx.author.voice.channel)
 
-    state = get_state(ctx.guild.id)
-    target_channel = ctx.author.voice.channel
+
+async def connect_voice(guild: discord.Guild, target_channel) -> discord.VoiceClient:
+    """Liga (ou move) o bot ao canal de voz, com tentativas. Lança CommandError com a causa provável."""
+    state = get_state(guild.id)
 
     async with state.voice_connect_lock:
-        voice = ctx.guild.voice_client
+        voice = guild.voice_client
         if voice and voice.is_connected():
             # Se já está ligado mas noutro canal, move
             if voice.channel != target_channel:
@@ -179,6 +1248,9 @@ async def ensure_voice(ctx: commands.Context) -> discord.VoiceClient:
 
         last_error: Optional[Exception] = None
         for attempt in range(1, 4):
+            attempt_started = time.monotonic()
+            if attempt > 1:
+                VOICE_CONNECT_RETRIES.inc()
             try:
                 # Keep retries under our control; discord.py internal reconnect can loop on stale sessions.
                 voice_client = await target_channel.connect(
@@ -187,6 +1259,8 @@ async def ensure_voice(ctx: commands.Context) -> discord.VoiceClient:
                     self_deaf=True,
                 )
                 if voice_client and voice_client.is_connected():
+                    VOICE_CONNECT_SECONDS.observe(time.monotonic() - attempt_started, result="ok")
+                    VOICE_CONNECT_ATTEMPTS.inc(result="ok")
                     return voice_client
                 try:
                     if voice_client:
@@ -198,8 +1272,8 @@ async def ensure_voice(ctx: commands.Context) -> discord.VoiceClient:
                 last_error = e
             except discord.ClientException as e:
                 error_msg = str(e)
-                if "Already connected" in error_msg and ctx.guild.voice_client:
-                    vc = ctx.guild.voice_client
+                if "Already connected" in error_msg and guild.voice_client:
+                    vc = guild.voice_client
                     if vc.is_connected():
                         return vc
                     try:
@@ -212,8 +1286,11 @@ async def ensure_voice(ctx: commands.Context) -> discord.VoiceClient:
             except Exception as e:
                 last_error = e
 
+            VOICE_CONNECT_SECONDS.observe(time.monotonic() - attempt_started, result="error")
+            VOICE_CONNECT_ATTEMPTS.inc(result=type(last_error).__name__ if last_error else "error")
+
             # Reset entre tentativas para evitar estado de handshake antigo (ex: 4017)
-            vc = ctx.guild.voice_client
+            vc = guild.voice_client
             if vc:
                 try:
                     await vc.disconnect(force=True)
@@ -251,62 +1328,1500 @@ async def ensure_voice(ctx: commands.Context) -> discord.VoiceClient:
         )
 
 
-def download_audio_to_file(url: str) -> Optional[str]:
+class PoolBusyError(commands.CommandError):
+    """Demasiados pedidos pendentes no pool de extração (back-pressure)."""
+
+
+class _PoolJob:
+    __slots__ = ("fn", "args", "kwargs", "future", "cancel_event", "on_abandon", "local", "slot", "abandoned")
+
+    def __init__(self, fn, args, kwargs, future, cancel_event, on_abandon, local):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.cancel_event = cancel_event
+        self.on_abandon = on_abandon
+        self.local = local
+        self.slot: Optional[int] = None  # modo process: índice do processo que corre o trabalho
+        self.abandoned = False  # processo terminado à força (timeout/cancelamento)
+
+
+def _process_context():
     """
-    Descarrega áudio com yt-dlp (API Python) para um ficheiro temporário.
-    Devolve o caminho do ficheiro ou None em caso de erro.
+    Contexto multiprocessing para o pool: nunca "fork" (o processo do bot já tem threads a correr,
+    e um fork copia locks apanhados a meio). forkserver (Unix) ou spawn (Windows/macOS).
     """
-    base = os.path.join(tempfile.gettempdir(), "discord_bot_" + uuid.uuid4().hex)
-    out_template = base + ".%(ext)s"
-    # Preferir m4a (AAC): o FFmpeg do Stremio pode não suportar Opus/webm → return code 1
-    opts = {
-        **YTDL_OPTS,
-        "format": "bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best",
-        "outtmpl": out_template,
-        "noplaylist": True,
-        "no_warnings": True,
-        "quiet": False,
-        "no_check_certificates": True,
-    }
-    try:
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-        if not info:
-            print("[PLAYER] yt-dlp: sem informação do vídeo")
-            return None
-        # Caminho do ficheiro descarregado (yt-dlp preenche requested_downloads)
-        req = info.get("requested_downloads") or []
-        if req:
-            path = req[0].get("filepath") or req[0].get("filename")
-            if path and os.path.isfile(path):
-                return path
-        # Fallback: construir path a partir de ext
-        ext = info.get("ext") or "m4a"
-        path = base + "." + ext
-        return path if os.path.isfile(path) else None
-    except yt_dlp.utils.DownloadError as e:
-        print(f"[PLAYER] yt-dlp: {e}")
-        return None
-    except Exception as e:
-        print(f"[PLAYER] yt-dlp: {e}")
-        return None
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        # O servidor importa o módulo principal uma vez; cada worker nasce dele já com yt-dlp carregado.
+        # O import não tem efeitos no disco (caches e estado só em load_persistent_state, no arranque do bot)
+        ctx.set_forkserver_preload(["__main__"])
+        return ctx
+    return multiprocessing.get_context("spawn")
 
 
-def _get_audio_url(info: dict) -> Optional[str]:
-    """Extrai URL de áudio do resultado do yt-dlp (suporta DASH e formatos simples)."""
-    if info.get("url"):
-        return info["url"]
-    requested = info.get("requested_formats")
-    if requested:
-        for f in requested:
-            if f.get("url") and (f.get("vcodec") == "none" or f.get("acodec")):
-                return f["url"]
-        if requested[0].get("url"):
-            return requested[0]["url"]
-    for f in reversed(info.get("formats", [])):
-        if f.get("url") and (f.get("vcodec") == "none" or not f.get("vcodec")):
-            return f["url"]
-    return None
+class ExtractionPool:
+    """
+    Executor dedicado ao yt-dlp (não usa o executor por defeito do asyncio).
+    - Tamanho fixo (threads ou processos), cada worker com a sua instância de YoutubeDL.
+    - Fairness: os trabalhos pendentes são despachados round-robin por servidor.
+    - Limite de pesquisas pendentes por servidor (PoolBusyError) e timeout por trabalho.
+    - Modo process: um executor de 1 processo por worker; no timeout/cancelamento o processo que
+      corre o trabalho é terminado (o cancel_event não chega ao filho) e recriado no próximo trabalho.
+      Ficheiros parciais que o filho deixe são apagados como órfãos pelo TempJanitor.
+    - local=True: fn corre numa thread deste processo (ex: download lido enquanto cresce), mas
+      ocupa um worker e passa pela mesma fila/fairness.
+    Os métodos assíncronos correm no event loop; só fn corre nos workers.
+    """
+
+    CANCEL_POLL_SECONDS = 0.5  # modo process: intervalo de verificação do cancel_event
+
+    def __init__(self, workers: int, mode: str = "thread", max_pending_per_guild: int = 10):
+        self.workers = max(workers, 1)
+        self.mode = mode if mode in ("thread", "process") else "thread"
+        self.max_pending_per_guild = max_pending_per_guild
+        self.running = 0
+        self._executor: Optional[concurrent.futures.Executor] = None  # threads (modo thread e trabalhos local)
+        self._slots: list[Optional[concurrent.futures.ProcessPoolExecutor]] = [None] * self.workers
+        self._busy_slots: set[int] = set()
+        self._mp_context = None
+        self._pending: OrderedDict[int, deque[_PoolJob]] = OrderedDict()  # guild_id -> trabalhos (ordem = vez)
+
+    @property
+    def pending(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="ytdl"
+            )
+        return self._executor
+
+    def _get_slot(self, slot: int) -> concurrent.futures.ProcessPoolExecutor:
+        executor = self._slots[slot]
+        if executor is None:
+            if self._mp_context is None:
+                self._mp_context = _process_context()
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=self._mp_context)
+            self._slots[slot] = executor
+        return executor
+
+    def _terminate(self, job: _PoolJob) -> None:
+        """Modo process: termina o processo que corre job (o futuro dele falha com BrokenProcessPool)."""
+        if job.slot is None or job.abandoned:
+            return
+        job.abandoned = True
+        executor = self._slots[job.slot]
+        self._slots[job.slot] = None  # o próximo trabalho neste worker cria um processo novo
+        if executor is None:
+            return
+        # ProcessPoolExecutor não expõe os processos antes do Python 3.14 (terminate_workers)
+        terminate = getattr(executor, "terminate_workers", None)
+        if terminate is not None:
+            terminate()
+        else:
+            for process in list((getattr(executor, "_processes", None) or {}).values()):
+                process.terminate()
+            executor.shutdown(wait=False, cancel_futures=True)
+        print(f"[POOL] Processo do worker {job.slot} terminado (trabalho abandonado)")
+
+    def _watch_cancel(self, job: _PoolJob) -> None:
+        if job.slot is None or job.abandoned:
+            return  # já terminou
+        if job.cancel_event.is_set():
+            self._terminate(job)
+            return
+        asyncio.get_running_loop().call_later(self.CANCEL_POLL_SECONDS, self._watch_cancel, job)
+
+    async def run(
+        self,
+        guild_id: int,
+        fn,
+        *args,
+        timeout: Optional[float] = None,
+        cancel_event: Optional[threading.Event] = None,
+        on_abandon=None,
+        bounded: bool = True,
+        local: bool = False,
+    ):
+        """
+        Corre fn(*args) num worker e devolve o resultado.
+        - cancel_event: passado a fn como keyword (só em modo thread/local) e ativado no timeout;
+          em modo process, ativá-lo (ou o timeout) termina o processo que corre fn.
+        - on_abandon(resultado): chamado se fn terminar depois de quem esperava desistir (ex: apagar ficheiro).
+        - bounded: conta para o limite de pendentes por servidor (pedidos de utilizadores).
+        - local: corre numa thread deste processo mesmo em modo process (ocupa um worker na mesma).
+        """
+        queued = self._pending.get(guild_id)
+        if bounded and queued is not None and len(queued) >= self.max_pending_per_guild:
+            raise PoolBusyError("⏳ Tenho demasiados pedidos pendentes neste servidor. Tenta daqui a pouco.")
+        local = local or self.mode == "thread"
+        kwargs = {}
+        if cancel_event is not None and local:
+            kwargs["cancel_event"] = cancel_event  # threading.Event não passa para outro processo
+        future = asyncio.get_running_loop().create_future()
+        job = _PoolJob(fn, args, kwargs, future, cancel_event, on_abandon, local)
+        self._pending.setdefault(guild_id, deque()).append(job)
+        self._dispatch()
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if cancel_event is not None:
+                cancel_event.set()
+            if not future.done():
+                future.cancel()  # ainda pendente: _dispatch ignora; a correr: _finished chama on_abandon
+            self._terminate(job)
+            raise
+
+    def _dispatch(self) -> None:
+        while self.running < self.workers and self._pending:
+            guild_id, jobs = next(iter(self._pending.items()))
+            job = jobs.popleft()
+            if jobs:
+                self._pending.move_to_end(guild_id)  # próximo servidor na vez
+            else:
+                del self._pending[guild_id]
+            if job.future.done():
+                continue  # desistiram enquanto esperava
+            if job.cancel_event is not None and job.cancel_event.is_set():
+                job.future.set_result(None)
+                continue
+            self.running += 1
+            loop = asyncio.get_running_loop()
+            call = functools.partial(job.fn, *job.args, **job.kwargs)
+            if job.local:
+                executor = self._get_executor()
+            else:
+                # running < workers garante um processo livre (os trabalhos local também contam)
+                job.slot = next(i for i in range(self.workers) if i not in self._busy_slots)
+                self._busy_slots.add(job.slot)
+                executor = self._get_slot(job.slot)
+            cf = loop.run_in_executor(executor, call)
+            cf.add_done_callback(functools.partial(self._finished, job))
+            if job.slot is not None and job.cancel_event is not None:
+                loop.call_later(self.CANCEL_POLL_SECONDS, self._watch_cancel, job)
+
+    def _finished(self, job: _PoolJob, cf: "asyncio.Future") -> None:
+        self.running -= 1
+        if job.slot is not None:
+            self._busy_slots.discard(job.slot)
+            job.slot = None
+        if job.abandoned:
+            if not cf.cancelled():
+                cf.exception()  # BrokenProcessPool esperado: marcar como lido
+            if not job.future.done():
+                job.future.set_result(None)  # cancelado via cancel_event enquanto corria
+        elif job.future.done():
+            if job.on_abandon is not None and not cf.cancelled() and cf.exception() is None:
+                job.on_abandon(cf.result())
+        elif cf.cancelled():
+            job.future.cancel()
+        elif cf.exception() is not None:
+            job.future.set_exception(cf.exception())
+        else:
+            job.future.set_result(cf.result())
+        self._dispatch()
+
+
+extraction_pool = ExtractionPool(EXTRACT_WORKERS, EXTRACT_POOL_MODE, EXTRACT_MAX_PENDING_PER_GUILD)
+
+
+def _remove_file(path: Optional[str]) -> None:
+    """Apaga um ficheiro ignorando erros (já apagado, em uso, etc.)."""
+    try:
+        if path and os.path.isfile(path):
+            os.remove(path)
+    except OSError:
+        pass
+    temp_janitor.forget(path)
+
+
+class TempJanitor:
+    """
+    Dono dos ficheiros temporários do processo (pasta TEMP_DIR, nomes "discord_bot_*").
+    - Ficheiros em uso (itens na fila, streams, anexos) são registados com track() e saem com forget().
+    - No arranque apaga o que ficou de um crash, exceto o que a fila restaurada ainda usa.
+    - Órfãos (não registados e sem escritas há ORPHAN_GRACE_SECONDS: downloads de FFmpeg que falhou,
+      cancelamentos a meio) são apagados periodicamente e sempre que o orçamento de disco é excedido.
+    A pasta é por processo de shards; na pasta temporária do sistema (versões antigas) e em pastas de
+    outro processo vivo só se apagam ficheiros sem alterações há mais de stale_seconds.
+    """
+
+    PREFIX = "discord_bot_"
+    OWNER_FILE = "owner.pid"
+    ORPHAN_GRACE_SECONDS = 300  # Um download parado há tanto tempo já foi abandonado
+
+    def __init__(self, directory: str, max_bytes: int, stale_seconds: float):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.stale_seconds = stale_seconds
+        self.usage = 0  # Bytes na pasta na última medição
+        self.removed_files = 0
+        self.removed_bytes = 0
+        self.refused = 0
+        self._lock = threading.Lock()  # track/forget vêm de threads de download e de áudio
+        self._owned: set[str] = set()
+        self._exclusive = True  # Falso se outro processo vivo usa a mesma pasta
+        self._ready = False
+        self._started_at = time.time()
+
+    def path(self, name: str) -> str:
+        """Caminho para um ficheiro temporário novo (cria a pasta se preciso)."""
+        if not self._ready:
+            os.makedirs(self.directory, exist_ok=True)
+            self._ready = True
+        return os.path.join(self.directory, name)
+
+    def new_base(self) -> str:
+        return self.path(self.PREFIX + uuid.uuid4().hex)
+
+    def track(self, path: Optional[str]) -> None:
+        if path and os.path.dirname(os.path.abspath(path)) == self.directory:
+            with self._lock:
+                self._owned.add(os.path.abspath(path))
+
+    def forget(self, path: Optional[str]) -> None:
+        if path:
+            with self._lock:
+                self._owned.discard(os.path.abspath(path))
+
+    def over_budget(self, extra: int = 0) -> bool:
+        return self.max_bytes > 0 and self.usage + extra > self.max_bytes
+
+    def _files(self, directory: str):
+        """(caminho, tamanho, mtime) dos ficheiros com o prefixo do bot."""
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if not entry.name.startswith(self.PREFIX) or not entry.is_file(follow_symlinks=False):
+                        continue
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    yield entry.path, st.st_size, st.st_mtime
+        except FileNotFoundError:
+            return
+
+    def _delete(self, path: str, size: int) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        self.removed_files += 1
+        self.removed_bytes += size
+
+    def measure(self) -> int:
+        """Bloqueante: mede os bytes na pasta (também o que ainda está a descarregar)."""
+        self.usage = sum(size for _path, size, _mtime in self._files(self.directory))
+        return self.usage
+
+    def _claim(self) -> None:
+        """Marca a pasta como deste processo; se outro processo vivo a usa, passa a só apagar ficheiros antigos."""
+        owner_path = self.path(self.OWNER_FILE)
+        try:
+            with open(owner_path, encoding="utf-8") as f:
+                pid = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            pid = 0
+        if pid and pid != os.getpid():
+            try:
+                os.kill(pid, 0)
+                self._exclusive = False
+                print(f"[TEMP] {self.directory} também é usada pelo processo {pid}: só limpo ficheiros antigos")
+                return
+            except ProcessLookupError:
+                pass
+            except OSError:  # PermissionError: o processo existe (outro utilizador)
+                self._exclusive = False
+                return
+        with open(owner_path, "w", encoding="utf-8") as f:
+            f.write(str(os.getpid()))
+
+    def sweep(self) -> tuple[int, int]:
+        """
+        Bloqueante. Arranque: apaga o que ficou de execuções anteriores (exceto ficheiros registados,
+        ex.: anexos da fila restaurada). Devolve (ficheiros, bytes) apagados.
+        """
+        before = (self.removed_files, self.removed_bytes)
+        self._claim()
+        stale = time.time() - self.stale_seconds
+        with self._lock:
+            owned = set(self._owned)
+        # Na pasta própria: tudo o que é anterior a este processo (o que já foi criado desde o arranque está em uso)
+        passes = [(self.directory, self._started_at if self._exclusive else stale)]
+        legacy = os.path.abspath(tempfile.gettempdir())
+        if legacy != self.directory:
+            passes.append((legacy, stale))  # Versões antigas escreviam diretamente aqui
+        for directory, cutoff in passes:
+            for path, size, mtime in list(self._files(directory)):
+                if path not in owned and mtime < cutoff:
+                    self._delete(path, size)
+        self.measure()
+        return self.removed_files - before[0], self.removed_bytes - before[1]
+
+    def evict_orphans(self) -> int:
+        """Bloqueante: apaga ficheiros não registados e parados há ORPHAN_GRACE_SECONDS. Devolve bytes libertados."""
+        before = self.removed_bytes
+        now = time.time()
+        with self._lock:
+            owned = set(self._owned)
+        for path, size, mtime in list(self._files(self.directory)):
+            if path not in owned and now - mtime >= self.ORPHAN_GRACE_SECONDS:
+                self._delete(path, size)
+        self.measure()
+        return self.removed_bytes - before
+
+    async def reserve(self, size: int) -> bool:
+        """Há espaço para mais size bytes? Se não, apaga órfãos e volta a medir; False = recusar."""
+        if self.max_bytes <= 0:
+            return True
+        await asyncio.to_thread(self.measure)
+        if self.over_budget(size):
+            await asyncio.to_thread(self.evict_orphans)
+        if self.over_budget(size):
+            self.refused += 1
+            return False
+        return True
+
+    async def run_periodic(self) -> None:
+        """Timer: apaga órfãos e atualiza a medição (usada pelo prefetch para respeitar o orçamento)."""
+        try:
+            freed = await asyncio.to_thread(self.evict_orphans)
+            if freed:
+                print(f"[TEMP] {freed / 1024 / 1024:.1f} MB de ficheiros órfãos apagados")
+            if self.over_budget():
+                print(
+                    f"[TEMP] Orçamento excedido: {self.usage / 1024 / 1024:.0f} MB em uso "
+                    f"(máximo {self.max_bytes // 1024 // 1024} MB); prefetch limitado à próxima faixa"
+                )
+        finally:
+            if TEMP_JANITOR_INTERVAL_SECONDS > 0:
+                timers.schedule("temp-janitor", TEMP_JANITOR_INTERVAL_SECONDS, self.run_periodic)
+
+    def stats(self) -> dict:
+        with self._lock:
+            owned = len(self._owned)
+        return {
+            "directory": self.directory,
+            "bytes": self.usage,
+            "max_bytes": self.max_bytes,
+            "owned": owned,
+            "removed_files": self.removed_files,
+            "removed_bytes": self.removed_bytes,
+            "refused": self.refused,
+        }
+
+
+temp_janitor = TempJanitor(TEMP_DIR, TEMP_MAX_BYTES, TEMP_STALE_SECONDS)
+
+
+class _CacheEntry:
+    __slots__ = ("path", "size", "last_used", "hits")
+
+    def __init__(self, path: str, size: int, last_used: float, hits: int = 0):
+        self.path = path
+        self.size = size
+        self.last_used = last_used
+        self.hits = hits
+
+
+class AudioCache:
+    """
+    Cache de ficheiros de áudio em disco com orçamento de bytes e eviction LRU/LFU.
+    - Escritas atómicas: o ficheiro entra com nome temporário e é renomeado (os.replace).
+    - Leitores seguros: ficheiros em uso (pin) nunca são removidos pela eviction.
+    - O último uso fica no mtime do ficheiro, por isso o LRU sobrevive a reinícios.
+    Thread-safe (usado a partir das threads de download).
+    """
+
+    def __init__(self, directory: str, max_bytes: int, policy: str = "lru"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.policy = policy if policy in ("lru", "lfu") else "lru"
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: dict[str, _CacheEntry] = {}
+        self._pins: dict[str, int] = {}  # path -> nº de leitores
+        self._total = 0
+
+    def load(self) -> None:
+        """Cria a pasta e indexa os ficheiros existentes. Só no arranque do bot (ver load_persistent_state)."""
+        if not self.enabled:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._scan()
+        except OSError as e:
+            print(f"[CACHE] Cache de áudio desativada ({self.directory}): {e}")
+            self.max_bytes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def _file_stem(key: str) -> str:
+        return re.sub(r"[^\w.-]", "_", key)
+
+    def _scan(self) -> None:
+        """Reconstrói o índice a partir dos ficheiros existentes (limpa temporários órfãos)."""
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".tmp-"):
+                _remove_file(path)  # Órfão de um crash (a pasta é só deste processo; os workers não a indexam)
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue  # Ex.: pastas shard<N> dentro de AUDIO_CACHE_DIR
+            key = os.path.splitext(name)[0]
+            self._entries[key] = _CacheEntry(path, st.st_size, st.st_mtime)
+            self._total += st.st_size
+
+    def _pin(self, path: str) -> None:
+        self._pins[path] = self._pins.get(path, 0) + 1
+
+    def lookup(self, key: str) -> Optional[str]:
+        """Devolve o caminho em cache (já reservado para leitura) ou None. Libertar com release()."""
+        if not self.enabled:
+            return None
+        stem = self._file_stem(key)
+        with self._lock:
+            entry = self._entries.get(stem)
+            if entry is not None and not os.path.isfile(entry.path):
+                # Removido por fora (limpeza manual da pasta)
+                self._total -= entry.size
+                del self._entries[stem]
+                entry = None
+            if entry is None:
+                # A pasta é só deste processo, mas um ficheiro pode ter sido copiado para lá à mão
+                for path in glob.glob(os.path.join(glob.escape(self.directory), glob.escape(stem) + ".*")):
+                    try:
+                        size = os.path.getsize(path)
+                    except OSError:
+                        continue
+                    entry = _CacheEntry(path, size, time.time())
+                    self._entries[stem] = entry
+                    self._total += size
+                    break
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry.hits += 1
+            entry.last_used = time.time()
+            self._pin(entry.path)
+        try:
+            os.utime(entry.path)
+        except OSError:
+            pass
+        return entry.path
+
+    def store(self, key: str, src_path: str) -> Optional[str]:
+        """
+        Move um ficheiro descarregado para a cache (atomicamente) e devolve o novo caminho,
+        já reservado para leitura. Devolve None se não couber/falhar (src_path fica intacto).
+        """
+        if not self.enabled:
+            return None
+        try:
+            size = os.path.getsize(src_path)
+        except OSError:
+            return None
+        if size > self.max_bytes:
+            return None
+        stem = self._file_stem(key)
+        ext = os.path.splitext(src_path)[1]
+        final_path = os.path.join(self.directory, stem + ext)
+        tmp_path = os.path.join(self.directory, f".tmp-{uuid.uuid4().hex}{ext}")
+        try:
+            shutil.move(src_path, tmp_path)
+        except OSError as e:
+            print(f"[CACHE] Erro ao guardar {key}: {e}")
+            _remove_file(tmp_path)
+            return None
+        with self._lock:
+            existing = self._entries.get(stem)
+            if existing is not None and os.path.isfile(existing.path):
+                # Outro download da mesma faixa chegou primeiro: usa esse
+                _remove_file(tmp_path)
+                existing.last_used = time.time()
+                self._pin(existing.path)
+                return existing.path
+            try:
+                os.replace(tmp_path, final_path)
+            except OSError as e:
+                print(f"[CACHE] Erro ao guardar {key}: {e}")
+                _remove_file(tmp_path)
+                return None
+            if existing is not None:
+                self._total -= existing.size
+            self._entries[stem] = _CacheEntry(final_path, size, time.time(), hits=1)
+            self._total += size
+            self._pin(final_path)
+            self._evict_locked()
+        return final_path
+
+    def contains(self, key: str) -> bool:
+        """True se a chave estiver em cache (sem reservar nem contar hit/miss)."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            entry = self._entries.get(self._file_stem(key))
+        return entry is not None and os.path.isfile(entry.path)
+
+    def release(self, path: Optional[str]) -> bool:
+        """Liberta um caminho devolvido por lookup/store. False se o caminho não for da cache."""
+        if not path or os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.directory):
+            return False
+        with self._lock:
+            count = self._pins.get(path, 0) - 1
+            if count > 0:
+                self._pins[path] = count
+            else:
+                self._pins.pop(path, None)
+            self._evict_locked()
+        return True
+
+    def _evict_locked(self) -> None:
+        if self._total <= self.max_bytes:
+            return
+        if self.policy == "lfu":
+            order = sorted(self._entries.items(), key=lambda kv: (kv[1].hits, kv[1].last_used))
+        else:
+            order = sorted(self._entries.items(), key=lambda kv: kv[1].last_used)
+        for stem, entry in order:
+            if self._total <= self.max_bytes:
+                break
+            if self._pins.get(entry.path):
+                continue  # a tocar agora; fica para depois
+            _remove_file(entry.path)
+            del self._entries[stem]
+            self._total -= entry.size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "policy": self.policy,
+            }
+
+
+audio_cache = AudioCache(AUDIO_CACHE_PROCESS_DIR, AUDIO_CACHE_PROCESS_MAX_BYTES, AUDIO_CACHE_POLICY)
+
+
+def release_audio_file(path: Optional[str]) -> None:
+    """Fim de uso de um ficheiro de áudio: liberta-o da cache ou apaga-o se for temporário."""
+    if not audio_cache.release(path):
+        _remove_file(path)
+
+
+async def fetch_audio(guild_id: int, item: dict, cancel_event: threading.Event) -> Optional[str]:
+    """
+    Obtém o ficheiro de áudio de um item: da cache se existir, senão descarrega no pool
+    de extração (e guarda na cache). Devolve None em caso de erro/cancelamento/timeout.
+    O caminho devolvido deve ser libertado com release_audio_file().
+    """
+    global _downloads_in_flight
+    started = time.monotonic()
+    cache_key = item.get("cache_key")
+    if cache_key:
+        cached = await asyncio.to_thread(audio_cache.lookup, cache_key)
+        if cached:
+            DOWNLOAD_SECONDS.observe(time.monotonic() - started, result="cache")
+            loudness.schedule(cache_key, cached)
+            return cached
+    url = item.get("webpage_url") or item.get("url")
+    if not url:
+        return None
+    _downloads_in_flight += 1
+    try:
+        path = await extraction_pool.run(
+            guild_id,
+            download_audio_to_file,
+            url,
+            resolved_info(item),
+            timeout=DOWNLOAD_TIMEOUT_SECONDS,
+            cancel_event=cancel_event,
+            on_abandon=_remove_file,
+            bounded=False,  # o nº de downloads por servidor já é limitado pela janela de prefetch
+        )
+    except asyncio.TimeoutError:
+        print(f"[PLAYER] Timeout ao descarregar: {item.get('title', '?')}")
+        path = None
+    except Exception as e:
+        print(f"[PLAYER] Erro ao descarregar: {e}")
+        path = None
+    finally:
+        _downloads_in_flight -= 1
+    DOWNLOAD_SECONDS.observe(time.monotonic() - started, result="ok" if path else "failed")
+    if path and cache_key:
+        path = await asyncio.to_thread(audio_cache.store, cache_key, path) or path
+    temp_janitor.track(path)  # Fora da cache: fica temporário até release_audio_file()
+    # Enquanto a faixa anterior toca: mede a loudness deste ficheiro (uma vez por faixa)
+    loudness.schedule(cache_key, path)
+    return path
+
+
+def download_audio_to_file(
+    url: str,
+    resolved: Optional[dict] = None,
+    cancel_event: Optional[threading.Event] = None,
+) -> Optional[str]:
+    """
+    Descarrega áudio com yt-dlp (API Python) para um ficheiro temporário.
+    Devolve o caminho do ficheiro ou None em caso de erro.
+    Se cancel_event for ativado durante o download, pára e apaga ficheiros parciais.
+    Se resolved (info já extraída no !play) for dado, não volta a extrair: só escolhe o formato e descarrega.
+    """
+    base = temp_janitor.new_base()
+    out_template = base + ".%(ext)s"
+
+    def _check_cancel(_progress: dict) -> None:
+        if cancel_event is not None and cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled("Download cancelado")
+
+    # Preferir m4a (AAC): o FFmpeg do Stremio pode não suportar Opus/webm → return code 1
+    opts = {
+        **YTDL_OPTS,
+        "format": "bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best",
+        "outtmpl": out_template,
+        "noplaylist": True,
+        "no_warnings": True,
+        "quiet": False,
+        "no_check_certificates": True,
+        "progress_hooks": [_check_cancel],
+    }
+    path: Optional[str] = None
+    keep: Optional[str] = None  # Ficheiro final a manter (tudo o resto com o prefixo é apagado)
+    try:
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = _download_resolved(ydl, resolved)
+            if not info:
+                info = ydl.extract_info(url, download=True)
+        if not info:
+            print("[PLAYER] yt-dlp: sem informação do vídeo")
+            return None
+        # Caminho do ficheiro descarregado (yt-dlp preenche requested_downloads)
+        req = info.get("requested_downloads") or []
+        if req:
+            path = req[0].get("filepath") or req[0].get("filename")
+        if not path or not os.path.isfile(path):
+            # Fallback: construir path a partir de ext
+            ext = info.get("ext") or "m4a"
+            path = base + "." + ext
+        if not os.path.isfile(path):
+            return None
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        keep = path
+        return path
+    except yt_dlp.utils.DownloadCancelled:
+        print(f"[PLAYER] Download cancelado: {url}")
+        return None
+    except yt_dlp.utils.DownloadError as e:
+        print(f"[PLAYER] yt-dlp: {e}")
+        return None
+    except Exception as e:
+        print(f"[PLAYER] yt-dlp: {e}")
+        return None
+    finally:
+        # Cancelado (mesmo já no fim) ou falhou: não deixar ficheiros parciais (.part, .ytdl, ...)
+        for leftover in glob.glob(glob.escape(base) + "*"):
+            if leftover != keep:
+                _remove_file(leftover)
+
+
+def _download_resolved(ydl: yt_dlp.YoutubeDL, resolved: Optional[dict]) -> Optional[dict]:
+    """Descarrega a partir de info já resolvida (sem nova extração). None se não houver ou falhar."""
+    if resolved is None:
+        return None
+    try:
+        return ydl.process_ie_result(resolved, download=True)
+    except yt_dlp.utils.DownloadCancelled:
+        raise
+    except yt_dlp.utils.DownloadError as e:
+        # URL direto rejeitado (ex: expirou antes do previsto): o chamador volta a extrair
+        print(f"[PLAYER] yt-dlp: info resolvida inválida, a extrair de novo: {e}")
+        return None
+
+
+class _Prefetch:
+    """Obtenção (cache ou download) de um item da fila a correr em background (cancelável)."""
+
+    def __init__(self, guild_id: int, item: dict):
+        self.item = item
+        self.cancel_event = threading.Event()
+        self.task: asyncio.Future[Optional[str]] = asyncio.ensure_future(
+            fetch_audio(guild_id, item, self.cancel_event)
+        )
+
+    def cancel(self) -> None:
+        """Pára o download; se já tiver terminado (ou terminar depois), liberta/apaga o ficheiro."""
+        self.cancel_event.set()
+        self.task.add_done_callback(_discard_prefetched_file)
+
+
+def _discard_prefetched_file(task: "asyncio.Future[Optional[str]]") -> None:
+    if task.cancelled() or task.exception() is not None:
+        return
+    release_audio_file(task.result())
+
+
+def drop_resolved_info(item: dict) -> None:
+    """Esquece a info do yt-dlp (formatos, URLs diretos) de um item; o download volta a extrair (resolved_info → None)."""
+    item.pop("_info", None)
+    item.pop("expires_at", None)
+
+
+def enqueue_resolved(state: GuildMusicState, item: dict) -> None:
+    """
+    Põe na fila um item resolvido no !play e atualiza o prefetch. Fora da janela de prefetch/resolução o item
+    não guarda a info do yt-dlp (a lista de formatos pesa por item em filas longas): é re-extraída perto de tocar.
+    """
+    state.queue.put(item)
+    if len(state.queue) > max(PREFETCH_COUNT, PLAYLIST_RESOLVE_AHEAD):
+        drop_resolved_info(item)
+    schedule_prefetch(state)
+
+
+def schedule_prefetch(state: GuildMusicState) -> None:
+    """
+    Mantém downloads em background para os próximos PREFETCH_COUNT itens da fila.
+    Prefetches de itens que saíram da janela (fila editada) são cancelados.
+    """
+    wanted: dict[int, dict] = {}
+    # Disco temporário acima do orçamento: só a próxima faixa (o player descarregava-a de qualquer forma)
+    for item in state.queue.peek(1 if temp_janitor.over_budget() else PREFETCH_COUNT):
+        if item.get("file_path"):
+            loudness.schedule(LoudnessAnalyzer.key_for(item), item["file_path"])
+            continue
+        if item.get("webpage_url") or item.get("url"):
+            wanted[item["qid"]] = item
+    for key in list(state.prefetches):
+        if key not in wanted:
+            prefetch = state.prefetches.pop(key)
+            prefetch.cancel()
+            drop_resolved_info(prefetch.item)  # Saiu da janela (fila editada): re-extrai quando voltar
+    for key, item in wanted.items():
+        if key not in state.prefetches:
+            state.prefetches[key] = _Prefetch(state.guild_id, item)
+    # Entradas de playlist perto do início: resolver info completa (as que já estão a
+    # descarregar não precisam, o download extrai-as)
+    for item in state.queue.peek(PLAYLIST_RESOLVE_AHEAD):
+        qid = item["qid"]
+        if item.get("lazy") and qid not in state.prefetches and qid not in state.resolving:
+            task = asyncio.ensure_future(_resolve_lazy_item(state.guild_id, item))
+            state.resolving[qid] = task
+            task.add_done_callback(lambda _t, qid=qid: state.resolving.pop(qid, None))
+    # A próxima faixa pode ter mudado (fila editada): pré-abrir a nova
+    schedule_preopen(state)
+
+
+async def _resolve_lazy_item(guild_id: int, item: dict) -> None:
+    """Troca os dados "flat" de uma entrada de playlist pela info completa (título, duração, formatos)."""
+    url = item.get("webpage_url")
+    if not url:
+        return
+    try:
+        info = await extraction_pool.run(guild_id, extract_info, url, timeout=EXTRACT_TIMEOUT_SECONDS, bounded=False)
+    except Exception as e:
+        print(f"[PLAYLIST] Não consegui resolver {url}: {e}")
+        return
+    metadata_cache.set(url, info)
+    get_state(guild_id).queue.update(item, {**info, "lazy": False})
+
+
+def cancel_downloads(state: GuildMusicState) -> None:
+    """Cancela todos os downloads em curso do servidor (prefetches e o do próximo item) e a source pré-aberta."""
+    discard_primed(state)
+    for pre in state.prefetches.values():
+        pre.cancel()
+    state.prefetches.clear()
+    if state.current_download is not None:
+        state.current_download.cancel()
+        state.current_download = None
+    for task in state.resolving.values():
+        task.cancel()
+    state.resolving.clear()
+
+
+def _get_audio_url(info: dict) -> Optional[str]:
+    """Extrai URL de áudio do resultado do yt-dlp (suporta DASH e formatos simples)."""
+    if info.get("url"):
+        return info["url"]
+    requested = info.get("requested_formats")
+    if requested:
+        for f in requested:
+            if f.get("url") and (f.get("vcodec") == "none" or f.get("acodec")):
+                return f["url"]
+        if requested[0].get("url"):
+            return requested[0]["url"]
+    for f in reversed(info.get("formats", [])):
+        if f.get("url") and (f.get("vcodec") == "none" or not f.get("vcodec")):
+            return f["url"]
+    return None
+
+
+class _GrowingFileReader:
+    """
+    Leitura de um ficheiro que ainda está a ser escrito pelo yt-dlp.
+    Usado como stdin do FFmpeg (pipe=True): espera por mais dados até o download terminar.
+    """
+
+    POLL_SECONDS = 0.05
+
+    def __init__(self, download: "_StreamingDownload"):
+        self._download = download
+        self._f = open(download.path, "rb")
+
+    def read(self, n: int = -1) -> bytes:
+        while True:
+            data = self._f.read(n)
+            if data:
+                return data
+            if self._download.done.is_set():
+                return self._f.read(n)  # o que faltar depois do último poll
+            if self._download.cancel_event.is_set():
+                return b""
+            time.sleep(self.POLL_SECONDS)
+
+    def close(self) -> None:
+        try:
+            self._f.close()
+        except OSError:
+            pass
+
+
+class _StreamingDownload:
+    """
+    Download com yt-dlp para um ficheiro que vai crescendo, tocado pelo FFmpeg via pipe
+    assim que houver STREAM_BUFFER_BYTES. No fim, se completo, o ficheiro entra na cache.
+    """
+
+    def __init__(self, guild_id: int, item: dict):
+        self.item = item
+        self.base = temp_janitor.new_base()
+        self.path = self.base + ".stream"
+        temp_janitor.track(self.path)
+        self.ext: Optional[str] = None
+        self.ok = False  # download terminou sem erros
+        self.cancel_event = threading.Event()
+        self.done = threading.Event()
+        self._reader: Optional[_GrowingFileReader] = None
+        url = item.get("webpage_url") or item.get("url")
+        # O ficheiro é lido à medida que cresce, por isso o download corre neste processo (local),
+        # mas ocupa um worker do pool e respeita a fairness entre servidores
+        self.task = asyncio.ensure_future(
+            extraction_pool.run(guild_id, self._run, url, resolved_info(item), bounded=False, local=True)
+        )
+
+    def _run(self, url: str, resolved: Optional[dict]) -> None:
+        def _check_cancel(_progress: dict) -> None:
+            if self.cancel_event.is_set():
+                raise yt_dlp.utils.DownloadCancelled("Download cancelado")
+
+        opts = {
+            **YTDL_OPTS,
+            # webm/opus e m4a do YouTube (DASH) podem ser lidos sequencialmente por pipe
+            "format": "bestaudio[ext=webm]/bestaudio[ext=m4a]/bestaudio/best",
+            "outtmpl": self.path,
+            "nopart": True,  # escrever diretamente no ficheiro final (é esse que o FFmpeg lê)
+            "fixup": "never",  # não reescrever o ficheiro no fim enquanto está a ser lido
+            "no_check_certificates": True,
+            "progress_hooks": [_check_cancel],
+        }
+        try:
+            with yt_dlp.YoutubeDL(opts) as ydl:
+                info = _download_resolved(ydl, resolved)
+                if not info:
+                    info = ydl.extract_info(url, download=True)
+            self.ext = (info or {}).get("ext")
+            self.ok = bool(info) and os.path.isfile(self.path)
+        except yt_dlp.utils.DownloadCancelled:
+            pass
+        except Exception as e:
+            print(f"[PLAYER] yt-dlp (stream): {e}")
+        finally:
+            self.done.set()
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+
+    async def wait_buffered(self, threshold: int, timeout: float) -> bool:
+        """True quando há dados suficientes para começar (ou o download já acabou com sucesso)."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and not self.cancel_event.is_set():
+            if self.done.is_set():
+                return self.ok
+            try:
+                if os.path.getsize(self.path) >= threshold:
+                    return True
+            except OSError:
+                pass
+            await asyncio.sleep(0.1)
+        return False
+
+    def open_source(self, stderr: Optional[_FFmpegStderrSink] = None) -> Optional[discord.AudioSource]:
+        try:
+            self._reader = _GrowingFileReader(self)
+            return make_audio_source(self._reader, loudness.volume(self.item.get("cache_key")), pipe=True, stderr=stderr)
+        except Exception as e:
+            print(f"[PLAYER] Erro ao criar source (stream): {e}")
+            return None
+
+    def finish(self) -> None:
+        """Depois de tocar (ou desistir): guarda na cache se o download ficou completo, senão apaga. Bloqueante."""
+        self.cancel_event.set()  # se ainda estiver a descarregar (skip), pára
+        self.done.wait(timeout=60)
+        if self._reader is not None:
+            self._reader.close()
+        cache_key = self.item.get("cache_key")
+        if self.ok and cache_key and os.path.isfile(self.path):
+            final_path = self.base + "." + (self.ext or "audio")
+            try:
+                os.replace(self.path, final_path)
+                stored = audio_cache.store(cache_key, final_path)
+                loudness.schedule(cache_key, stored)  # Próxima vez já toca com o ganho certo
+                audio_cache.release(stored)
+            except OSError:
+                pass
+        # O que não entrou na cache (incompleto, cancelado, erro) é apagado
+        for leftover in glob.glob(glob.escape(self.base) + "*"):
+            _remove_file(leftover)
+
+    def finish_in_background(self) -> None:
+        threading.Thread(target=self.finish, name="stream-finish", daemon=True).start()
+
+
+def make_audio_source(
+    source,
+    volume: float,
+    *,
+    pipe: bool = False,
+    before_options: Optional[str] = None,
+    stderr: Optional[_FFmpegStderrSink] = None,
+) -> discord.AudioSource:
+    """
+    Source do FFmpeg com o volume aplicado. Em AUDIO_ENCODE_MODE=opus o FFmpeg (processo próprio) faz
+    o volume e a codificação Opus e o discord.py só lê pacotes prontos do pipe: nenhum trabalho
+    por frame no processo do bot. Em "pcm" fica como antes (PCMVolumeTransformer + encoder Opus em Python).
+    """
+    if AUDIO_ENCODE_MODE == "opus":
+        return discord.FFmpegOpusAudio(
+            source,
+            pipe=pipe,
+            bitrate=OPUS_BITRATE_KBPS,
+            executable=FFMPEG_EXECUTABLE,
+            before_options=before_options,
+            options=f"{FFMPEG_OPTS} -af volume={volume:.4f}",
+            stderr=stderr or _FFmpegStderrSink(),
+        )
+    pcm = discord.FFmpegPCMAudio(
+        source,
+        pipe=pipe,
+        executable=FFMPEG_EXECUTABLE,
+        before_options=before_options,
+        options=FFMPEG_OPTS,
+        stderr=stderr or _FFmpegStderrSink(),
+    )
+    return discord.PCMVolumeTransformer(pcm, volume=volume)
+
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _process_cpu_seconds(pid: int) -> Optional[float]:
+    """CPU (user + system) de um processo a partir de /proc/<pid>/stat. None fora de Linux."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            fields = f.read().rsplit(b")", 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS  # utime e stime (campos 14 e 15)
+
+
+def _ffmpeg_process(source: discord.AudioSource) -> Optional[subprocess.Popen]:
+    while source is not None:
+        process = getattr(source, "_process", None)
+        if process is not None:
+            return process
+        source = getattr(source, "original", None)
+    return None
+
+
+class _MeasuredSource(discord.AudioSource):
+    """
+    Envolve a source final para medir o primeiro frame (FFmpeg a arrancar e fila → áudio)
+    e o CPU do stream: do processo FFmpeg (/proc) e da thread de áudio do discord.py
+    (leitura, volume/encoder em modo pcm e envio), em fração de um core.
+    """
+
+    def __init__(self, original: discord.AudioSource, item: dict):
+        self.original = original
+        self.item = item
+        self.created_at = time.monotonic()
+        self._first_frame = False
+        self._started_at = 0.0
+        self._thread_id: Optional[int] = None
+        self._thread_cpu_start = 0.0
+        self._process = _ffmpeg_process(original)
+        self._ffmpeg_cpu_start = (self._process and _process_cpu_seconds(self._process.pid)) or 0.0
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if data and not self._first_frame:
+            self._first_frame = True
+            now = time.monotonic()
+            self._started_at = now
+            self._thread_id = threading.get_ident()
+            self._thread_cpu_start = time.thread_time()
+            FFMPEG_FIRST_FRAME_SECONDS.observe(now - self.created_at)
+            if self.item.get("enqueued_at"):
+                ENQUEUE_TO_AUDIO_SECONDS.observe(now - self.item["enqueued_at"])
+        return data
+
+    @property
+    def played(self) -> bool:
+        """True se chegou a sair algum frame."""
+        return self._first_frame
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def cpu_usage(self) -> dict[str, float]:
+        """CPU até agora em fração de um core: {"ffmpeg": …, "python": …} (só o que for mensurável)."""
+        usage: dict[str, float] = {}
+        wall = time.monotonic() - self._started_at
+        if not self._first_frame or wall <= 0:
+            return usage
+        if self._process is not None:
+            cpu = _process_cpu_seconds(self._process.pid)
+            if cpu is not None:
+                usage["ffmpeg"] = (cpu - self._ffmpeg_cpu_start) / wall
+        if self._thread_id == threading.get_ident():  # thread_time só vale na thread de áudio
+            usage["python"] = (time.thread_time() - self._thread_cpu_start) / wall
+        return usage
+
+    def cleanup(self) -> None:
+        wall = time.monotonic() - self._started_at
+        for part, ratio in self.cpu_usage().items():  # antes do cleanup: o FFmpeg ainda existe
+            STREAM_CPU_RATIO.observe(ratio, part=part, mode=AUDIO_ENCODE_MODE)
+            STREAM_CPU_SECONDS.inc(ratio * wall, part=part)
+        self.original.cleanup()
+
+
+class _PrimedSource(discord.AudioSource):
+    """Source da próxima faixa com o FFmpeg já a correr e os primeiros frames em memória (gapless)."""
+
+    def __init__(self, original: discord.AudioSource, item: dict, sink: _FFmpegStderrSink):
+        self.original = original
+        self.item = item
+        self.sink = sink
+        self._buffer: deque[bytes] = deque()
+
+    def prime(self, frames: int) -> None:
+        """Lê os primeiros frames (arranque do FFmpeg, probe e primeira descodificação). Bloqueante."""
+        for _ in range(frames):
+            data = self.original.read()
+            if not data:
+                break
+            self._buffer.append(data)
+
+    def read(self) -> bytes:
+        if self._buffer:
+            return self._buffer.popleft()
+        return self.original.read()
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def cleanup(self) -> None:
+        self.original.cleanup()
+
+
+class _CrossfadeSource(discord.AudioSource):
+    """
+    Últimos CROSSFADE_SECONDS da faixa atual misturados com o início da próxima (já pré-aberta).
+    Os frames da próxima consumidos aqui já não se repetem: o voice.play seguinte continua dali.
+    Só PCM (em modo opus os pacotes já vêm codificados do FFmpeg).
+    """
+
+    # Posição contada em amostras a partir do tamanho real de cada frame PCM (48 kHz, 16-bit estéreo)
+    SAMPLE_RATE = discord.opus.Encoder.SAMPLING_RATE
+    BYTES_PER_SAMPLE = discord.opus.Encoder.SAMPLE_SIZE  # todos os canais
+
+    def __init__(self, original: discord.AudioSource, duration: float, state: GuildMusicState):
+        self.original = original
+        self.state = state
+        self.total_samples = int(duration * self.SAMPLE_RATE)
+        self.fade_samples = max(int(CROSSFADE_SECONDS * self.SAMPLE_RATE), discord.opus.Encoder.SAMPLES_PER_FRAME)
+        self.samples = 0
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if not data:
+            return data
+        self.samples += len(data) // self.BYTES_PER_SAMPLE
+        remaining = self.total_samples - self.samples
+        following = self.state.primed
+        if remaining > self.fade_samples or following is None or following.is_opus():
+            return data
+        try:
+            other = following.read()
+        except Exception:
+            return data
+        if len(other) != len(data):
+            return data
+        t = max(remaining / self.fade_samples, 0.0)  # 1 → 0 ao longo do crossfade
+        return audioop.add(audioop.mul(data, 2, t), audioop.mul(other, 2, 1.0 - t), 2)
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        self.original.cleanup()
+
+
+def release_primed(primed: _PrimedSource) -> None:
+    """Fecha uma source pré-aberta fora do event loop (o cleanup mata o FFmpeg e espera por ele)."""
+    spawn_background(asyncio.to_thread(primed.cleanup))
+
+
+def discard_primed(state: GuildMusicState) -> None:
+    """Descarta a source pré-aberta (e a pré-abertura em curso), ex: a fila mudou ou !stop."""
+    if state.preopen_task is not None and not state.preopen_task.done():
+        state.preopen_task.cancel()
+    state.preopen_task = None
+    state.preopen_qid = None
+    primed, state.primed = state.primed, None
+    if primed is not None:
+        release_primed(primed)
+
+
+def schedule_preopen(state: GuildMusicState) -> None:
+    """
+    Enquanto uma faixa toca: abre já o FFmpeg da seguinte (quando o ficheiro estiver pronto) para a
+    transição não pagar arranque/probe/primeira descodificação. Chamado ao começar a tocar e quando a fila muda.
+    """
+    if not GAPLESS or state.currently_playing is None:
+        return
+    following = state.queue.at(0)
+    if following is None:
+        discard_primed(state)
+        return
+    if state.primed is not None and state.primed.item is following:
+        return
+    if state.preopen_qid == following["qid"] and state.preopen_task is not None and not state.preopen_task.done():
+        return
+    discard_primed(state)
+    if not following.get("file_path") and following["qid"] not in state.prefetches:
+        return  # Sem ficheiro a caminho (ex: streaming): transição normal
+    state.preopen_qid = following["qid"]
+    state.preopen_task = asyncio.ensure_future(_preopen(state, following))
+
+
+async def _preopen(state: GuildMusicState, item: dict) -> None:
+    path = item.get("file_path")
+    if path:
+        if not await asyncio.to_thread(os.path.isfile, path):
+            return
+        volume = loudness.volume(LoudnessAnalyzer.key_for(item))
+    else:
+        prefetch = state.prefetches.get(item["qid"])
+        if prefetch is None:
+            return
+        path = await asyncio.shield(prefetch.task)  # Cancelar a pré-abertura não cancela o download
+        if not path:
+            return
+        volume = loudness.volume(item.get("cache_key"))
+    sink = _FFmpegStderrSink(stream_tag(state.guild_id, item))
+    try:
+        primed = _PrimedSource(
+            make_audio_source(path, volume, before_options=FFMPEG_BEFORE_OPTS_FILE, stderr=sink), item, sink
+        )
+    except Exception as e:
+        print(f"[PLAYER] Erro ao pré-abrir a próxima faixa: {e}")
+        return
+    try:
+        await asyncio.to_thread(primed.prime, GAPLESS_PRIME_FRAMES)
+    except BaseException:
+        release_primed(primed)
+        raise
+    state.primed = primed
+
+
+async def take_primed(state: GuildMusicState, item: dict, prefetch: Optional["_Prefetch"]) -> Optional[_PrimedSource]:
+    """Source pré-aberta para o item que vai tocar (None se não houver). Descarta a de outro item."""
+    task = state.preopen_task
+    if task is not None and not task.done() and state.preopen_qid == item["qid"]:
+        if prefetch is None or prefetch.task.done():
+            # Ficheiro pronto, só falta o FFmpeg acabar de arrancar: esperar sai mais barato que abrir outro
+            try:
+                await task
+            except Exception:
+                pass
+    primed = state.primed
+    if primed is not None and primed.item is item:
+        state.primed = None
+        state.preopen_task = None
+        state.preopen_qid = None
+        return primed
+    discard_primed(state)
+    return None
+
+
+def with_crossfade(audio: discord.AudioSource, item: dict, state: GuildMusicState) -> discord.AudioSource:
+    if CROSSFADE_SECONDS <= 0 or audioop is None or audio.is_opus() or not item.get("duration"):
+        return audio
+    return _CrossfadeSource(audio, float(item["duration"]), state)
+
+
+def report_playback_error(err: Optional[Exception], source: "_MeasuredSource", sink: _FFmpegStderrSink) -> None:
+    """after= do voice.play: erro do discord.py, ou faixa que acabou sem nenhum frame (FFmpeg falhou), com o fim do stderr."""
+    tail = sink.tail_text()
+    if err is None and (source.played or not tail):
+        return  # Terminou normalmente, ou !skip antes do primeiro frame
+    reason = f"Erro: {err}" if err else "Terminou sem áudio"
+    print(f"[PLAYER] {reason} ({sink.tag})" + (f"\n  stderr do FFmpeg:\n    " + tail.replace("\n", "\n    ") if tail else ""))
+
+
+def record_startup_latency(mode: str, seconds: float) -> None:
+    """Latência de arranque (item sai da fila → voice.play) por modo."""
+    STARTUP_SECONDS.observe(seconds, mode=mode)
+
+
+class AttachmentStore:
+    """
+    Anexos de áudio guardados na pasta temporária, partilhados entre itens da fila.
+    - Downloads em streaming para disco, com limite por ficheiro e por servidor.
+    - Deduplicação pelo SHA-256 do ficheiro inteiro (calculado durante o download): o mesmo ficheiro
+      enviado duas vezes fica em disco uma vez.
+    - Contagem de referências: o ficheiro só é apagado quando nenhum item da fila o usa.
+    """
+
+    PREFIX = "discord_bot_att_"
+    CHUNK_BYTES = 64 * 1024
+
+    def __init__(self, concurrency: int, max_bytes: int, guild_max_bytes: int):
+        self.max_bytes = max_bytes
+        self.guild_max_bytes = guild_max_bytes
+        self._semaphore = asyncio.Semaphore(max(concurrency, 1))
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = threading.Lock()  # release() é chamado a partir da thread de áudio
+        self._by_hash: dict[str, str] = {}  # sha256 (32 primeiros dígitos, como no nome do ficheiro) -> caminho
+        self._info: dict[str, tuple[str, int]] = {}  # caminho -> (sha256, tamanho)
+        self._refs: dict[str, dict[int, int]] = {}  # caminho -> {guild_id: nº de itens}
+        self._guild_bytes: dict[int, int] = {}
+        self._reserved: dict[int, int] = {}  # guild_id -> bytes de downloads ainda em curso
+
+    @classmethod
+    def is_attachment(cls, path: Optional[str]) -> bool:
+        return bool(path) and os.path.basename(path).startswith(cls.PREFIX) and not path.endswith(".part")
+
+    def adopt(self, guild_id: int, path: str) -> None:
+        """Volta a gerir um anexo que já estava em disco (fila restaurada do journal depois de reiniciar)."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        sha = os.path.splitext(os.path.basename(path))[0][-32:]  # O nome acaba no hash (depois do shard, se houver)
+        with self._lock:
+            if path not in self._info:
+                self._by_hash.setdefault(sha, path)
+                self._info[path] = (sha, size)
+            self._acquire_locked(guild_id, path)
+        temp_janitor.track(path)
+
+    def owns(self, path: Optional[str]) -> bool:
+        with self._lock:
+            return path in self._refs
+
+    def guild_bytes(self, guild_id: int) -> int:
+        """Bytes de anexos do servidor na fila, incluindo os que ainda estão a descarregar."""
+        with self._lock:
+            return self._guild_bytes.get(guild_id, 0) + self._reserved.get(guild_id, 0)
+
+    def _unreserve_locked(self, guild_id: int, size: int) -> None:
+        left = self._reserved.get(guild_id, 0) - size
+        if left > 0:
+            self._reserved[guild_id] = left
+        else:
+            self._reserved.pop(guild_id, None)
+
+    def _acquire_locked(self, guild_id: int, path: str) -> None:
+        holders = self._refs.setdefault(path, {})
+        holders[guild_id] = holders.get(guild_id, 0) + 1
+        self._guild_bytes[guild_id] = self._guild_bytes.get(guild_id, 0) + self._info[path][1]
+
+    def release(self, guild_id: int, path: Optional[str]) -> None:
+        """Um item deixou de usar o ficheiro (tocou ou saiu da fila); apaga-o se era o último."""
+        with self._lock:
+            holders = self._refs.get(path)
+            if not holders or guild_id not in holders:
+                return
+            size = self._info[path][1]
+            self._guild_bytes[guild_id] = max(self._guild_bytes.get(guild_id, 0) - size, 0)
+            holders[guild_id] -= 1
+            if holders[guild_id] <= 0:
+                del holders[guild_id]
+            if holders:
+                return
+            del self._refs[path]
+            sha, _size = self._info.pop(path)
+            self._by_hash.pop(sha, None)
+        _remove_file(path)
+
+    async def close(self) -> None:
+        """Fecha a sessão HTTP (no fecho do bot)."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _session_get(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_read=60))
+        return self._session
+
+    async def fetch(self, guild_id: int, attachment: discord.Attachment, ext: str) -> str:
+        """Devolve o caminho local do anexo (já com referência para guild_id). Lança CommandError."""
+        name = attachment.filename or "anexo"
+        if attachment.size > self.max_bytes:
+            raise commands.CommandError(
+                f"{name} é demasiado grande ({attachment.size / 1024 / 1024:.0f} MB; máximo {self.max_bytes // 1024 // 1024} MB)."
+            )
+        # Verificar e reservar no mesmo passo: anexos em paralelo não podem passar todos o limite
+        with self._lock:
+            used = self._guild_bytes.get(guild_id, 0) + self._reserved.get(guild_id, 0)
+            if used + attachment.size > self.guild_max_bytes:
+                raise commands.CommandError(
+                    f"Sem espaço para {name}: este servidor já tem {used // 1024 // 1024} MB "
+                    f"de anexos na fila (máximo {self.guild_max_bytes // 1024 // 1024} MB)."
+                )
+            self._reserved[guild_id] = self._reserved.get(guild_id, 0) + attachment.size
+        try:
+            path = await self._fetch_file(attachment, ext)
+        except BaseException:
+            with self._lock:
+                self._unreserve_locked(guild_id, attachment.size)  # Falhou/cancelado: a reserva sai
+            raise
+        with self._lock:
+            self._unreserve_locked(guild_id, attachment.size)  # A reserva passa a ser a referência (tamanho real)
+            if path not in self._info:
+                raise commands.CommandError(f"{name} foi removido enquanto era descarregado. Tenta novamente.")
+            self._acquire_locked(guild_id, path)
+        return path
+
+    async def _fetch_file(self, attachment: discord.Attachment, ext: str) -> str:
+        name = attachment.filename or "anexo"
+        async with self._semaphore:
+            if not await temp_janitor.reserve(attachment.size):
+                raise commands.CommandError(
+                    f"Sem espaço temporário para {name} (limite de {temp_janitor.max_bytes // 1024 // 1024} MB "
+                    f"em ficheiros temporários). Tenta mais tarde."
+                )
+            return await self._download(attachment, ext)
+
+    async def _download(self, attachment: discord.Attachment, ext: str) -> str:
+        name = attachment.filename or "anexo"
+        tmp_path = temp_janitor.path(f"{self.PREFIX}{uuid.uuid4().hex}.part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async with self._session_get().get(attachment.url) as resp:
+                resp.raise_for_status()
+                with open(tmp_path, "wb") as f:
+                    async for chunk in resp.content.iter_chunked(self.CHUNK_BYTES):
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise commands.CommandError(f"{name} excede o máximo de {self.max_bytes // 1024 // 1024} MB.")
+                        digest.update(chunk)
+                        f.write(chunk)
+        except commands.CommandError:
+            _remove_file(tmp_path)
+            raise
+        except Exception as e:
+            _remove_file(tmp_path)
+            raise commands.CommandError(f"Erro ao descarregar o ficheiro {name}: {e}")
+        sha = digest.hexdigest()[:32]
+        # Com TEMP_DIR partilhado, os processos de shards não partilham as contagens de referências: nomes por processo
+        shard_tag = f"s{SHARD_INDEX}_" if SHARD_INDEX >= 0 else ""
+        final_path = temp_janitor.path(f"{self.PREFIX}{shard_tag}{sha}{ext}")
+        with self._lock:
+            existing = self._by_hash.get(sha)
+            if existing and os.path.isfile(existing):
+                _remove_file(tmp_path)  # conteúdo repetido: reutiliza o que já está em disco
+                return existing
+            try:
+                os.replace(tmp_path, final_path)
+            except OSError as e:
+                _remove_file(tmp_path)
+                raise commands.CommandError(f"Erro ao guardar o ficheiro {name}: {e}")
+            self._by_hash[sha] = final_path
+            self._info[final_path] = (sha, size)
+        temp_janitor.track(final_path)
+        return final_path
+
+
+attachment_store = AttachmentStore(ATTACHMENT_CONCURRENCY, ATTACHMENT_MAX_BYTES, ATTACHMENT_GUILD_MAX_BYTES)
+
+
+def _close_resources_on_shutdown(client: commands.Bot) -> None:
+    """Envolve client.close() (Ctrl+C, SIGTERM ou bot.close()) para libertar também os recursos do bot."""
+    original = client.close
+
+    async def close() -> None:
+        try:
+            await attachment_store.close()
+        except Exception as e:
+            print(f"[SHUTDOWN] Erro ao fechar a sessão HTTP dos anexos: {e}")
+        try:
+            # Antes de desligar das chamadas de voz: as filas ficam como estavam para o próximo arranque
+            await queue_journal.close()
+        except Exception as e:
+            print(f"[SHUTDOWN] Erro ao gravar o journal das filas: {e}")
+        # Só gravam se houver alterações desde a última gravação (durante a execução é no máximo de 30 em 30 s)
+        for name, cache in (("metadados", metadata_cache), ("loudness", loudness)):
+            try:
+                await asyncio.to_thread(cache.save)
+            except Exception as e:
+                print(f"[SHUTDOWN] Erro ao gravar a cache de {name}: {e}")
+        await original()
+
+    client.close = close
+
+
+_close_resources_on_shutdown(bot)
+
+
+def release_local_file(guild_id: int, file_path: Optional[str]) -> None:
+    """Fim de uso do ficheiro local de um item (anexos são apagados quando já ninguém os usa)."""
+    if attachment_store.owns(file_path):
+        attachment_store.release(guild_id, file_path)
+
+
+def discard_item(guild_id: int, item: dict) -> None:
+    """Item removido da fila sem tocar: liberta o ficheiro do anexo, se houver."""
+    release_local_file(guild_id, item.get("file_path"))
+
+
+def clear_queue(state: GuildMusicState) -> None:
+    """Esvazia a fila e apaga o que era só dela: anexos, downloads em curso ou já feitos e a source pré-aberta."""
+    for item in state.queue.clear():
+        discard_item(state.guild_id, item)
+    cancel_downloads(state)
 
 
 def is_local_file(query: str) -> bool:
@@ -335,7 +2850,10 @@ def get_file_info(file_path: str) -> Optional[dict]:
     if ext not in ['.mp3', '.m4a', '.wav', '.flac', '.ogg', '.opus', '.aac']:
         return None
     
-    # Usa o nome do ficheiro como título
+    # Se estiver na biblioteca local já temos tags e duração; senão usa o nome do ficheiro como título
+    indexed = local_library.lookup(file_path)
+    if indexed is not None:
+        return indexed
     title = os.path.basename(file_path)
     
     # Marca como ficheiro local (sem webpage_url)
@@ -348,13 +2866,865 @@ def get_file_info(file_path: str) -> Optional[dict]:
     }
 
 
+LIBRARY_AUDIO_EXT = ('.mp3', '.m4a', '.wav', '.flac', '.ogg', '.opus', '.aac')
+
+
+def probe_audio_file(path: str) -> dict:
+    """Tags (título/artista/álbum) e duração com ffprobe. Sem ffprobe ou em erro devolve só o que conseguir."""
+    try:
+        result = subprocess.run(
+            [FFPROBE_EXECUTABLE, "-v", "quiet", "-print_format", "json", "-show_format", path],
+            capture_output=True, timeout=30,
+        )
+        fmt = json.loads(result.stdout or b"{}").get("format") or {}
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return {}
+    tags = {k.lower(): v for k, v in (fmt.get("tags") or {}).items()}
+    try:
+        duration = float(fmt["duration"])
+    except (KeyError, TypeError, ValueError):
+        duration = None
+    return {
+        "title": tags.get("title"),
+        "artist": tags.get("artist") or tags.get("album_artist"),
+        "album": tags.get("album"),
+        "duration": duration,
+    }
+
+
+class LocalLibrary:
+    """
+    Índice das pastas LIBRARY_DIRS em SQLite com pesquisa de texto (FTS5).
+    - Scan incremental: só corre o ffprobe em ficheiros novos ou com mtime/tamanho diferente,
+      e remove do índice os que desapareceram (arranque rápido mesmo com 100k ficheiros).
+    - ffprobe em paralelo (LIBRARY_SCAN_WORKERS); escritas em lotes numa só transação.
+    - search() devolve o melhor ficheiro para um texto ("artista título"), sem rede.
+    Thread-safe (uma ligação partilhada protegida por lock).
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, dirs: list[str], path: str, workers: int):
+        self.dirs = [os.path.abspath(os.path.expanduser(d.strip())) for d in dirs]
+        self.path = path
+        self.workers = max(workers, 1)
+        self.fts = False
+        self.scanning = False
+        self.last_scan: Optional[dict] = None
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.dirs and self.path)
+
+    def _conn(self) -> sqlite3.Connection:
+        # Chamar com self._lock
+        if self._db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS tracks ("
+                " id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, mtime REAL NOT NULL, size INTEGER NOT NULL,"
+                " title TEXT, artist TEXT, album TEXT, duration REAL)"
+            )
+            try:
+                db.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5("
+                    "title, artist, album, filename, tokenize='unicode61 remove_diacritics 2')"
+                )
+                self.fts = True
+            except sqlite3.OperationalError:
+                print("[LIBRARY] SQLite sem FTS5; pesquisa local por LIKE (mais lenta)")
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _walk(self):
+        """(caminho, mtime, tamanho) de todos os ficheiros de áudio das pastas (iterativo, sem seguir links)."""
+        pending = list(self.dirs)
+        while pending:
+            folder = pending.pop()
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                pending.append(entry.path)
+                            elif entry.name.lower().endswith(LIBRARY_AUDIO_EXT) and entry.is_file():
+                                st = entry.stat()
+                                yield entry.path, st.st_mtime, st.st_size
+                        except OSError:
+                            continue
+            except OSError as e:
+                print(f"[LIBRARY] Não consegui ler {folder}: {e}")
+
+    def _store(self, rows: list[tuple]) -> None:
+        self._store_rows(rows)
+        for path, _mtime, _size, meta in rows:
+            title = meta.get("title") or os.path.splitext(os.path.basename(path))[0]
+            title_index.add(self._display_title(title, meta.get("artist")), path)
+
+    def _store_rows(self, rows: list[tuple]) -> None:
+        with self._lock:
+            db = self._conn()
+            with db:
+                for path, mtime, size, meta in rows:
+                    title = meta.get("title") or os.path.splitext(os.path.basename(path))[0]
+                    row = db.execute(
+                        "INSERT INTO tracks (path, mtime, size, title, artist, album, duration) VALUES (?, ?, ?, ?, ?, ?, ?)"
+                        " ON CONFLICT(path) DO UPDATE SET mtime=excluded.mtime, size=excluded.size, title=excluded.title,"
+                        " artist=excluded.artist, album=excluded.album, duration=excluded.duration RETURNING id",
+                        (path, mtime, size, title, meta.get("artist"), meta.get("album"), meta.get("duration")),
+                    ).fetchone()
+                    if self.fts:
+                        db.execute("DELETE FROM tracks_fts WHERE rowid = ?", (row[0],))
+                        db.execute(
+                            "INSERT INTO tracks_fts (rowid, title, artist, album, filename) VALUES (?, ?, ?, ?, ?)",
+                            (row[0], title, meta.get("artist") or "", meta.get("album") or "", os.path.basename(path)),
+                        )
+
+    def _delete(self, ids: list[int]) -> None:
+        with self._lock:
+            db = self._conn()
+            with db:
+                for start in range(0, len(ids), self.BATCH_SIZE):
+                    chunk = [(i,) for i in ids[start:start + self.BATCH_SIZE]]
+                    db.executemany("DELETE FROM tracks WHERE id = ?", chunk)
+                    if self.fts:
+                        db.executemany("DELETE FROM tracks_fts WHERE rowid = ?", chunk)
+
+    def scan(self) -> Optional[dict]:
+        """Scan incremental (bloqueante: correr numa thread). Devolve contagens ou None se já havia um a correr."""
+        if not self.enabled or not self._scan_lock.acquire(blocking=False):
+            return None
+        self.scanning = True
+        started = time.monotonic()
+        try:
+            with self._lock:
+                known = {
+                    path: (track_id, mtime, size)
+                    for track_id, path, mtime, size in self._conn().execute("SELECT id, path, mtime, size FROM tracks")
+                }
+            seen = set()
+            changed = []
+            for path, mtime, size in self._walk():
+                seen.add(path)
+                old = known.get(path)
+                if old is None or old[1] != mtime or old[2] != size:
+                    changed.append((path, mtime, size))
+            removed = [(track_id, path) for path, (track_id, _m, _s) in known.items() if path not in seen]
+            if removed:
+                self._delete([track_id for track_id, _path in removed])
+                for _track_id, path in removed:
+                    title_index.discard(path)
+            batch = []
+            with concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="ffprobe") as pool:
+                for (path, mtime, size), meta in zip(changed, pool.map(probe_audio_file, (c[0] for c in changed))):
+                    batch.append((path, mtime, size, meta))
+                    if len(batch) >= self.BATCH_SIZE:
+                        self._store(batch)
+                        batch = []
+            if batch:
+                self._store(batch)
+            self.last_scan = {
+                "files": len(seen), "updated": len(changed), "removed": len(removed),
+                "seconds": time.monotonic() - started, "finished_at": time.time(),
+            }
+            print(
+                f"[LIBRARY] {len(seen)} ficheiros ({len(changed)} novos/alterados, {len(removed)} removidos) "
+                f"em {self.last_scan['seconds']:.1f}s"
+            )
+            return self.last_scan
+        finally:
+            self.scanning = False
+            self._scan_lock.release()
+
+    @staticmethod
+    def _display_title(title: str, artist: Optional[str]) -> str:
+        return f"{artist} - {title}" if artist else title
+
+    def titles(self) -> list[tuple[str, str]]:
+        """(título mostrado, caminho) de todas as faixas indexadas (para o autocomplete)."""
+        if not self.enabled or not os.path.isfile(self.path):
+            return []
+        with self._lock:
+            rows = self._conn().execute("SELECT title, artist, path FROM tracks").fetchall()
+        return [(self._display_title(title, artist), path) for title, artist, path in rows]
+
+    @staticmethod
+    def _item(row: tuple) -> dict:
+        path, title, artist, duration = row
+        return {
+            "title": LocalLibrary._display_title(title, artist),
+            "webpage_url": None,
+            "url": None,
+            "file_path": path,
+            "duration": duration,
+        }
+
+    def lookup(self, path: str) -> Optional[dict]:
+        """Item da fila para um caminho já indexado (None se não estiver no índice)."""
+        if not self.enabled or not os.path.isfile(self.path):
+            return None
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT path, title, artist, duration FROM tracks WHERE path = ?", (os.path.abspath(path),)
+            ).fetchone()
+        return self._item(row) if row else None
+
+    def search(self, text: str, limit: int = 1) -> list[dict]:
+        """Ficheiros cujo título/artista/álbum/nome contêm todas as palavras do texto (prefixos), melhores primeiro."""
+        words = re.findall(r"\w+", text.lower())
+        if not self.enabled or not words or not os.path.isfile(self.path):
+            return []
+        with self._lock:
+            db = self._conn()
+            if self.fts:
+                match = " ".join(f'"{w}"*' for w in words)
+                rows = db.execute(
+                    "SELECT t.path, t.title, t.artist, t.duration FROM tracks_fts f JOIN tracks t ON t.id = f.rowid"
+                    " WHERE tracks_fts MATCH ? ORDER BY bm25(tracks_fts, 10.0, 5.0, 2.0, 1.0) LIMIT ?",
+                    (match, limit),
+                ).fetchall()
+            else:
+                where = " AND ".join(
+                    "(title || ' ' || IFNULL(artist, '') || ' ' || IFNULL(album, '') || ' ' || path) LIKE ?" for _ in words
+                )
+                rows = db.execute(
+                    f"SELECT path, title, artist, duration FROM tracks WHERE {where} LIMIT ?",
+                    [f"%{w}%" for w in words] + [limit],
+                ).fetchall()
+        return [self._item(row) for row in rows if os.path.isfile(row[0])]
+
+    def stats(self) -> dict:
+        if not self.enabled or not os.path.isfile(self.path):
+            return {"tracks": 0}
+        with self._lock:
+            count, total = self._conn().execute("SELECT COUNT(*), IFNULL(SUM(duration), 0) FROM tracks").fetchone()
+        return {"tracks": count, "seconds": total}
+
+
+local_library = LocalLibrary(LIBRARY_DIRS, LIBRARY_DB_FILE, LIBRARY_SCAN_WORKERS)
+
+
+_library_task: Optional[asyncio.Task] = None
+
+
+def start_library_scan() -> None:
+    """Arranca o scan da biblioteca uma vez (on_ready repete-se em reconexões)."""
+    global _library_task
+    if local_library.enabled and (_library_task is None or _library_task.done()):
+        _library_task = spawn_background(library_rescan_loop())
+
+
+async def library_rescan_loop() -> None:
+    """Scan no arranque e, se LIBRARY_RESCAN_MINUTES > 0, periodicamente (só ficheiros alterados)."""
+    # Faixas já indexadas em execuções anteriores entram no autocomplete (o scan só traz as alteradas)
+    try:
+        title_index.add_many(await asyncio.to_thread(local_library.titles))
+    except sqlite3.Error as e:
+        print(f"[LIBRARY] Não consegui ler o índice: {e}")
+    if SHARD_INDEX > 0:
+        return  # Com vários processos de shards só o primeiro indexa; os outros só leem a base de dados
+    while True:
+        try:
+            await asyncio.to_thread(local_library.scan)
+        except Exception as e:
+            print(f"[LIBRARY] Erro no scan: {e}")
+        if LIBRARY_RESCAN_MINUTES <= 0:
+            return
+        await asyncio.sleep(LIBRARY_RESCAN_MINUTES * 60)
+
+
+class TitleIndex:
+    """
+    Índice em memória dos títulos já resolvidos (cache de metadados) e da biblioteca local, para o
+    autocomplete do /play responder em milissegundos e sem rede (o Discord só dá ~3 s).
+    - Cada palavra entra pelos prefixos de 1 e 2 letras (o que se está a escrever) e pelos trigramas.
+    - Uma pesquisa intersecta os conjuntos (do menor para o maior) e confirma as palavras no texto.
+    - add()/discard() incrementais (cache de metadados e scans da biblioteca); o mais antigo sai acima
+      de max_entries. Thread-safe (o scan corre numa thread).
+    - Caminhos da biblioteca nunca saem para o Discord: o autocomplete usa um id opaco ("lib:<id>"),
+      resolvido aqui no /play.
+    """
+
+    TOKEN_PREFIX = "lib:"
+    VERIFY_LIMIT = 5000  # Candidatos confirmados por pesquisa no máximo (prefixos de 1 letra dão muitos)
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._ids: dict[str, int] = {}  # valor (link ou caminho) -> id
+        self._entries: OrderedDict[int, tuple[str, str, str]] = OrderedDict()  # id -> (título, valor, texto normalizado)
+        self._keys: dict[str, set[int]] = {}  # prefixo ("^ab") ou trigrama -> ids
+        self._seq = itertools.count(1)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Minúsculas, sem acentos, só palavras ("Café Del Mar!" -> "cafe del mar")."""
+        decomposed = unicodedata.normalize("NFKD", text.casefold())
+        return " ".join(re.findall(r"\w+", "".join(c for c in decomposed if not unicodedata.combining(c))))
+
+    @staticmethod
+    def _word_keys(word: str) -> set[str]:
+        keys = {"^" + word[:1], "^" + word[:2]}
+        keys.update(word[i:i + 3] for i in range(len(word) - 2))
+        return keys
+
+    @staticmethod
+    def _query_keys(word: str) -> list[str]:
+        if len(word) < 3:
+            return ["^" + word]
+        return [word[i:i + 3] for i in range(len(word) - 2)]
+
+    def add(self, title: Optional[str], value: Optional[str]) -> None:
+        if not title or not value:
+            return
+        norm = self.normalize(title)
+        with self._lock:
+            self._discard_locked(value)
+            entry_id = next(self._seq)
+            self._ids[value] = entry_id
+            self._entries[entry_id] = (title, value, norm)
+            for key in {k for word in norm.split() for k in self._word_keys(word)}:
+                self._keys.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._discard_locked(next(iter(self._entries.values()))[1])
+
+    def add_many(self, pairs) -> None:
+        for title, value in pairs:
+            self.add(title, value)
+
+    def discard(self, value: str) -> None:
+        with self._lock:
+            self._discard_locked(value)
+
+    def _discard_locked(self, value: str) -> None:
+        entry_id = self._ids.pop(value, None)
+        if entry_id is None:
+            return
+        _title, _value, norm = self._entries.pop(entry_id)
+        for key in {k for word in norm.split() for k in self._word_keys(word)}:
+            ids = self._keys.get(key)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._keys[key]
+
+    def search(self, text: str, limit: int = 25) -> list[tuple[str, str]]:
+        """(título, valor) que contêm todas as palavras do texto; começos de título e os mais recentes primeiro."""
+        words = self.normalize(text).split()
+        with self._lock:
+            if not words:
+                return [(t, v) for t, v, _n in itertools.islice(reversed(self._entries.values()), limit)]
+            sets = []
+            for word in words:
+                for key in self._query_keys(word):
+                    ids = self._keys.get(key)
+                    if not ids:
+                        return []
+                    sets.append(ids)
+            sets.sort(key=len)
+            candidates = sets[0]
+            for ids in sets[1:]:
+                candidates = candidates & ids
+                if not candidates:
+                    return []
+            prefix = " ".join(words)
+            scored = []
+            ordered = candidates
+            if len(candidates) > self.VERIFY_LIMIT:
+                # Muitos candidatos (uma ou duas letras): confirmar só os mais recentes
+                ordered = (entry_id for entry_id in reversed(self._entries) if entry_id in candidates)
+            for entry_id in itertools.islice(ordered, self.VERIFY_LIMIT):
+                title, value, norm = self._entries[entry_id]
+                padded = " " + norm
+                if all(" " + w in padded for w in words):  # Cada palavra começa uma palavra do título
+                    scored.append((not norm.startswith(prefix), -entry_id, title, value))
+        return [(title, value) for _s, _i, title, value in heapq.nsmallest(limit, scored)]
+
+    def public_value(self, value: str) -> Optional[str]:
+        """Valor a mostrar ao Discord: links tal como estão, caminhos locais como "lib:<id>"."""
+        if value.startswith(("http://", "https://")):
+            return value
+        with self._lock:
+            entry_id = self._ids.get(value)
+        return None if entry_id is None else f"{self.TOKEN_PREFIX}{entry_id}"
+
+    def resolve_token(self, text: str) -> Optional[str]:
+        """Valor interno de um "lib:<id>" do autocomplete (None se não for um, ou se já saiu do índice)."""
+        text = text.strip()
+        if not text.startswith(self.TOKEN_PREFIX) or not text[len(self.TOKEN_PREFIX):].isdigit():
+            return None
+        with self._lock:
+            entry = self._entries.get(int(text[len(self.TOKEN_PREFIX):]))
+        return None if entry is None else entry[1]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+title_index = TitleIndex(TITLE_INDEX_MAX_ENTRIES)
+
+
+class MetadataCache:
+    """
+    Cache LRU com TTL para os resultados de extract_info (título, link, duração).
+    A chave é a query normalizada (texto em minúsculas/espaços colapsados; links tal como estão).
+    Não guarda o URL direto do áudio porque esse expira. Thread-safe.
+    """
+
+    SAVE_INTERVAL_SECONDS = 30.0  # Persistência no máximo de 30 em 30 s
+
+    def __init__(self, ttl: float, max_entries: int, path: str = ""):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()  # chave -> (expira_em, info)
+        self._last_save = 0.0
+        self._dirty = False
+
+    def load(self) -> None:
+        """Lê a cache persistida (se houver ficheiro). Só no arranque do bot."""
+        if self.path:
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        query = query.strip()
+        if query.startswith(("http://", "https://")):
+            return query
+        return " ".join(query.lower().split())
+
+    def get(self, query: str) -> Optional[dict]:
+        """Devolve uma cópia da info em cache (ou None se não existir/expirou)."""
+        if not self.enabled:
+            return None
+        key = self.normalize(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return {**entry[1], "url": None}
+
+    def set(self, query: str, info: dict) -> None:
+        if not self.enabled:
+            return
+        value = {k: info.get(k) for k in ("title", "webpage_url", "duration", "cache_key")}
+        expires_at = time.time() + self.ttl
+        keys = {self.normalize(query)}
+        if info.get("webpage_url"):
+            keys.add(self.normalize(info["webpage_url"]))  # um link direto para o mesmo vídeo também acerta
+        with self._lock:
+            for key in keys:
+                self._entries[key] = (expires_at, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+        title_index.add(value["title"], value["webpage_url"])
+
+    def titles(self) -> list[tuple[str, str]]:
+        """(título, link) de todas as entradas válidas, das mais antigas para as mais recentes."""
+        now = time.time()
+        with self._lock:
+            return [
+                (value.get("title"), value.get("webpage_url"))
+                for expires_at, value in self._entries.values()
+                if expires_at > now
+            ]
+
+    def save_due(self) -> bool:
+        """True se houver alterações por gravar e já passou SAVE_INTERVAL_SECONDS desde a última gravação."""
+        return bool(self.path) and self._dirty and time.monotonic() - self._last_save >= self.SAVE_INTERVAL_SECONDS
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _load(self) -> None:
+        self._merge(self._read(), oldest=False)
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"[CACHE] Não consegui ler {self.path}: {e}")
+            return {}
+
+    def _merge(self, data: dict, oldest: bool) -> None:
+        """Junta entradas lidas do ficheiro (oldest=True: entram como as menos recentes). Chamar com self._lock."""
+        now = time.time()
+        for key, (expires_at, value) in (reversed(data.items()) if oldest else data.items()):
+            current = self._entries.get(key)
+            if expires_at <= now or (current is not None and current[0] >= expires_at):
+                continue
+            self._entries[key] = (expires_at, value)
+            if oldest and current is None:
+                self._entries.move_to_end(key, last=False)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def save(self) -> None:
+        """Grava a cache em disco (escrita atómica). Chamado fora do event loop."""
+        if not self.path:
+            return
+        # Vários processos de shards gravam o mesmo ficheiro: junta primeiro o que os outros gravaram
+        on_disk = self._read() if SHARD_INDEX >= 0 else {}
+        with self._lock:
+            if not self._dirty:
+                return
+            self._merge(on_disk, oldest=True)
+            data = dict(self._entries)
+            self._dirty = False
+            self._last_save = time.monotonic()
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"[CACHE] Não consegui gravar {self.path}: {e}")
+            _remove_file(tmp_path)
+
+
+metadata_cache = MetadataCache(METADATA_CACHE_TTL_SECONDS, METADATA_CACHE_MAX_ENTRIES, METADATA_CACHE_FILE)
+
+
+class LoudnessAnalyzer:
+    """
+    Análise de loudness (EBU R128, filtro ebur128 do FFmpeg) feita uma vez por faixa, em background
+    e com poucos workers, para nunca competir com a reprodução. O resultado (loudness integrada e
+    true peak) fica guardado em LOUDNESS_CACHE_FILE, ao lado da cache de metadados; ao tocar
+    só se aplica um ganho fixo na source (-af volume do FFmpeg ou PCMVolumeTransformer), sem custo extra por stream.
+    Chave: cache_key do yt-dlp, ou caminho+tamanho+mtime para ficheiros locais. Thread-safe.
+    """
+
+    SAVE_INTERVAL_SECONDS = 30.0
+    MAX_ENTRIES = 50000
+    PEAK_CEILING_DB = -1.0  # Ganho limitado para o true peak não passar de -1 dBTP
+    _INTEGRATED_RE = re.compile(r"Integrated loudness:\s*I:\s*(-?[\d.]+|-inf) LUFS", re.S)
+    _PEAK_RE = re.compile(r"True peak:\s*Peak:\s*(-?[\d.]+|-inf) dBFS", re.S)
+
+    def __init__(self, target_lufs: float, max_gain_db: float, workers: int, path: str = ""):
+        self.target_lufs = target_lufs
+        self.max_gain_db = max(max_gain_db, 0.0)  # Único limite de amplificação (o true peak limita o resto)
+        self.path = path
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, float]] = OrderedDict()  # chave -> (LUFS, true peak dBFS)
+        self._pending: set[str] = set()
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._last_save = 0.0
+        self._dirty = False
+
+    def load(self) -> None:
+        """Lê as análises persistidas (se houver ficheiro). Só no arranque do bot."""
+        if self.enabled and self.path:
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    @staticmethod
+    def key_for(item: dict) -> Optional[str]:
+        if item.get("cache_key"):
+            return item["cache_key"]
+        path = item.get("file_path")
+        try:
+            st = os.stat(path)
+        except (OSError, TypeError):
+            return None
+        return f"file:{os.path.abspath(path)}:{st.st_size}:{int(st.st_mtime)}"
+
+    def volume(self, key: Optional[str]) -> float:
+        """Volume linear da source: ganho até ao alvo se a faixa já foi analisada, senão DEFAULT_VOLUME."""
+        with self._lock:
+            entry = self._entries.get(key) if key else None
+        if entry is None:
+            return DEFAULT_VOLUME
+        lufs, peak = entry
+        gain_db = min(self.target_lufs - lufs, self.max_gain_db, self.PEAK_CEILING_DB - peak)
+        return max(10 ** (gain_db / 20), 0.05)
+
+    def schedule(self, key: Optional[str], path: Optional[str]) -> None:
+        """Pede a análise de um ficheiro (ignora se já é conhecida ou está em curso). Pode ser chamado de qualquer thread."""
+        if not self.enabled or not key or not path:
+            return
+        with self._lock:
+            if key in self._entries or key in self._pending:
+                return
+            self._pending.add(key)
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="loudness")
+        self._executor.submit(self._analyze, key, path)
+
+    def _analyze(self, key: str, path: str) -> None:
+        started = time.monotonic()
+        try:
+            proc = subprocess.Popen(
+                [FFMPEG_EXECUTABLE, "-nostdin", "-hide_banner", "-nostats", "-i", path,
+                 "-vn", "-af", "ebur128=peak=true:framelog=quiet", "-f", "null", "-"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            )
+            # Prioridade baixa depois do arranque (preexec_fn não é seguro num processo com threads)
+            if hasattr(os, "setpriority"):
+                try:
+                    os.setpriority(os.PRIO_PROCESS, proc.pid, 10)
+                except OSError:
+                    pass
+            try:
+                _stdout, stderr = proc.communicate(timeout=600)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.communicate()
+                raise
+            output = stderr.decode("utf-8", "replace")
+            integrated = self._INTEGRATED_RE.findall(output)
+            peak = self._PEAK_RE.findall(output)
+            if proc.returncode != 0 or not integrated or integrated[-1] == "-inf":
+                return  # ficheiro já apagado, corrompido ou silêncio: fica com DEFAULT_VOLUME
+            entry = (float(integrated[-1]), float(peak[-1]) if peak and peak[-1] != "-inf" else 0.0)
+        except (OSError, subprocess.SubprocessError, ValueError) as e:
+            print(f"[LOUDNESS] Erro ao analisar {os.path.basename(path)}: {e}")
+            return
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+        LOUDNESS_ANALYSIS_SECONDS.observe(time.monotonic() - started)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+            self._dirty = True
+            save_due = bool(self.path) and time.monotonic() - self._last_save >= self.SAVE_INTERVAL_SECONDS
+        if save_due:
+            self.save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "pending": len(self._pending)}
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"[LOUDNESS] Não consegui ler {self.path}: {e}")
+            return
+        for key, (lufs, peak) in data.items():
+            self._entries[key] = (lufs, peak)
+
+    def save(self) -> None:
+        """Grava as análises em disco (escrita atómica). Chamado fora do event loop."""
+        on_disk = {}
+        if SHARD_INDEX >= 0 and self.path:
+            # Vários processos de shards gravam o mesmo ficheiro: mantém também as análises dos outros
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    on_disk = json.load(f)
+            except (OSError, ValueError):
+                pass
+        with self._lock:
+            if not self._dirty or not self.path:
+                return
+            for key, (lufs, peak) in on_disk.items():
+                if key not in self._entries:
+                    self._entries[key] = (lufs, peak)
+                    self._entries.move_to_end(key, last=False)
+            while len(self._entries) > self.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+            data = dict(self._entries)
+            self._dirty = False
+            self._last_save = time.monotonic()
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"[LOUDNESS] Não consegui gravar {self.path}: {e}")
+            _remove_file(tmp_path)
+
+
+loudness = LoudnessAnalyzer(LOUDNESS_TARGET_LUFS, LOUDNESS_MAX_GAIN_DB, LOUDNESS_WORKERS, LOUDNESS_CACHE_FILE)
+
+
+def load_persistent_state() -> None:
+    """
+    Lê do disco as caches (áudio, metadados, loudness) antes de ligar ao Discord.
+    Fora do import de propósito: os workers do pool de extração (modo process) importam este módulo
+    e não podem indexar/limpar a pasta da cache nem ler os ficheiros de estado do bot.
+    """
+    audio_cache.load()
+    metadata_cache.load()
+    title_index.add_many(metadata_cache.titles())
+    loudness.load()
+
+
+# Listas geradas automaticamente pelo YouTube (mix/rádio "RD…", uploads "UL…"): infinitas ou sem interesse
+_AUTO_PLAYLIST_PREFIXES = ("RD", "UL")
+
+
+def is_playlist_url(query: str, explicit: bool = False) -> bool:
+    """
+    True se a query for um link de playlist a adicionar inteira (/playlist, SoundCloud /sets/, list= sem vídeo).
+    Um link de vídeo com list= (watch?v=…&list=…, youtu.be/ID?list=…) toca só o vídeo, salvo explicit (!playlist).
+    Mixes automáticos (list=RD…/UL…) nunca contam como playlist.
+    """
+    query = query.strip()
+    if not query.startswith(("http://", "https://")):
+        return False
+    parsed = urlparse(query)
+    if "/playlist" in parsed.path or "/sets/" in parsed.path:
+        return True
+    list_id = (parse_qs(parsed.query).get("list") or [""])[0]
+    if not list_id or list_id.startswith(_AUTO_PLAYLIST_PREFIXES):
+        return False
+    has_video = "v" in parse_qs(parsed.query) or (parsed.netloc.endswith("youtu.be") and parsed.path.strip("/"))
+    return explicit or not has_video
+
+
+def extract_playlist(url: str, limit: int, start: int = 1) -> dict:
+    """
+    Extração "flat" de uma playlist: só ID/título/duração de cada entrada, sem abrir os vídeos.
+    Devolve {"title", "total", "items"} com no máximo limit itens a partir da entrada start (marcados lazy=True).
+    """
+    opts = {
+        **YTDL_OPTS,
+        "noplaylist": False,
+        "extract_flat": "in_playlist",
+        "playliststart": start,
+        "playlistend": start + limit - 1,
+    }
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if not info:
+        return {"title": None, "total": 0, "items": []}
+    items: list[dict] = []
+    for entry in itertools.islice(info.get("entries") or [], limit):
+        if not entry:
+            continue
+        entry_url = entry.get("url") or entry.get("webpage_url")
+        if entry.get("ie_key") == "Youtube" and entry.get("id"):
+            entry_url = f"https://www.youtube.com/watch?v={entry['id']}"
+        if not entry_url:
+            continue
+        cache_key = None
+        if entry.get("ie_key") and entry.get("id"):
+            cache_key = f"{entry['ie_key']}-{entry['id']}"
+        items.append({
+            "title": entry.get("title") or "Sem título",
+            "webpage_url": entry_url,
+            "url": None,
+            "duration": entry.get("duration"),
+            "cache_key": cache_key,
+            "lazy": True,  # info completa só quando estiver perto de tocar
+        })
+    if "entries" not in info and info.get("webpage_url") and start == 1:
+        # Afinal era um vídeo isolado
+        items.append({
+            "title": info.get("title", "Sem título"),
+            "webpage_url": info["webpage_url"],
+            "url": None,
+            "duration": info.get("duration"),
+            "cache_key": f"{info['extractor_key']}-{info['id']}" if info.get("extractor_key") and info.get("id") else None,
+        })
+    return {
+        "title": info.get("title"),
+        "total": info.get("playlist_count") or len(items),
+        "items": items,
+    }
+
+
+async def resolve_query(guild_id: int, query: str) -> dict:
+    """
+    Resolve uma pesquisa/link: da cache de metadados ou com extract_info no pool de extração.
+    Lança PoolBusyError se o servidor já tiver demasiadas pesquisas pendentes.
+    """
+    started = time.monotonic()
+    info = metadata_cache.get(query)
+    if info is not None:
+        RESOLVE_SECONDS.observe(time.monotonic() - started, source="cache")
+        return info
+    try:
+        info = await extraction_pool.run(guild_id, extract_info, query, timeout=EXTRACT_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        RESOLVE_SECONDS.observe(time.monotonic() - started, source="timeout")
+        raise commands.CommandError("Demorou demasiado a obter esse áudio. Tenta novamente.")
+    RESOLVE_SECONDS.observe(time.monotonic() - started, source="ytdl")
+    metadata_cache.set(query, info)
+    if metadata_cache.save_due():
+        spawn_background(asyncio.to_thread(metadata_cache.save))
+    return info
+
+
+def _direct_url_expiry(info: dict) -> float:
+    """Quando (epoch) os URLs diretos da info deixam de ser válidos (parâmetro expire=, ex: YouTube)."""
+    urls = [info.get("url")] + [f.get("url") for f in info.get("formats") or []]
+    for url in urls:
+        if not url:
+            continue
+        expire = parse_qs(urlparse(url).query).get("expire")
+        if expire and expire[0].isdigit():
+            return float(expire[0])
+    return time.time() + DIRECT_URL_DEFAULT_TTL_SECONDS
+
+
+def _slim_info(info: dict) -> dict:
+    """
+    Info do yt-dlp reduzida ao necessário para descarregar mais tarde sem nova extração:
+    só formatos com áudio e sem legendas/miniaturas/descrição (a info completa do YouTube é enorme).
+    """
+    info = yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True)
+    for key in ("thumbnails", "thumbnail", "subtitles", "automatic_captions", "heatmap", "description", "chapters"):
+        info.pop(key, None)
+    if info.get("formats"):
+        info["formats"] = [f for f in info["formats"] if f.get("acodec") != "none"]
+    return info
+
+
+def resolved_info(item: dict) -> Optional[dict]:
+    """Info resolvida do item (cópia) se os URLs diretos ainda forem válidos; senão None (re-extrair)."""
+    info = item.get("_info")
+    expires_at = item.get("expires_at")
+    if not info or not expires_at or time.time() >= expires_at - DIRECT_URL_EXPIRY_MARGIN_SECONDS:
+        return None
+    return copy.deepcopy(info)
+
+
 def extract_info(query: str) -> dict:
     """
     Retorna info de um vídeo.
     - Se query for link, usa direto
     - Se for texto, yt-dlp faz search por causa do default_search
     """
-    info = ytdl.extract_info(query, download=False)
+    info = _worker_ytdl().extract_info(query, download=False)
 
     # Se for search, vem uma lista em info["entries"]
     if "entries" in info:
@@ -363,135 +3733,372 @@ def extract_info(query: str) -> dict:
     url = _get_audio_url(info) or info.get("url")
     webpage_url = info.get("webpage_url") or info.get("url")
 
-    return {
+    # Chave da cache de áudio: extractor + ID (igual para o mesmo vídeo em qualquer link/pesquisa)
+    cache_key = None
+    if info.get("extractor_key") and info.get("id"):
+        cache_key = f"{info['extractor_key']}-{info['id']}"
+
+    result = {
         "title": info.get("title", "Sem título"),
         "webpage_url": webpage_url,
         "url": url,
         "duration": info.get("duration"),
+        "cache_key": cache_key,
     }
+    # Info resolvida (formatos + URLs diretos) para o download não voltar a extrair
+    result["_info"] = _slim_info(info)
+    result["expires_at"] = _direct_url_expiry(info)
+    return result
 
 
 async def player_loop(guild: discord.Guild):
     """Loop que consome a fila e toca música (download com yt-dlp → ficheiro → FFmpeg ou ficheiro local)."""
     state = get_state(guild.id)
+    # Loop atual (não bot.loop): permite correr o player sem ligação ao Discord (bench.py)
+    loop = asyncio.get_running_loop()
 
     while True:
         state.play_next.clear()
         state.current_ytdl_process = None
+        if state.currently_playing is not None:
+            queue_journal.record(guild.id, "done")
+            if not state.queue:
+                touch_activity(guild.id)  # Fica parado: a inatividade conta a partir do fim da última faixa
+                if state.status_message is not None:
+                    request_status(state)  # Acabou a fila: tirar o "a tocar"
         state.currently_playing = None
 
         item = await state.queue.get()
+        started_at = time.monotonic()
+        # Download já feito/em curso em background para este item (se houver)
+        prefetch = state.prefetches.pop(item["qid"], None)
         
-        # Remove o item da lista de fila quando começa a tocar
-        if item in state.queue_list:
-            state.queue_list.remove(item)
+        # A janela de prefetch avançou: começa já a descarregar os seguintes
+        schedule_prefetch(state)
         
         # Marca como atualmente a tocar (reseta inatividade)
         state.currently_playing = item
         touch_activity(guild.id)
+        if state.status_message is not None:
+            request_status(state)  # "A tocar" na mensagem de estado (junta-se a outros pedidos pendentes)
 
         voice: discord.VoiceClient = guild.voice_client
         if voice is None or not voice.is_connected():
+            if prefetch is not None:
+                prefetch.cancel()
+            discard_primed(state)
+            discard_item(guild.id, item)  # Anexo: apagar já, não fica à espera de ninguém
             continue
 
+        # FFmpeg já aberto durante a faixa anterior (gapless), se houver
+        primed = await take_primed(state, item, prefetch)
+
         # Verifica se é um ficheiro local
         file_path = item.get("file_path")
         if file_path:
             # Ficheiro local: usar diretamente
-            if not os.path.isfile(file_path):
+            if primed is None and not await asyncio.to_thread(os.path.isfile, file_path):  # Pode estar num disco de rede
                 print(f"[PLAYER] Ficheiro não encontrado: {file_path}")
-                bot.loop.call_soon_threadsafe(state.play_next.set)
+                release_local_file(guild.id, file_path)
+                loop.call_soon_threadsafe(state.play_next.set)
                 continue
             
+            if primed is not None:
+                audio, sink = primed, primed.sink
+            else:
+                sink = _FFmpegStderrSink(stream_tag(guild.id, item))
+                try:
+                    audio = make_audio_source(
+                        file_path,
+                        loudness.volume(LoudnessAnalyzer.key_for(item)),
+                        before_options=FFMPEG_BEFORE_OPTS_FILE,
+                        stderr=sink,
+                    )
+                except Exception as e:
+                    print(f"[PLAYER] Erro ao criar source: {e}")
+                    release_local_file(guild.id, file_path)
+                    loop.call_soon_threadsafe(state.play_next.set)
+                    continue
+
+            measured = _MeasuredSource(with_crossfade(audio, item, state), item)
+
+            def after_play_local(err, file_path: str = file_path, measured: _MeasuredSource = measured, sink=sink):
+                report_playback_error(err, measured, sink)
+                # Anexos: apaga o ficheiro se mais nenhum item da fila o usar
+                release_local_file(guild.id, file_path)
+                loop.call_soon_threadsafe(state.play_next.set)
+
+            voice.play(measured, after=after_play_local)
+            record_startup_latency("local-primed" if primed is not None else "local", time.monotonic() - started_at)
+            schedule_preopen(state)
+            await state.play_next.wait()
+            continue
+
+        # Ficheiro remoto: descarregar primeiro
+        play_url = item.get("webpage_url") or item.get("url")
+        if not play_url:
+            print(f"[PLAYER] Sem URL para: {item.get('title', '?')}")
+            loop.call_soon_threadsafe(state.play_next.set)
+            continue
+
+        # Streaming (opcional): só quando não há prefetch nem cache, ou seja, quando iria esperar pelo download todo
+        cache_key = item.get("cache_key")
+        if STREAM_MODE and prefetch is None and not (cache_key and audio_cache.contains(cache_key)):
+            stream = _StreamingDownload(guild.id, item)
+            state.current_download = stream
+            try:
+                buffered = await stream.wait_buffered(STREAM_BUFFER_BYTES, STREAM_START_TIMEOUT_SECONDS)
+            finally:
+                if state.current_download is stream:
+                    state.current_download = None
+            if stream.cancel_event.is_set():
+                # !skip / !stop durante o buffering
+                stream.finish_in_background()
+                loop.call_soon_threadsafe(state.play_next.set)
+                continue
+            sink = _FFmpegStderrSink(stream_tag(guild.id, item))
+            audio = stream.open_source(sink) if buffered else None
+            if audio is not None:
+                measured = _MeasuredSource(audio, item)
+
+                def after_stream(err, stream: _StreamingDownload = stream, measured: _MeasuredSource = measured, sink=sink):
+                    report_playback_error(err, measured, sink)
+                    stream.finish_in_background()
+                    loop.call_soon_threadsafe(state.play_next.set)
+
+                voice.play(measured, after=after_stream)
+                record_startup_latency("stream", time.monotonic() - started_at)
+                schedule_preopen(state)
+                await state.play_next.wait()
+                continue
+            # Fallback: download completo (caminho normal)
+            print(f"[PLAYER] Streaming falhou, a descarregar por completo: {item.get('title', '?')}")
+            stream.finish_in_background()
+
+        # Descarregar áudio para ficheiro (mais fiável que stream/pipe), ou usar a cache.
+        # Normalmente já foi obtido em background enquanto tocava a anterior.
+        if prefetch is None:
+            prefetch = _Prefetch(guild.id, item)
+        state.current_download = prefetch
+        try:
+            temp_path = await prefetch.task
+        finally:
+            if state.current_download is prefetch:
+                state.current_download = None
+        if not temp_path or not os.path.isfile(temp_path):
+            print(f"[PLAYER] Falha ao descarregar: {item.get('title', '?')}")
+            if primed is not None:
+                release_primed(primed)
+            loop.call_soon_threadsafe(state.play_next.set)
+            continue
+
+        if primed is not None:
+            audio, sink = primed, primed.sink
+        else:
+            sink = _FFmpegStderrSink(stream_tag(guild.id, item))
             try:
-                source = discord.FFmpegPCMAudio(
-                    file_path,
-                    executable=FFMPEG_EXECUTABLE,
-                    before_options=FFMPEG_BEFORE_OPTS_FILE,
-                    options=FFMPEG_OPTS,
-                    stderr=_FFmpegStderrSink(),
+                audio = make_audio_source(
+                    temp_path, loudness.volume(cache_key), before_options=FFMPEG_BEFORE_OPTS_FILE, stderr=sink
                 )
             except Exception as e:
                 print(f"[PLAYER] Erro ao criar source: {e}")
-                bot.loop.call_soon_threadsafe(state.play_next.set)
+                release_audio_file(temp_path)
+                loop.call_soon_threadsafe(state.play_next.set)
                 continue
 
-            audio = discord.PCMVolumeTransformer(source, volume=0.7)
+        measured = _MeasuredSource(with_crossfade(audio, item, state), item)
+
+        def after_play(err, path: str, measured: _MeasuredSource, sink: _FFmpegStderrSink):
+            report_playback_error(err, measured, sink)
+            # Ficheiro em cache fica para a próxima vez; temporário é apagado
+            release_audio_file(path)
+            loop.call_soon_threadsafe(state.play_next.set)
+
+        voice.play(measured, after=functools.partial(after_play, path=temp_path, measured=measured, sink=sink))
+        record_startup_latency("primed" if primed is not None else "download", time.monotonic() - started_at)
+        schedule_preopen(state)
+
+        await state.play_next.wait()
+
+
+metrics.gauge("musicbot_queue_depth", "Itens em espera em todas as filas", lambda: sum(len(st.queue) for st in guild_states.values()))
+metrics.gauge("musicbot_voice_clients", "Ligações de voz ativas", lambda: len(bot.voice_clients))
+metrics.gauge("musicbot_downloads_in_flight", "Downloads de áudio em curso", lambda: _downloads_in_flight)
+metrics.gauge("musicbot_extraction_pool_running", "Trabalhos a correr no pool de extração", lambda: extraction_pool.running)
+metrics.gauge("musicbot_extraction_pool_pending", "Trabalhos à espera no pool de extração", lambda: extraction_pool.pending)
+metrics.gauge("musicbot_temp_bytes", "Bytes em ficheiros temporários (última medição)", lambda: temp_janitor.usage)
+
+_metrics_server: Optional[asyncio.AbstractServer] = None
+
+
+async def _handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """HTTP mínimo: GET /metrics devolve as métricas em texto Prometheus."""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass  # ignora headers
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
 
-            # Verifica se é um ficheiro temporário de anexo (deve ser limpo após tocar)
-            is_temp_attachment = (
-                file_path.startswith(tempfile.gettempdir()) and 
-                os.path.basename(file_path).startswith("discord_bot_")
-            )
+async def start_metrics_server() -> None:
+    global _metrics_server
+    if METRICS_PORT <= 0 or _metrics_server is not None:
+        return
+    try:
+        _metrics_server = await asyncio.start_server(_handle_metrics_request, METRICS_HOST, METRICS_PORT)
+        print(f"[METRICS] http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        print(f"[METRICS] Não consegui abrir a porta {METRICS_PORT}: {e}")
 
-            def after_play_local(err):
-                if err:
-                    print(f"[PLAYER] Erro: {err}")
-                # Limpa ficheiros temporários de anexos
-                if is_temp_attachment:
-                    try:
-                        if os.path.isfile(file_path):
-                            os.remove(file_path)
-                    except OSError:
-                        pass
-                bot.loop.call_soon_threadsafe(state.play_next.set)
 
-            voice.play(audio, after=after_play_local)
-            await state.play_next.wait()
-            continue
+_queues_restored = False
 
-        # Ficheiro remoto: descarregar primeiro
-        play_url = item.get("webpage_url") or item.get("url")
-        if not play_url:
-            print(f"[PLAYER] Sem URL para: {item.get('title', '?')}")
-            bot.loop.call_soon_threadsafe(state.play_next.set)
-            continue
 
-        # Descarregar áudio para ficheiro temporário (mais fiável que stream/pipe)
-        temp_path = await asyncio.to_thread(download_audio_to_file, play_url)
-        if not temp_path or not os.path.isfile(temp_path):
-            print(f"[PLAYER] Falha ao descarregar: {item.get('title', '?')}")
-            bot.loop.call_soon_threadsafe(state.play_next.set)
+async def restore_queues() -> None:
+    """
+    Arranque: repõe as filas do journal e volta aos canais de voz onde o bot estava a tocar.
+    As ligações de voz são feitas em background, no máximo QUEUE_RESTORE_CONCURRENCY de cada vez.
+    """
+    global _queues_restored
+    if not queue_journal.enabled or _queues_restored:
+        return
+    _queues_restored = True
+    started = time.monotonic()
+    try:
+        saved = await asyncio.to_thread(queue_journal.load)
+    except OSError as e:
+        print(f"[JOURNAL] Não consegui ler {queue_journal.path}: {e}")
+        return
+    to_resume = []
+    for guild_id, g in saved.items():
+        guild = bot.get_guild(guild_id)
+        items = ([g["playing"]] if g.get("playing") else []) + list(g["items"].values())
+        if guild is None or not g.get("voice") or not items:
             continue
+        state = get_state(guild_id)
+        state.last_channel_id = g.get("text")
+        for item in items:
+            if AttachmentStore.is_attachment(item.get("file_path")):
+                attachment_store.adopt(guild_id, item["file_path"])
+        state.queue.restore(items)
+        to_resume.append((guild, g["voice"], len(items)))
+    queue_journal.compact_soon()  # o estado restaurado passa a ser o novo snapshot
+    print(f"[JOURNAL] {len(to_resume)} filas restauradas em {time.monotonic() - started:.2f}s")
 
-        try:
-            source = discord.FFmpegPCMAudio(
-                temp_path,
-                executable=FFMPEG_EXECUTABLE,
-                before_options=FFMPEG_BEFORE_OPTS_FILE,
-                options=FFMPEG_OPTS,
-                stderr=_FFmpegStderrSink(),
-            )
-        except Exception as e:
-            print(f"[PLAYER] Erro ao criar source: {e}")
+    semaphore = asyncio.Semaphore(max(QUEUE_RESTORE_CONCURRENCY, 1))
+
+    async def resume(guild: discord.Guild, channel_id: int, count: int) -> None:
+        state = get_state(guild.id)
+        channel = guild.get_channel(channel_id)
+        if not isinstance(channel, (discord.VoiceChannel, discord.StageChannel)):
+            return
+        async with semaphore:
             try:
-                os.remove(temp_path)
-            except OSError:
+                await connect_voice(guild, channel)
+            except commands.CommandError as e:
+                print(f"[JOURNAL] Não consegui voltar a {guild.name}/{channel.name}: {e}")
+                return
+        if state.audio_task is None or state.audio_task.done():
+            state.audio_task = asyncio.ensure_future(player_loop(guild))
+        schedule_prefetch(state)
+        touch_activity(guild.id)
+        text = guild.get_channel(state.last_channel_id) if state.last_channel_id else None
+        if isinstance(text, discord.TextChannel):
+            try:
+                await text.send(f"♻️ Voltei depois de um reinício; a continuar a fila ({count} músicas).")
+            except discord.HTTPException:
                 pass
-            bot.loop.call_soon_threadsafe(state.play_next.set)
-            continue
 
-        audio = discord.PCMVolumeTransformer(source, volume=0.7)
+    for guild, channel_id, count in to_resume:
+        spawn_background(resume(guild, channel_id, count))
 
-        def after_play(err, path: str):
-            if err:
-                print(f"[PLAYER] Erro: {err}")
-            try:
-                if path and os.path.isfile(path):
-                    os.remove(path)
-            except OSError:
-                pass
-            bot.loop.call_soon_threadsafe(state.play_next.set)
 
-        voice.play(audio, after=lambda e: after_play(e, temp_path))
+_app_commands_synced = False
+
+
+async def sync_app_commands() -> None:
+    """
+    Regista os slash commands no Discord, só se mudaram desde o último registo (o sync global tem
+    rate limit apertado e os comandos demoram a propagar). Só o primeiro processo de shards o faz.
+    """
+    global _app_commands_synced
+    if not SLASH_SYNC or _app_commands_synced or SHARD_INDEX > 0:
+        return
+    _app_commands_synced = True
+    payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    digest = hashlib.sha256(json.dumps([bot.application_id, payload], sort_keys=True).encode()).hexdigest()
+    try:
+        with open(APP_COMMANDS_HASH_FILE, encoding="utf-8") as f:
+            if f.read().strip() == digest:
+                return
+    except OSError:
+        pass
+    try:
+        synced = await bot.tree.sync()
+    except discord.HTTPException as e:
+        print(f"[SLASH] Erro ao registar os slash commands: {e}")
+        return
+    print(f"[SLASH] {len(synced)} slash commands registados")
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(APP_COMMANDS_HASH_FILE)), exist_ok=True)
+        with open(APP_COMMANDS_HASH_FILE, "w", encoding="utf-8") as f:
+            f.write(digest)
+    except OSError as e:
+        print(f"[SLASH] Não consegui gravar {APP_COMMANDS_HASH_FILE}: {e}")
+
+
+_temp_swept = False
 
-        await state.play_next.wait()
+
+async def sweep_temp_files() -> None:
+    """Arranque (depois de restaurar as filas, cujos anexos ficam): limpa temporários antigos e agenda o janitor."""
+    global _temp_swept
+    if _temp_swept:
+        return
+    _temp_swept = True
+    try:
+        files, size = await asyncio.to_thread(temp_janitor.sweep)
+    except OSError as e:
+        print(f"[TEMP] Erro ao limpar {temp_janitor.directory}: {e}")
+    else:
+        if files:
+            print(f"[TEMP] {files} ficheiros temporários antigos apagados ({size / 1024 / 1024:.1f} MB)")
+    if TEMP_JANITOR_INTERVAL_SECONDS > 0:
+        timers.schedule("temp-janitor", TEMP_JANITOR_INTERVAL_SECONDS, temp_janitor.run_periodic)
+
+
+@bot.event
+async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+    # Canal de voz do bot para o journal (saídas são registadas em !leave / inatividade,
+    # não aqui: ao desligar o processo o Discord também manda "saiu do canal")
+    if member.id == bot.user.id and after.channel is not None and after.channel != before.channel:
+        queue_journal.record(member.guild.id, "voice", channel=after.channel.id, text=get_state(member.guild.id).last_channel_id)
 
 
 @bot.event
 async def on_ready():
     print(f"Logado como {bot.user} (ID: {bot.user.id})")
-    bot.loop.create_task(inactivity_check_loop())
+    timers.start()
+    loop_monitor.start()
+    await start_metrics_server()
+    queue_journal.start()
+    await restore_queues()
+    await sweep_temp_files()
+    await sync_app_commands()
+    start_library_scan()
 
 
 @bot.command(name="join")
@@ -511,122 +4118,96 @@ async def join(ctx: commands.Context):
         await ctx.reply(str(e))
 
 
-@bot.command(name="play")
+@bot.hybrid_command(name="play", description="Toca ou adiciona à fila um link, uma pesquisa ou um ficheiro")
+@app_commands.describe(query="Link, playlist, título para pesquisar ou caminho de ficheiro")
+@app_commands.guild_only()
 async def play(ctx: commands.Context, *, query: str = ""):
     """
     Uso:
     !play <link do youtube>
+    !play <link de playlist> (até PLAYLIST_MAX_ENTRIES faixas; link de vídeo com list= toca só o vídeo: usa !playlist)
     !play <título / texto para pesquisar>
     !play <caminho para ficheiro MP3>
     Ou anexa um ficheiro de áudio com !play
+    Também como /play, com sugestões de títulos já tocados e da biblioteca local.
     """
     touch_activity(ctx.guild.id, ctx.channel.id)
-    if not _is_ffmpeg_available():
-        return await ctx.reply(
-            "⚠️ FFmpeg não encontrado. Para tocar áudio:\n"
-            "1. Descarrega: https://ffmpeg.org/download.html\n"
-            "2. Adiciona a pasta **bin** ao PATH do sistema,\n"
-            "   ou no `.env` define: `FFMPEG_PATH=C:\\caminho\\para\\ffmpeg.exe`"
-        )
-    missing_voice_libs = _missing_voice_libraries()
-    if missing_voice_libs:
-        pip_pkgs = " ".join("PyNaCl" if lib == "PyNaCl" else "davey" for lib in missing_voice_libs)
-        return await ctx.reply(
-            f"⚠️ Dependências de voz em falta: {', '.join(missing_voice_libs)}.\n"
-            f"Instala com: `pip install {pip_pkgs}`"
-        )
+    if ctx.interaction is not None:
+        await ctx.defer(ephemeral=True)  # A resolução pode passar dos 3 s que o Discord dá para responder
+    problem = playback_unavailable()
+    if problem:
+        return await ctx.reply(problem)
     try:
         voice = await ensure_voice(ctx)
     except commands.CommandError as e:
         return await ctx.reply(str(e))
-    state = get_state(ctx.guild.id)
-
-    # cria o loop do player uma vez por servidor
-    if state.audio_task is None or state.audio_task.done():
-        state.audio_task = bot.loop.create_task(player_loop(ctx.guild))
+    state = start_player(ctx.guild)
 
     # Verifica se há anexos (ficheiros) na mensagem
     SUPPORTED_AUDIO_EXT = ('.mp3', '.m4a', '.wav', '.flac', '.ogg', '.opus', '.aac')
     if ctx.message.attachments:
-        infos: list[dict] = []
+        audio_attachments = []
         for attachment in ctx.message.attachments:
             ext = os.path.splitext(attachment.filename)[1].lower() if attachment.filename else ""
             if ext not in SUPPORTED_AUDIO_EXT:
                 continue  # skip unsupported attachments
-            temp_path = os.path.join(tempfile.gettempdir(), f"discord_bot_{uuid.uuid4().hex}{ext}")
-            try:
-                await attachment.save(temp_path)
-            except Exception as e:
-                raise commands.CommandError(f"Erro ao descarregar o ficheiro {attachment.filename}: {e}")
+            audio_attachments.append((attachment, ext))
+        if not audio_attachments:
+            raise commands.CommandError(
+                f"Nenhum ficheiro de áudio nos anexos. Formatos suportados: MP3, M4A, WAV, FLAC, OGG, OPUS, AAC"
+            )
+        # Todos em paralelo (limitado por ATTACHMENT_CONCURRENCY); a ordem da fila é a da mensagem
+        results = await asyncio.gather(
+            *(attachment_store.fetch(ctx.guild.id, attachment, ext) for attachment, ext in audio_attachments),
+            return_exceptions=True,
+        )
+        infos: list[dict] = []
+        errors: list[str] = []
+        for (attachment, _ext), result in zip(audio_attachments, results):
+            if isinstance(result, BaseException):
+                errors.append(str(result) if isinstance(result, commands.CommandError) else f"{attachment.filename}: {result}")
+                continue
             infos.append({
                 "title": attachment.filename or "Ficheiro anexado",
                 "webpage_url": None,
                 "url": None,
-                "file_path": temp_path,
+                "file_path": result,
                 "duration": None,
             })
         if not infos:
-            raise commands.CommandError(
-                f"Nenhum ficheiro de áudio nos anexos. Formatos suportados: MP3, M4A, WAV, FLAC, OGG, OPUS, AAC"
-            )
+            raise commands.CommandError("\n".join(errors))
         # Add all to queue; we'll use the first as "info" for the legacy single-item path, then add the rest
         info = infos[0]
         for i in infos:
-            await state.queue.put(i)
-            state.queue_list.append(i)
-        # Build reply and skip the single put/append below
-        queue_display = state.get_queue_display()
-        total_items = len(queue_display)
+            state.queue.put(i)
+        schedule_prefetch(state)
+        # A fila aparece na mensagem de estado; só os erros têm resposta própria
         if len(infos) == 1:
-            msg = f"✅ Adicionado à fila: **{info['title']}**"
+            note = f"✅ Adicionado à fila: **{_short_title(info['title'])}** ({ctx.author.display_name})"
         else:
-            msg = f"✅ Adicionados **{len(infos)}** ficheiros à fila:\n"
-            for idx, it in enumerate(infos, 1):
-                msg += f"  {idx}. {it['title']}\n"
-        msg += f"\n📋 **Fila ({total_items} {'item' if total_items == 1 else 'itens'}):**"
-        for idx, queue_item in enumerate(queue_display, 1):
-            prefix = "▶️" if idx == 1 and state.currently_playing == queue_item else f"{idx}."
-            title = queue_item.get('title', 'Sem título')
-            msg += f"\n{prefix} {title}"
-        await ctx.reply(msg)
-        if voice and not voice.is_playing() and not voice.is_paused():
-            pass
+            note = f"✅ {len(infos)} ficheiros adicionados à fila ({ctx.author.display_name})"
+        request_status(state, note)
+        await acknowledge_interaction(ctx, note)
+        if errors:
+            await ctx.reply("⚠️ Não adicionados:\n" + "\n".join(f"  • {err}" for err in errors[:5]))
         return
     elif query.strip():
-        # Verifica se é um ficheiro local primeiro
-        if is_local_file(query):
-            info = await asyncio.to_thread(get_file_info, query)
-            if not info:
-                raise commands.CommandError(f"Ficheiro não encontrado ou formato não suportado: {query}")
-        else:
-            # Tenta obter info do YouTube/outras fontes
-            try:
-                info = await asyncio.to_thread(extract_info, query)
-            except Exception as e:
-                raise commands.CommandError(f"Não consegui obter esse áudio. Detalhes: {e}")
+        if is_playlist_url(query):
+            return await enqueue_playlist(ctx, state, query.strip())
+        info = await resolve_play_query(ctx.guild.id, query)
     else:
         raise commands.CommandError("Fornece um link, pesquisa, caminho de ficheiro, ou anexa um ficheiro de áudio!")
 
-    await state.queue.put(info)
-    state.queue_list.append(info)
+    enqueue_resolved(state, info)
 
-    # Constrói mensagem com a fila
-    queue_display = state.get_queue_display()
-    total_items = len(queue_display)
-    
-    msg = f"✅ Adicionado à fila: **{info['title']}**"
+    # Sem resposta própria: vários !play seguidos dão uma só edição da mensagem de estado
+    note = f"✅ Adicionado à fila: **{_short_title(info['title'])}** ({ctx.author.display_name})"
     if info.get("webpage_url"):
-        msg += f"\n🔗 {info['webpage_url']}"
-    
-    # Mostra a fila se houver mais de 1 item
-    if total_items > 1:
-        msg += f"\n\n📋 **Fila ({total_items} {'item' if total_items == 1 else 'itens'}):**"
-        for idx, queue_item in enumerate(queue_display, 1):
-            prefix = "▶️" if idx == 1 and state.currently_playing == queue_item else f"{idx}."
-            title = queue_item.get('title', 'Sem título')
-            msg += f"\n{prefix} {title}"
-    
-    await ctx.reply(msg)
+        note += f"\n🔗 <{info['webpage_url']}>"
+    if is_playlist_url(query, explicit=True):
+        note += "\n💡 Para adicionar a playlist toda: `!playlist <link>`"
+    request_status(state, note)
+    await acknowledge_interaction(ctx, note)
 
     # Se não está a tocar, força começar (às vezes o voice pode estar parado)
     if voice and not voice.is_playing() and not voice.is_paused():
@@ -634,15 +4215,230 @@ async def play(ctx: commands.Context, *, query: str = ""):
         pass
 
 
+def playback_unavailable() -> Optional[str]:
+    """Mensagem para o utilizador se faltar o FFmpeg ou as bibliotecas de voz (None se estiver tudo bem)."""
+    if not _is_ffmpeg_available():
+        return (
+            "⚠️ FFmpeg não encontrado. Para tocar áudio:\n"
+            "1. Descarrega: https://ffmpeg.org/download.html\n"
+            "2. Adiciona a pasta **bin** ao PATH do sistema,\n"
+            "   ou no `.env` define: `FFMPEG_PATH=C:\\caminho\\para\\ffmpeg.exe`"
+        )
+    missing_voice_libs = _missing_voice_libraries()
+    if missing_voice_libs:
+        pip_pkgs = " ".join("PyNaCl" if lib == "PyNaCl" else "davey" for lib in missing_voice_libs)
+        return (
+            f"⚠️ Dependências de voz em falta: {', '.join(missing_voice_libs)}.\n"
+            f"Instala com: `pip install {pip_pkgs}`"
+        )
+    return None
+
+
+def start_player(guild: discord.Guild) -> GuildMusicState:
+    """Estado do servidor, com o loop do player a correr (criado uma vez por servidor)."""
+    state = get_state(guild.id)
+    if state.audio_task is None or state.audio_task.done():
+        state.audio_task = bot.loop.create_task(player_loop(guild))
+    return state
+
+
+async def resolve_play_query(guild_id: int, query: str) -> dict:
+    """Item da fila para um texto do !play: ficheiro local, biblioteca local ou pesquisa/link. Lança CommandError."""
+    if query.strip().startswith(TitleIndex.TOKEN_PREFIX):
+        # Sugestão do autocomplete do /play (id opaco de um ficheiro da biblioteca)
+        path = title_index.resolve_token(query)
+        if path is None:
+            raise commands.CommandError("Essa sugestão já não está disponível. Escreve o título da música.")
+        query = path
+    if is_local_file(query):
+        info = await asyncio.to_thread(get_file_info, query)
+        if not info:
+            raise commands.CommandError(f"Ficheiro não encontrado ou formato não suportado: {query}")
+        return info
+    # Biblioteca local primeiro (sem rede), mas nunca para links: as palavras do URL não podem trocar o link por outra faixa
+    is_link = query.strip().startswith(("http://", "https://"))
+    if not is_link and (local_matches := await asyncio.to_thread(local_library.search, query)):
+        return local_matches[0]
+    # Tenta obter info do YouTube/outras fontes (pesquisas repetidas vêm da cache)
+    try:
+        return await resolve_query(guild_id, query)
+    except commands.CommandError:
+        raise
+    except Exception as e:
+        raise commands.CommandError(f"Não consegui obter esse áudio. Detalhes: {e}")
+
+
+_PLAYMANY_BULLET_RE = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+")
+
+
+@bot.command(name="playmany")
+async def playmany(ctx: commands.Context, *, text: str = ""):
+    """
+    Várias músicas de uma vez, uma por linha (links ou pesquisas; listas com "-" ou "1." também servem):
+    !playmany
+    artista - música
+    https://youtu.be/...
+    As linhas são resolvidas em paralelo (PLAYMANY_CONCURRENCY) e entram na fila pela ordem da mensagem,
+    cada uma assim que ela e as anteriores estão prontas.
+    """
+    touch_activity(ctx.guild.id, ctx.channel.id)
+    lines = [(number, _PLAYMANY_BULLET_RE.sub("", line).strip()) for number, line in enumerate(text.splitlines(), 1)]
+    lines = [(number, line) for number, line in lines if line]
+    if not lines:
+        raise commands.CommandError("Escreve uma música ou link por linha, a seguir ao `!playmany`.")
+    if len(lines) > PLAYMANY_MAX_LINES:
+        raise commands.CommandError(f"Máximo de {PLAYMANY_MAX_LINES} linhas por `!playmany` (recebi {len(lines)}).")
+    problem = playback_unavailable()
+    if problem:
+        return await ctx.reply(problem)
+    try:
+        await ensure_voice(ctx)
+    except commands.CommandError as e:
+        return await ctx.reply(str(e))
+    state = start_player(ctx.guild)
+
+    # Sem passar o limite de pesquisas pendentes por servidor do pool (senão PoolBusyError a meio)
+    semaphore = asyncio.Semaphore(max(min(PLAYMANY_CONCURRENCY, EXTRACT_MAX_PENDING_PER_GUILD), 1))
+
+    async def resolve(line: str) -> dict:
+        if is_playlist_url(line):
+            raise commands.CommandError("playlists só com `!play`")
+        async with semaphore:
+            return await resolve_play_query(ctx.guild.id, line)
+
+    started = time.monotonic()
+    tasks = [asyncio.ensure_future(resolve(line)) for _number, line in lines]
+    added = 0
+    failures: list[str] = []
+    try:
+        # Esperar pela ordem da mensagem: cada linha entra na fila logo que ela e as anteriores estão resolvidas
+        for (number, line), task in zip(lines, tasks):
+            try:
+                info = await task
+            except Exception as e:  # CommandError com a mensagem para o utilizador ou erro do extrator
+                failures.append(f"linha {number} (`{_short_title(line, 60)}`): {e}")
+                continue
+            enqueue_resolved(state, info)
+            added += 1
+    finally:
+        for task in tasks:
+            task.cancel()  # Comando interrompido: não deixar pesquisas a correr para nada
+    print(f"[PLAYMANY] {len(lines)} linhas em {time.monotonic() - started:.1f}s ({len(failures)} falhadas)")
+    if added:
+        request_status(state, f"✅ {added} músicas adicionadas à fila ({ctx.author.display_name})")
+    if failures:
+        shown = failures[:10]
+        if len(failures) > len(shown):
+            shown.append(f"… e mais {len(failures) - len(shown)}")
+        await ctx.reply(f"⚠️ {len(failures)} de {len(lines)} não adicionadas:\n" + "\n".join(shown))
+
+
+@play.autocomplete("query")
+async def play_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+    """Sugestões do índice em memória (sem rede: tem de responder bem dentro dos ~3 s do Discord)."""
+    started = time.perf_counter()
+    choices = []
+    for title, value in title_index.search(current, 25):
+        # Caminhos locais vão como id opaco; links acima do limite de 100 caracteres do Discord vão pelo título
+        public = title_index.public_value(value) or title
+        choices.append(app_commands.Choice(name=_short_title(title, 100), value=public if len(public) <= 100 else title[:100]))
+    AUTOCOMPLETE_SECONDS.observe(time.perf_counter() - started)
+    return choices
+
+
+async def acknowledge_interaction(ctx: commands.Context, note: str) -> None:
+    """Um slash command tem sempre de ter resposta; com prefixo fica só a mensagem de estado."""
+    if ctx.interaction is not None:
+        await ctx.reply(note, ephemeral=True)
+
+
+async def enqueue_playlist(ctx: commands.Context, state: GuildMusicState, url: str) -> None:
+    """
+    Adiciona as entradas de uma playlist à fila (leves; resolvidas perto de tocar), PLAYLIST_PAGE_SIZE de
+    cada vez: as primeiras já tocam enquanto as seguintes são extraídas, e a mensagem mostra o progresso.
+    """
+    progress = await ctx.reply("🔄 A carregar playlist...")
+    page_size = max(min(PLAYLIST_PAGE_SIZE, PLAYLIST_MAX_ENTRIES), 1)
+    added = 0
+    title: Optional[str] = None
+    total = 0
+    error: Optional[str] = None
+    while added < PLAYLIST_MAX_ENTRIES:
+        try:
+            page = await extraction_pool.run(
+                ctx.guild.id,
+                extract_playlist,
+                url,
+                min(page_size, PLAYLIST_MAX_ENTRIES - added),
+                added + 1,
+                timeout=EXTRACT_TIMEOUT_SECONDS,
+            )
+        except asyncio.TimeoutError:
+            error = "Demorou demasiado a carregar a playlist. Tenta novamente."
+            break
+        except commands.CommandError as e:
+            error = str(e)
+            break
+        except Exception as e:
+            error = f"Não consegui carregar essa playlist. Detalhes: {e}"
+            break
+        title = title or page["title"]
+        total = max(total, page["total"])
+        for item in page["items"]:
+            state.queue.put(item)
+        added += len(page["items"])
+        if page["items"]:
+            schedule_prefetch(state)
+        if len(page["items"]) < page_size or (total and added >= total):
+            break  # Última página
+        await progress.edit(content=f"🔄 A carregar playlist **{title or 'sem nome'}**: {added} faixas adicionadas...")
+    if not added:
+        return await progress.edit(content=f"⚠️ {error or 'A playlist está vazia ou não está acessível.'}")
+    msg = f"✅ Playlist **{title or 'sem nome'}**: {added} faixas adicionadas à fila"
+    if total > added and not error:
+        msg += f" (de {total}; limite {PLAYLIST_MAX_ENTRIES} por pedido)"
+    if error:
+        msg += f"\n⚠️ O resto não foi carregado: {error}"
+    msg += f"\n📋 Fila: {len(state.queue)} {'item' if len(state.queue) == 1 else 'itens'} em espera"
+    await progress.edit(content=msg)
+
+
+@bot.command(name="playlist")
+async def playlist(ctx: commands.Context, *, url: str = ""):
+    """
+    Adiciona uma playlist inteira, mesmo a partir de um link de vídeo (watch?v=…&list=…).
+    O !play com esse link toca só o vídeo. Mixes automáticos do YouTube (list=RD…) não são suportados.
+    """
+    touch_activity(ctx.guild.id, ctx.channel.id)
+    url = url.strip().strip("<>")
+    if not is_playlist_url(url, explicit=True):
+        raise commands.CommandError("Usa `!playlist <link de playlist>` (mixes automáticos do YouTube não servem).")
+    problem = playback_unavailable()
+    if problem:
+        return await ctx.reply(problem)
+    try:
+        await ensure_voice(ctx)
+    except commands.CommandError as e:
+        return await ctx.reply(str(e))
+    await enqueue_playlist(ctx, start_player(ctx.guild), url)
+
+
 @bot.command(name="skip")
 async def skip(ctx: commands.Context):
     touch_activity(ctx.guild.id, ctx.channel.id)
     voice = ctx.voice_client
     if not voice or not voice.is_connected():
         return await ctx.reply("Não estou ligado a nenhum canal de voz.")
+    state = get_state(ctx.guild.id)
+    title = _short_title((state.currently_playing or {}).get("title"))
     if voice.is_playing():
         voice.stop()
-        await ctx.reply("⏭️ Skip.")
+        request_status(state, f"⏭️ Skip: {title} ({ctx.author.display_name})")
+    elif state.current_download is not None:
+        # Ainda a descarregar a próxima: cancela o download (o player passa à seguinte)
+        state.current_download.cancel()
+        state.current_download = None
+        request_status(state, f"⏭️ Skip: {title} ({ctx.author.display_name})")
     else:
         await ctx.reply("Não estou a tocar nada.")
 
@@ -676,23 +4472,15 @@ async def stop(ctx: commands.Context):
     if not voice or not voice.is_connected():
         return await ctx.reply("Não estou ligado a nenhum canal de voz.")
 
-    # esvazia a fila
+    # esvazia a fila e cancela downloads em background (apaga ficheiros já descarregados)
     state = get_state(ctx.guild.id)
-    while not state.queue.empty():
-        try:
-            state.queue.get_nowait()
-            state.queue.task_done()
-        except asyncio.QueueEmpty:
-            break
-    
-    # Limpa a lista de fila também
-    state.queue_list.clear()
+    clear_queue(state)
     state.currently_playing = None
 
     if voice.is_playing() or voice.is_paused():
         voice.stop()
 
-    await ctx.reply("⏹️ Parei e limpei a fila.")
+    request_status(state, f"⏹️ Parei e limpei a fila ({ctx.author.display_name})")
 
 
 @bot.command(name="leave")
@@ -700,6 +4488,11 @@ async def leave(ctx: commands.Context):
     touch_activity(ctx.guild.id, ctx.channel.id)
     voice = ctx.voice_client
     if voice and voice.is_connected():
+        queue_journal.record(ctx.guild.id, "leave")
+        state = get_state(ctx.guild.id)
+        clear_queue(state)  # Sem voz o player só ia descartar os itens
+        state.status_message = None  # Na próxima vez começa uma mensagem de estado nova
+        state.status_notes.clear()
         await voice.disconnect()
         await ctx.reply("Saí do canal de voz 👋")
     else:
@@ -707,24 +4500,335 @@ async def leave(ctx: commands.Context):
 
 
 @bot.command(name="queue")
-async def queue_cmd(ctx: commands.Context):
-    """Mostra a fila de música atual."""
+async def queue_cmd(ctx: commands.Context, page: int = 1):
+    """Mostra a fila de música atual (paginada: !queue <página>)."""
     touch_activity(ctx.guild.id, ctx.channel.id)
     state = get_state(ctx.guild.id)
-    queue_display = state.get_queue_display()
     
-    if not queue_display:
+    if not _queue_total_items(state):
         return await ctx.reply("📋 A fila está vazia.")
     
-    total_items = len(queue_display)
-    msg = f"📋 **Fila ({total_items} {'item' if total_items == 1 else 'itens'}):**\n\n"
-    
-    for idx, item in enumerate(queue_display, 1):
-        prefix = "▶️" if idx == 1 and state.currently_playing == item else f"{idx}."
-        title = item.get('title', 'Sem título')
-        msg += f"{prefix} {title}\n"
-    
-    await ctx.reply(msg)
+    content, view = queue_page_message(state, page - 1)
+    await ctx.reply(content, view=view)
+
+
+QUEUE_PAGE_SIZE = 10  # Itens por página do !queue (mantém a mensagem abaixo dos 2000 caracteres)
+
+
+def _format_duration(seconds: Optional[float]) -> str:
+    if not seconds:
+        return "?"
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
+
+
+def _short_title(title: Optional[str], limit: int = 80) -> str:
+    title = title or "Sem título"
+    return title if len(title) <= limit else title[:limit - 1] + "…"
+
+
+def _queue_total_items(state: GuildMusicState) -> int:
+    return len(state.queue) + (1 if state.currently_playing else 0)
+
+
+def render_queue_page(state: GuildMusicState, page: int) -> tuple[str, int, int]:
+    """
+    Texto de uma página da fila (a música atual aparece sempre no topo).
+    Só percorre os itens da página; totais vêm dos contadores da TrackQueue.
+    Devolve (texto, página efetiva, nº de páginas).
+    """
+    queue = state.queue
+    current = state.currently_playing
+    pages = max(1, -(-len(queue) // QUEUE_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+
+    total_items = _queue_total_items(state)
+    total_duration = queue.total_duration + int((current or {}).get("duration") or 0)
+    unknown = queue.unknown_durations + (1 if current and not current.get("duration") else 0)
+    duration_text = _format_duration(total_duration) if total_duration else "?"
+    if total_duration and unknown:
+        duration_text += "+"
+    header = f"📋 **Fila ({total_items} {'item' if total_items == 1 else 'itens'} · {duration_text})**"
+    if pages > 1:
+        header += f" — página {page + 1}/{pages}"
+    lines = [header]
+    if current:
+        lines.append(f"▶️ {_short_title(current.get('title'))} [{_format_duration(current.get('duration'))}]")
+    offset = 2 if current else 1  # numeração igual à do !remove / !move
+    start = page * QUEUE_PAGE_SIZE
+    for idx, item in enumerate(queue.snapshot()[start:start + QUEUE_PAGE_SIZE], start + offset):
+        lines.append(f"{idx}. {_short_title(item.get('title'))} [{_format_duration(item.get('duration'))}]")
+    return "\n".join(lines), page, pages
+
+
+class QueuePaginator(discord.ui.View):
+    """Botões ◀️ / ▶️ para navegar nas páginas da fila (renderiza só a página pedida)."""
+
+    def __init__(self, state: GuildMusicState, page: int, pages: int):
+        super().__init__(timeout=180)
+        self.state = state
+        self.page = page
+        self._update_buttons(pages)
+
+    def _update_buttons(self, pages: int) -> None:
+        self.previous_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= pages - 1
+
+    async def _show(self, interaction: discord.Interaction, page: int) -> None:
+        content, self.page, pages = render_queue_page(self.state, page)
+        self._update_buttons(pages)
+        await interaction.response.edit_message(content=content, view=self)
+
+    @discord.ui.button(emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page + 1)
+
+
+def queue_page_message(state: GuildMusicState, page: int) -> tuple[str, Optional[discord.ui.View]]:
+    """Conteúdo de uma página da fila e, se houver mais páginas, a View de navegação."""
+    content, page, pages = render_queue_page(state, page)
+    return content, (QueuePaginator(state, page, pages) if pages > 1 else None)
+
+
+def request_status(state: GuildMusicState, note: Optional[str] = None) -> None:
+    """
+    Pede uma atualização da mensagem de estado do servidor (no canal do último comando).
+    Pedidos seguidos (ex.: 20 !play) dão uma só edição, feita quando param durante
+    STATUS_DEBOUNCE_SECONDS ou, em rajadas longas, STATUS_MAX_DELAY_SECONDS depois do primeiro.
+    """
+    if note:
+        state.status_notes.append(note)
+    STATUS_UPDATES.inc(kind="requested")
+    now = time.monotonic()
+    if state.status_pending_since is None:
+        state.status_pending_since = now
+    delay = min(STATUS_DEBOUNCE_SECONDS, state.status_pending_since + STATUS_MAX_DELAY_SECONDS - now)
+    timers.schedule(("status", state.guild_id), max(delay, 0.0), functools.partial(flush_status, state.guild_id))
+
+
+def render_status(state: GuildMusicState) -> tuple[str, Optional[discord.ui.View]]:
+    lines = list(state.status_notes)
+    if _queue_total_items(state):
+        content, view = queue_page_message(state, 0)
+    else:
+        content, view = "📋 A fila está vazia.", None
+    text = "\n".join(lines + [""] + [content]) if lines else content
+    return text[:2000], view
+
+
+async def flush_status(guild_id: int) -> None:
+    """Timer do request_status: edita a mensagem de estado (ou envia uma nova se não houver/for antiga)."""
+    state = guild_states.get(guild_id)
+    if state is None or state.status_pending_since is None:
+        return
+    channel = bot.get_channel(state.last_channel_id) if state.last_channel_id else None
+    if not isinstance(channel, discord.abc.Messageable):
+        state.status_pending_since = None
+        return
+    async with state.status_lock:
+        state.status_pending_since = None  # Pedidos a partir daqui agendam nova edição
+        content, view = render_status(state)
+        old = state.status_message
+        try:
+            if (
+                old is not None
+                and old.channel.id == channel.id
+                and time.monotonic() - state.status_posted_at < STATUS_REPOST_SECONDS
+            ):
+                try:
+                    await old.edit(content=content, view=view)
+                    STATUS_UPDATES.inc(kind="edit")
+                    return
+                except discord.NotFound:
+                    old = None  # Apagada por alguém: envia outra
+            state.status_message = await channel.send(content, view=view)
+            state.status_posted_at = time.monotonic()
+            STATUS_UPDATES.inc(kind="send")
+        except discord.HTTPException as e:
+            print(f"[STATUS] Erro ao atualizar a mensagem de estado em {guild_id}: {e}")
+            return
+        if old is not None:
+            # A antiga ficou lá em cima com informação desatualizada
+            spawn_background(_delete_message_quietly(old))
+
+
+async def _delete_message_quietly(message: discord.Message) -> None:
+    try:
+        await message.delete()
+    except discord.HTTPException:
+        pass
+
+
+def _queue_index(state: GuildMusicState, position: int) -> Optional[int]:
+    """
+    Converte a posição mostrada no !queue (1 = a tocar, se houver) no índice da fila.
+    None se a posição não corresponder a um item em espera.
+    """
+    index = position - 1 - (1 if state.currently_playing else 0)
+    if index < 0 or index >= len(state.queue):
+        return None
+    return index
+
+
+@bot.command(name="remove")
+async def remove_cmd(ctx: commands.Context, position: int):
+    """Remove da fila o item na posição indicada (numeração do !queue)."""
+    touch_activity(ctx.guild.id, ctx.channel.id)
+    state = get_state(ctx.guild.id)
+    if position == 1 and state.currently_playing:
+        return await ctx.reply("Essa está a tocar agora. Usa `!skip` para a saltar.")
+    index = _queue_index(state, position)
+    item = state.queue.at(index) if index is not None else None
+    if item is None:
+        return await ctx.reply("Posição inválida. Vê as posições com `!queue`.")
+    state.queue.remove(item["qid"])
+    discard_item(state.guild_id, item)
+    schedule_prefetch(state)
+    await ctx.reply(f"🗑️ Removido da fila: **{item.get('title', 'Sem título')}**")
+
+
+@bot.command(name="move")
+async def move_cmd(ctx: commands.Context, from_position: int, to_position: int):
+    """Move um item da fila para outra posição (numeração do !queue)."""
+    touch_activity(ctx.guild.id, ctx.channel.id)
+    state = get_state(ctx.guild.id)
+    index = _queue_index(state, from_position)
+    item = state.queue.at(index) if index is not None else None
+    if item is None:
+        return await ctx.reply("Posição inválida. Vê as posições com `!queue`.")
+    offset = 1 if state.currently_playing else 0
+    target = min(max(to_position - 1 - offset, 0), len(state.queue) - 1)
+    state.queue.move(item["qid"], target)
+    schedule_prefetch(state)
+    await ctx.reply(f"↕️ **{item.get('title', 'Sem título')}** movido para a posição {target + 1 + offset}.")
+
+
+@bot.command(name="shuffle")
+async def shuffle_cmd(ctx: commands.Context):
+    """Baralha a ordem da fila (a música atual continua a tocar)."""
+    touch_activity(ctx.guild.id, ctx.channel.id)
+    state = get_state(ctx.guild.id)
+    if len(state.queue) < 2:
+        return await ctx.reply("Não há músicas suficientes na fila para baralhar.")
+    state.queue.shuffle()
+    schedule_prefetch(state)
+    await ctx.reply(f"🔀 Fila baralhada ({len(state.queue)} itens).")
+
+
+@bot.command(name="library")
+async def library_cmd(ctx: commands.Context, action: str = ""):
+    """Estado da biblioteca local; `!library rescan` (admin) volta a indexar os ficheiros alterados."""
+    if not local_library.enabled:
+        return await ctx.reply("Biblioteca local desativada (define LIBRARY_DIRS no .env).")
+    if action.lower() == "rescan":
+        if not ctx.author.guild_permissions.administrator:
+            raise commands.MissingPermissions(["administrator"])
+        if local_library.scanning:
+            return await ctx.reply("⏳ Já está a indexar.")
+        message = await ctx.reply("🔎 A indexar a biblioteca…")
+        result = await asyncio.to_thread(local_library.scan)
+        if result is None:
+            return await message.edit(content="⏳ Já está a indexar.")
+        return await message.edit(
+            content=f"✅ {result['files']} ficheiros ({result['updated']} novos/alterados, "
+            f"{result['removed']} removidos) em {result['seconds']:.1f}s."
+        )
+    stats = await asyncio.to_thread(local_library.stats)
+    lines = [
+        f"📚 **{stats['tracks']}** faixas ({_format_duration(stats.get('seconds'))}) em {len(local_library.dirs)} pasta(s)",
+        f"Pesquisa: {'FTS5' if local_library.fts else 'LIKE'}" + (" — a indexar…" if local_library.scanning else ""),
+    ]
+    if local_library.last_scan:
+        scan = local_library.last_scan
+        lines.append(
+            f"Último scan: {scan['updated']} novos/alterados, {scan['removed']} removidos em {scan['seconds']:.1f}s"
+        )
+    await ctx.reply("\n".join(lines))
+
+
+@bot.command(name="cacheinfo")
+async def cacheinfo(ctx: commands.Context):
+    """Mostra estatísticas das caches (metadados e áudio)."""
+    meta = metadata_cache.stats()
+    audio = audio_cache.stats()
+    lines = [
+        f"Metadados: {meta['entries']} entradas, {meta['hits']} hits / {meta['misses']} misses",
+    ]
+    if audio_cache.enabled:
+        lines.append(
+            f"Áudio ({audio['policy'].upper()}): {audio['entries']} ficheiros, "
+            f"{audio['bytes'] / 1024 / 1024:.1f} / {audio['max_bytes'] / 1024 / 1024:.0f} MB, "
+            f"{audio['hits']} hits / {audio['misses']} misses"
+        )
+    else:
+        lines.append("Áudio: cache desativada")
+    if loudness.enabled:
+        level = loudness.stats()
+        lines.append(f"Loudness: {level['entries']} faixas analisadas, {level['pending']} em análise")
+    temp = temp_janitor.stats()
+    limit = f"{temp['max_bytes'] / 1024 / 1024:.0f} MB" if temp["max_bytes"] else "sem limite"
+    lines.append(
+        f"Temporários: {temp['bytes'] / 1024 / 1024:.1f} MB / {limit}, {temp['owned']} em uso, "
+        f"{temp['removed_files']} apagados ({temp['removed_bytes'] / 1024 / 1024:.1f} MB), {temp['refused']} recusados"
+    )
+    await ctx.reply("```\n" + "\n".join(lines) + "\n```")
+
+
+@bot.command(name="stats")
+@commands.has_permissions(administrator=True)
+async def stats_cmd(ctx: commands.Context):
+    """(Admin) Latências por etapa e estado atual do bot."""
+    lines = []
+    for hist in metrics.histograms.values():
+        for labels, count, avg, p50, p99 in sorted(hist.summaries()):
+            label = ",".join(v for _k, v in labels)
+            name = hist.name.removeprefix("musicbot_").removesuffix("_seconds")
+            lines.append(f"{name}{f'[{label}]' if label else ''}: n={count} média={avg:.2f}s p50={p50:.2f}s p99={p99:.2f}s")
+    for counter in metrics.counters.values():
+        for labels, value in sorted(counter.values().items()):
+            label = ",".join(v for _k, v in labels)
+            lines.append(f"{counter.name.removeprefix('musicbot_')}{f'[{label}]' if label else ''}: {value:g}")
+    for gauge in metrics.gauges.values():
+        lines.append(f"{gauge.name.removeprefix('musicbot_')}: {gauge.value():g}")
+    text = "\n".join(lines) or "Sem dados ainda."
+    if len(text) > 1900:
+        text = text[:1900] + "\n…"
+    await ctx.reply("```\n" + text + "\n```")
+
+
+@bot.command(name="perf")
+@commands.has_permissions(administrator=True)
+async def perf_cmd(ctx: commands.Context, detail: int = 0):
+    """(Admin) Lag do event loop e bloqueios recentes; `!perf <n>` mostra a stack do n-ésimo bloqueio."""
+    lines = []
+    lag = loop_monitor.summary()
+    if lag is None:
+        lines.append("Lag do event loop: sem amostras (monitor desligado?)")
+    else:
+        lines.append(
+            f"Lag do event loop (últimas {len(loop_monitor.recent)} amostras): "
+            f"p50={lag[0] * 1000:.1f}ms p99={lag[1] * 1000:.1f}ms máx={lag[2] * 1000:.0f}ms"
+        )
+    events = list(loop_monitor.events)[::-1]  # Mais recente primeiro
+    lines.append(f"Bloqueios > {SLOW_CALLBACK_SECONDS * 1000:.0f}ms: {len(events)} recentes")
+    if 1 <= detail <= len(events):
+        event = events[detail - 1]
+        lines.append(f"#{detail}: {event.duration * 1000:.0f}ms às {time.strftime('%H:%M:%S', time.localtime(event.at))}")
+        lines.extend(line.rstrip() for line in event.stack[-8:])
+    else:
+        for n, event in enumerate(events[:10], 1):
+            where = event.stack[-1].strip().splitlines()[0] if event.stack else "?"
+            lines.append(f"#{n} {event.duration * 1000:.0f}ms {time.strftime('%H:%M:%S', time.localtime(event.at))} {where}")
+    text = "\n".join(lines)
+    if len(text) > 1900:
+        text = text[-1900:]
+    await ctx.reply("```\n" + text + "\n```")
 
 
 @bot.command(name="voiceinfo")
@@ -771,6 +4875,24 @@ async def voiceinfo(ctx: commands.Context):
             info_lines.append(f"Canal conectado: {voice.channel.name}")
     else:
         info_lines.append("Estado da conexão: ❌ Sem conexão")
+
+    # Latência de arranque das músicas por modo (download completo / streaming / local)
+    info_lines.append(f"Streaming: {'✅ Ativo' if STREAM_MODE else 'desligado'}")
+    for labels, count, avg, p50, p99 in sorted(STARTUP_SECONDS.summaries()):
+        mode = dict(labels).get("mode", "?")
+        info_lines.append(f"Arranque ({mode}): n={count} média={avg:.2f}s p50={p50:.2f}s p99={p99:.2f}s")
+
+    lag = loop_monitor.summary()
+    if lag is not None:
+        info_lines.append(f"Lag do event loop: p99={lag[1] * 1000:.1f}ms máx={lag[2] * 1000:.0f}ms (detalhes: !perf)")
+
+    # CPU do stream atual (FFmpeg via /proc; a parte Python só é visível no fim, ver !stats)
+    info_lines.append(f"Codificação: {AUDIO_ENCODE_MODE} ({OPUS_BITRATE_KBPS} kbps)")
+    source = voice.source if voice and voice.is_playing() else None
+    if isinstance(source, _MeasuredSource):
+        usage = source.cpu_usage()
+        if "ffmpeg" in usage:
+            info_lines.append(f"CPU do FFmpeg neste stream: {usage['ffmpeg'] * 100:.1f}% de um core")
     
     await ctx.reply("```\n" + "\n".join(info_lines) + "\n```")
 
@@ -808,13 +4930,20 @@ def _is_davey_available() -> bool:
         return False
 
 
+_voice_libraries_ok = False
+
+
 def _missing_voice_libraries() -> list[str]:
-    """Lista bibliotecas de voz em falta."""
+    """Lista bibliotecas de voz em falta (depois de estarem todas, não volta a tentar imports a cada !play)."""
+    global _voice_libraries_ok
+    if _voice_libraries_ok:
+        return []
     missing: list[str] = []
     if not _is_pynacl_available():
         missing.append("PyNaCl")
     if not _is_davey_available():
         missing.append("davey")
+    _voice_libraries_ok = not missing
     return missing
 
 
@@ -841,9 +4970,125 @@ def _validate_runtime_for_voice() -> None:
         print("[WARN] " + msg.replace("\n", " "))
 
 
+def _recommended_shards(token: str) -> tuple[int, int]:
+    """(nº de shards recomendado, identifies em paralelo permitidos) segundo GET /gateway/bot."""
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot (music-bot, 1.0)"},
+    )
+    with urllib.request.urlopen(request, timeout=15) as response:
+        data = json.load(response)
+    return int(data["shards"]), int(data.get("session_start_limit", {}).get("max_concurrency", 1))
+
+
+class _ShardProcess:
+    def __init__(self, index: int, shard_ids: list[int]):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process: Optional[subprocess.Popen] = None
+        self.started_at = 0.0
+        self.restarts = 0  # Falhas seguidas (para o backoff)
+        self.restart_at = 0.0
+
+
+class ShardSupervisor:
+    """
+    SHARD_MODE=process: lança um processo por grupo de shards (intervalos contíguos de shard IDs)
+    com este mesmo script, e reinicia-os com backoff exponencial se terminarem.
+    Cada filho tem os seus player loops, pool de extração e pasta da cache de áudio (AUDIO_CACHE_DIR/shard<N>,
+    com uma fração do orçamento); as caches de metadados e de loudness são partilhadas (junção ao gravar).
+    """
+
+    IDENTIFY_INTERVAL_SECONDS = 5.5  # O Discord permite um identify por 5 s (por grupo de max_concurrency)
+    STABLE_AFTER_SECONDS = 60.0  # Um processo que durou isto deixa de contar como falha seguida
+
+    def __init__(self, token: str, shard_count: int, processes: int):
+        self.token = token
+        self.shard_count = shard_count
+        self.processes = processes
+        self.max_concurrency = 1
+        self.children: list[_ShardProcess] = []
+        self.stopping = False
+
+    def _plan(self) -> None:
+        if self.shard_count <= 0:
+            self.shard_count, self.max_concurrency = _recommended_shards(self.token)
+        processes = max(min(self.processes, self.shard_count), 1)
+        self.shard_count = max(self.shard_count, processes)
+        per, extra = divmod(self.shard_count, processes)
+        first = 0
+        for index in range(processes):
+            size = per + (1 if index < extra else 0)
+            self.children.append(_ShardProcess(index, list(range(first, first + size))))
+            first += size
+
+    def _spawn(self, child: _ShardProcess) -> None:
+        env = {
+            **os.environ,
+            "SHARD_MODE": "process",
+            "SHARD_INDEX": str(child.index),
+            "SHARD_IDS": ",".join(map(str, child.shard_ids)),
+            "SHARD_COUNT": str(self.shard_count),
+            "SHARD_PROCESS_COUNT": str(len(self.children)),
+        }
+        child.process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        child.started_at = time.monotonic()
+        print(f"[SHARDS] Processo {child.index} (shards {child.shard_ids[0]}-{child.shard_ids[-1]}) PID {child.process.pid}")
+
+    def _stop(self, *_args) -> None:
+        self.stopping = True
+
+    def run(self) -> int:
+        self._plan()
+        print(f"[SHARDS] {self.shard_count} shards em {len(self.children)} processos")
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+        for child in self.children:
+            if self.stopping:
+                break
+            self._spawn(child)
+            # Escalona os arranques para não exceder o limite de identifies do gateway
+            wait = self.IDENTIFY_INTERVAL_SECONDS * -(-len(child.shard_ids) // self.max_concurrency)
+            deadline = time.monotonic() + wait
+            while time.monotonic() < deadline and not self.stopping:
+                time.sleep(0.2)
+        while not self.stopping:
+            time.sleep(1)
+            now = time.monotonic()
+            for child in self.children:
+                if child.process is None:
+                    if now >= child.restart_at:
+                        self._spawn(child)
+                    continue
+                code = child.process.poll()
+                if code is None:
+                    continue
+                if now - child.started_at >= self.STABLE_AFTER_SECONDS:
+                    child.restarts = 0
+                delay = min(2 ** child.restarts, 60)
+                child.restarts += 1
+                print(f"[SHARDS] Processo {child.index} terminou (código {code}); a reiniciar em {delay}s")
+                child.process = None
+                child.restart_at = now + delay
+        print("[SHARDS] A terminar os processos…")
+        running = [c.process for c in self.children if c.process is not None and c.process.poll() is None]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + 30
+        for process in running:
+            try:
+                process.wait(timeout=max(deadline - time.monotonic(), 0.1))
+            except subprocess.TimeoutExpired:
+                process.kill()
+        return 0
+
+
 if __name__ == "__main__":
     if not TOKEN:
         raise RuntimeError("Define a variável de ambiente DISCORD_BOT_TOKEN com o token do teu bot.")
     _validate_runtime_for_voice()
+    if SHARD_MODE == "process" and SHARD_INDEX < 0:
+        sys.exit(ShardSupervisor(TOKEN, SHARD_COUNT, SHARD_PROCESSES).run())
+    load_persistent_state()
     bot.run(TOKEN)
 